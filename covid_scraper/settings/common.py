@@ -123,6 +123,38 @@ USE_TZ = True
 
 STATIC_URL = '/static/'
 
+
+# Scraper
+
+# ETag/Last-Modified and SHA-256 of the last situation page processed, for conditional fetches
+SITUATION_PAGE_STATE_PATH = os.path.join(BASE_DIR, 'exports', 'html', 'situation_page_state.json')
+
+# Same for each mn.gov dashboard CSV update_dashboard_data downloads
+DASHBOARD_STATE_PATH = os.path.join(BASE_DIR, 'exports', 'dashboard', 'dashboard_state.json')
+
+# BeautifulSoup backend for parsing MDH pages: 'html.parser', 'lxml' or 'selectolax'. Compare them with aux__benchmark_html_parsers.
+HTML_PARSER_BACKEND = 'html.parser'
+
+# Tables already extracted from situation pages, keyed by page hash, so parsing the same page again is a file read. None turns it off.
+TABLE_CACHE_DIR = os.path.join(BASE_DIR, 'exports', 'table_cache')
+TABLE_CACHE_MAX_BYTES = 512 * 1024 * 1024  # Least recently used entries are deleted past this
+
+# Archived situation pages read by the aux__get_cached_* backfills are kept here, stored once per content hash, so no file is downloaded twice
+HTML_ARCHIVE_MIRROR_DIR = os.path.join(BASE_DIR, 'exports', 'html_mirror')
+HTML_ARCHIVE_WORKERS = 16
+HTML_ARCHIVE_LOCAL_DIR = None  # Read the archive from this directory instead of S3
+HTML_ARCHIVE_INDEX_PATH = os.path.join(BASE_DIR, 'exports', 'html_archive_index.sqlite3')  # What's in the archive, so backfills don't have to list it all
+HTML_ARCHIVE_ZSTD_DICTIONARY = None  # A zstd dictionary trained by aux__train_archive_dictionary for archive_raw_payloads to compress with
+BACKFILL_PROCESSES = None  # Processes parsing archived pages in a backfill. None is one per CPU.
+BACKFILL_CHECKPOINT_DIR = os.path.join(BASE_DIR, 'exports', 'backfill_checkpoints')  # Which archived pages each backfill extractor has already done
+
+# Where archive_raw_payloads stores each run's situation page and CDC json: s3://<bucket>/<prefix>/html/, the raw/html/ folder under S3_URL the scrape has always pushed to. settings/docker.py takes them from S3_URL.
+RAW_ARCHIVE_BUCKET = 'static.startribune.com'
+RAW_ARCHIVE_PREFIX = 'news/projects/all/2021-covid-scraper/raw'
+
+# Store the statewide cases, tests, hospitalizations and deaths timeseries as versions with valid_from/valid_to, writing a row only when MDH revises it, instead of the whole table again on every scrape_date. Read them with stats.utils.timeseries_as_of(). aux__version_timeseries converts rows already saved.
+VERSIONED_TIMESERIES = False
+
 try:
     from .local_settings import *
 except ImportError:
@@ -18,3 +18,8 @@ DATABASES = {
         'PORT': 5432,
     }
 }
+
+# S3_URL is <bucket>/<path>, and raw pages have always gone to its raw/ folder
+if os.environ.get('S3_URL'):
+    RAW_ARCHIVE_BUCKET, _, s3_url_path = os.environ['S3_URL'].strip('/').partition('/')
+    RAW_ARCHIVE_PREFIX = '/'.join(p for p in [s3_url_path, 'raw'] if p)
@@ -0,0 +1,28 @@
+#!/bin/bash
+# Push the dashboard CSVs update_dashboard_data saved this run to S3. Used by docker-entrypoint-scrape.sh and by the watch_mdh command.
+# Their hashes and ETags are only saved once every upload has worked, otherwise the next run downloads them again.
+FAILED=0
+trap 'FAILED=1' ERR
+
+EXPORTS_ROOT=covid_scraper/exports
+
+# Only the CSVs whose content changed this run are listed in the manifest
+while read -r LATEST_SUPPLIES_SCRAPE
+do
+  for DASHPATH in db_hosp_cap_* db_procurement_* db_days_on_hand_chart_* db_days_on_hand_tbl_* db_crit_care_supply_sources_* db_dialback_*
+  do
+    if [[ ${LATEST_SUPPLIES_SCRAPE##*/} == $DASHPATH ]]; then
+      echo "Pushing copy of dashboard csv... $LATEST_SUPPLIES_SCRAPE"
+      aws s3 cp $LATEST_SUPPLIES_SCRAPE s3://$S3_URL/dashboard/${LATEST_SUPPLIES_SCRAPE##*/} \
+      --content-type=text/csv \
+      --acl public-read
+    fi
+  done
+done < $EXPORTS_ROOT/dashboard/changed_files.txt
+
+if [ $FAILED -eq 0 ]; then
+  python manage.py update_dashboard_data --commit
+else
+  echo "A dashboard upload failed, so the next run will fetch and push those CSVs again."
+  exit 1
+fi
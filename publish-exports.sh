@@ -0,0 +1,91 @@
+#!/bin/bash
+# Push the exports written by the dump_* commands to S3. Used by docker-entrypoint-scrape.sh and by the watch_mdh command.
+# Exits non-zero if any upload failed, so the caller doesn't mark the run's page processed.
+FAILED=0
+trap 'FAILED=1' ERR
+
+EXPORTS_ROOT=covid_scraper/exports
+COUNTY_LATEST_FILENAME=mn_counties_latest
+STATEWIDE_LATEST_FILENAME=mn_statewide_latest
+STATEWIDE_TIMESERIES_FILENAME=mn_statewide_timeseries
+COUNTY_TIMESERIES_TALL_FILENAME=mn_county_timeseries_tall
+COUNTY_TIMESERIES_ALL_FILENAME=mn_county_timeseries_all_counties
+
+LINE_COUNT=($(wc -l $EXPORTS_ROOT/mn_covid_data/$STATEWIDE_LATEST_FILENAME.csv))
+if (("${LINE_COUNT[0]}" > 1)); then
+  echo "***** Uploading latest statewide and county count CSVs to S3. *****"
+  download_datetime=$(date '+%Y%m%d%H%M%S');
+
+  aws s3 cp $EXPORTS_ROOT/$COUNTY_LATEST_FILENAME.json s3://$S3_URL/latest/json/$COUNTY_LATEST_FILENAME.json \
+  --content-type=application/json \
+  --acl public-read
+
+  aws s3 cp $EXPORTS_ROOT/mn_covid_data/$STATEWIDE_LATEST_FILENAME.csv s3://$S3_URL/latest/csv/$STATEWIDE_LATEST_FILENAME.csv \
+  --content-type=text/csv \
+  --acl public-read
+
+  aws s3 cp $EXPORTS_ROOT/mn_covid_data/$STATEWIDE_LATEST_FILENAME.csv s3://$S3_URL/github/$STATEWIDE_LATEST_FILENAME.csv \
+  --content-type=text/csv \
+  --acl public-read
+
+  aws s3 cp $EXPORTS_ROOT/mn_covid_data/$STATEWIDE_LATEST_FILENAME.csv s3://$S3_URL/versions/csv/$STATEWIDE_LATEST_FILENAME-$download_datetime.csv \
+  --content-type=text/csv \
+  --acl public-read
+
+else
+  echo "***** WARNING WARNING WARNING: The newest 'latest' file is very short. Taking no further action. *****"
+fi
+printf "\n\n"
+
+# Only dump if csvs have many lines or were produced in last few minutes
+LINE_COUNT=($(wc -l $EXPORTS_ROOT/mn_covid_data/$STATEWIDE_TIMESERIES_FILENAME.csv))
+if (("${LINE_COUNT[0]}" > 2)); then
+  echo "***** Uploading timeseries CSVs to S3. *****"
+
+  aws s3 cp $EXPORTS_ROOT/mn_covid_data/$STATEWIDE_TIMESERIES_FILENAME.csv s3://$S3_URL/latest/csv/$STATEWIDE_TIMESERIES_FILENAME.csv \
+  --content-type=text/csv \
+  --acl public-read
+
+  aws s3 cp $EXPORTS_ROOT/mn_covid_data/$STATEWIDE_TIMESERIES_FILENAME.csv s3://$S3_URL/github/$STATEWIDE_TIMESERIES_FILENAME.csv \
+  --content-type=text/csv \
+  --acl public-read
+
+  aws s3 cp $EXPORTS_ROOT/$STATEWIDE_TIMESERIES_FILENAME.json s3://$S3_URL/latest/json/$STATEWIDE_TIMESERIES_FILENAME.json \
+  --content-type=application/json \
+  --acl public-read
+
+  gzip -vc $EXPORTS_ROOT/mn_covid_data/$COUNTY_TIMESERIES_TALL_FILENAME.csv | aws s3 cp - s3://$S3_URL/latest/csv/$COUNTY_TIMESERIES_TALL_FILENAME.csv.gz \
+  --content-type=text/csv \
+  --acl public-read \
+  --content-encoding gzip
+
+  aws s3 cp $EXPORTS_ROOT/mn_covid_data/$COUNTY_TIMESERIES_TALL_FILENAME.csv s3://$S3_URL/github/$COUNTY_TIMESERIES_TALL_FILENAME.csv \
+  --content-type=text/csv \
+  --acl public-read
+
+  aws s3 cp $EXPORTS_ROOT/mn_covid_data/$COUNTY_TIMESERIES_ALL_FILENAME.csv s3://$S3_URL/github/$COUNTY_TIMESERIES_ALL_FILENAME.csv \
+  --content-type=text/csv \
+  --acl public-read
+
+  aws s3 cp $EXPORTS_ROOT/mn_covid_data/$STATEWIDE_TIMESERIES_FILENAME.csv s3://$S3_URL/versions/csv/$STATEWIDE_TIMESERIES_FILENAME-$download_datetime.csv \
+  --content-type=text/csv \
+  --acl public-read
+
+  aws s3 cp $EXPORTS_ROOT/$STATEWIDE_TIMESERIES_FILENAME.json s3://$S3_URL/versions/json/$STATEWIDE_TIMESERIES_FILENAME-$download_datetime.json \
+  --content-type=application/json \
+  --acl public-read
+
+  aws s3 cp $EXPORTS_ROOT/mn_covid_data/$COUNTY_TIMESERIES_TALL_FILENAME.csv s3://$S3_URL/versions/csv/$COUNTY_TIMESERIES_TALL_FILENAME-$download_datetime.csv \
+  --content-type=text/csv \
+  --acl public-read
+
+  aws s3 cp $EXPORTS_ROOT/mn_county_timeseries.json s3://$S3_URL/latest/json/mn_county_timeseries.json \
+  --content-type=application/json \
+  --acl public-read
+
+else
+  echo "***** WARNING WARNING WARNING: The newest file is very short. Taking no further action. *****"
+fi
+printf "\n"
+
+exit $FAILED
@@ -0,0 +1,204 @@
+import os
+import csv
+import glob
+import datetime
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from stats.utils import SituationPage, ArchiveIndex, html_archive, add_archive_arguments, find_filename_date_matchs
+
+# Extractors aux__backfill_archive can run together, by name
+BACKFILL_EXTRACTORS = {
+    'icu': 'stats.management.commands.aux__get_cached_icu.IcuExtractor',
+    'care_homes': 'stats.management.commands.aux__get_cached_care_homes.CareHomesExtractor',
+    'care_deaths': 'stats.management.commands.aux__get_cached_care_deaths.CareDeathsExtractor',
+    'ltc_cases': 'stats.management.commands.aux__get_cached_ltc_cases.LtcCasesExtractor',
+    'deaths_by_race': 'stats.management.commands.aux__get_cached_deaths_by_race.DeathsByRaceExtractor',
+    'presumed_deaths': 'stats.management.commands.aux__get_cached_presumed_deaths.PresumedDeathsExtractor',
+}
+
+
+class ArchiveExtractor:
+    ''' Something to pull out of archived situation pages. The class attributes pick which archived files it wants, like the arguments to find_filename_date_matchs(). extract() runs in a worker process and has to return picklable records. start(), write() and finish() run in the main process, with write() getting each page's records in date order as they come in. When start() is told to append, only pages it hasn't seen before will come in, and their results should be added to what the last run wrote. '''
+    name = None
+    version = 1  # Bump when extract() changes, so the next run starts over instead of appending
+    streams = False  # True if write() saves each page's results right away, so the checkpoint can advance page by page
+    bucket = 'static.startribune.com'
+    prefix = settings.S3_EXPORT_PREFIX
+    hour = None
+    slice = 'first'
+
+    def extract(self, page, scrape_date):
+        return []
+
+    def start(self, append=False):
+        pass
+
+    def write(self, scrape_date, records):
+        pass
+
+    def finish(self):
+        pass
+
+
+class CsvArchiveExtractor(ArchiveExtractor):
+    ''' Writes records to csv_path as they arrive, with the first record's keys as the header '''
+    csv_path = None
+    streams = True
+
+    def start(self, append=False):
+        self.csvfile = None
+        self.append = append and os.path.exists(self.csv_path) and os.path.getsize(self.csv_path) > 0
+
+    def write(self, scrape_date, records):
+        if not records:
+            return
+        if self.csvfile is None:
+            if self.append:
+                with open(self.csv_path, newline='') as f:
+                    fieldnames = next(csv.reader(f))
+                self.csvfile = open(self.csv_path, 'a', newline='')
+                self.writer = csv.DictWriter(self.csvfile, fieldnames=fieldnames, lineterminator='\n')
+            else:
+                self.csvfile = open(self.csv_path, 'w', newline='')
+                self.writer = csv.DictWriter(self.csvfile, fieldnames=records[0].keys(), lineterminator='\n')
+                self.writer.writeheader()
+        self.writer.writerows(records)
+        self.csvfile.flush()  # Before the checkpoint says this page is done
+
+    def finish(self):
+        if self.csvfile is not None:
+            self.csvfile.close()
+
+
+class BackfillCheckpoint:
+    ''' The archive keys an extractor has already handled at its current version, one per line, so the next run only reads new ones '''
+    def __init__(self, extractor):
+        self.name = extractor.name
+        self.path = os.path.join(settings.BACKFILL_CHECKPOINT_DIR, '{}.v{}.keys'.format(extractor.name, extractor.version))
+        try:
+            with open(self.path) as f:
+                self.keys = set(line.strip() for line in f if line.strip())
+        except FileNotFoundError:
+            self.keys = set()
+
+    def reset(self):
+        ''' Forget every key, including those recorded by other versions of the extractor '''
+        os.makedirs(settings.BACKFILL_CHECKPOINT_DIR, exist_ok=True)
+        for path in glob.glob(os.path.join(settings.BACKFILL_CHECKPOINT_DIR, '{}.v*.keys'.format(self.name))):
+            os.remove(path)
+        self.keys = set()
+
+    def add(self, keys):
+        with open(self.path, 'a') as f:
+            for key in keys:
+                f.write(key + '\n')
+        self.keys.update(keys)
+
+
+def extractor_path(extractor):
+    return '{}.{}'.format(type(extractor).__module__, type(extractor).__qualname__)
+
+_worker_extractors = {}
+
+def extract_page(paths, html, scrape_date):
+    ''' Runs in a worker process. Parses the page once and runs every extractor that wants it. '''
+    page = SituationPage(html)
+    extracted = {}
+    for path in paths:
+        if path not in _worker_extractors:
+            _worker_extractors[path] = import_string(path)()
+        extracted[path] = _worker_extractors[path].extract(page, scrape_date)
+    return extracted
+
+def extract_pages(archive, files, pool, max_in_flight):
+    ''' Yield (file, extracted) in archive order, downloading and parsing ahead of the caller '''
+    in_flight = deque()
+    for f, (scrape_date, html) in zip(files, archive.prefetch(files, in_order=True)):
+        paths = [extractor_path(e) for e in f['extractors']]
+        if pool is None:
+            yield f, extract_page(paths, html, scrape_date)
+            continue
+
+        in_flight.append((f, pool.submit(extract_page, paths, html, scrape_date)))
+        if len(in_flight) >= max_in_flight:
+            f, future = in_flight.popleft()
+            yield f, future.result()
+
+    while in_flight:
+        f, future = in_flight.popleft()
+        yield f, future.result()
+
+def run_backfill(extractors, archive_dir=None, workers=None, processes=None, full=False, use_index=False):
+    ''' Read every archived page the extractors want once, running all of them on each page, and feed them the results in date order. Pages an extractor's checkpoint says it has already handled are skipped and its output is appended to, unless full. Pages are picked from a listing of the archive, or with use_index from the archive index, which is brought up to date first by reading every page archived since its last update. '''
+    processes = processes or settings.BACKFILL_PROCESSES or os.cpu_count()
+
+    checkpoints = {}
+    archives = {}
+    for extractor in extractors:
+        checkpoint = BackfillCheckpoint(extractor)
+        if full or not checkpoint.keys:
+            checkpoint.reset()
+            extractor.start(append=False)
+        else:
+            print('{}: {} archived pages already done, appending'.format(extractor.name, len(checkpoint.keys)))
+            extractor.start(append=True)
+        checkpoints[extractor.name] = checkpoint
+        archives.setdefault((extractor.bucket, extractor.prefix), []).append(extractor)
+
+    finished_keys = {extractor.name: [] for extractor in extractors}  # For extractors that only save their output in finish()
+    index = ArchiveIndex() if use_index else None
+    pool = ProcessPoolExecutor(max_workers=processes, initializer=django.setup) if processes > 1 else None
+    try:
+        for (bucket, prefix), archive_extractors in archives.items():
+            archive = html_archive(bucket, prefix, archive_dir, workers)
+            if index:
+                print('Indexed {} newly archived pages'.format(index.update(archive)))
+            else:
+                keys = archive.list_keys()  # Only the pages picked below get downloaded
+
+            wanted = {}
+            for extractor in archive_extractors:
+                # The first or last page in the hour if there is one, otherwise the day's last page
+                if index:
+                    matches = index.pages(archive.name, hour=extractor.hour, slice=extractor.slice if extractor.hour is not None else 'last')
+                else:
+                    matches = find_filename_date_matchs(keys, hour=extractor.hour, slice=extractor.slice)
+                for f in matches:
+                    # Today's pages are still coming in, so which one is the day's last isn't settled. Leave them for the next run.
+                    if f['key'] not in checkpoints[extractor.name].keys and f['scrape_date'] < datetime.date.today():
+                        wanted.setdefault(f['key'], {'key': f['key'], 'scrape_date': f['scrape_date'], 'extractors': []})['extractors'].append(extractor)
+            files = [wanted[key] for key in sorted(wanted)]
+            print('Reading {} archived pages from {}/{} for {}'.format(len(files), bucket, prefix, ', '.join(e.name for e in archive_extractors)))
+
+            for f, extracted in extract_pages(archive, files, pool, processes * 2):
+                for extractor in f['extractors']:
+                    records = extracted[extractor_path(extractor)]
+                    print('{} {}: {} records'.format(f['scrape_date'], extractor.name, len(records)))
+                    extractor.write(f['scrape_date'], records)
+                    if extractor.streams:
+                        checkpoints[extractor.name].add([f['key']])
+                    else:
+                        finished_keys[extractor.name].append(f['key'])
+    finally:
+        if index:
+            index.close()
+        if pool is not None:
+            pool.shutdown()
+
+    for extractor in extractors:
+        extractor.finish()
+        checkpoints[extractor.name].add(finished_keys[extractor.name])
+
+def add_backfill_arguments(parser):
+    add_archive_arguments(parser)
+    parser.add_argument('--processes', type=int, help='Parse this many pages at once (default BACKFILL_PROCESSES, or one per CPU). 1 parses in this process.')
+    parser.add_argument('--full', action='store_true', help='Ignore the checkpoint and redo the whole archive, replacing the output instead of appending to it')
+    parser.add_argument('--use-index', action='store_true', help='Pick pages from the archive index (HTML_ARCHIVE_INDEX_PATH) instead of listing the archive. Updating the index reads every page archived since it was last updated, so build it first with aux__index_html_archive.')
+
+def backfill_options(options):
+    return {'archive_dir': options['archive_dir'], 'workers': options['workers'], 'processes': options['processes'], 'full': options['full'], 'use_index': options['use_index']}
@@ -0,0 +1,79 @@
+import os
+
+import requests
+from django.conf import settings
+from django.utils import timezone
+from django.core.management.base import BaseCommand, CommandError
+
+from stats.utils import ArchiveIndex, ARCHIVE_KEY_RE, html_archive_backend, read_situation_page_snapshot, load_situation_page_state
+
+
+class Command(BaseCommand):
+    help = '''Archive this run's raw situation page and CDC vaccine json to <prefix>/html/. Each payload is stored once per SHA-256, compressed with zstd (or gzip without zstandard), and every timestamp gets a small pointer file naming it, so a page that didn't change costs a pointer instead of another full copy. New payloads are also written uncompressed under their own names (situation_<date>_<time>.html, cdc_vac_<date>_<time>.json), so the public raw/html/ URLs keep working.'''
+
+    CDC_VACCINE_DATA_URL = 'https://covid.cdc.gov/covid-data-tracker/COVIDData/getAjaxData?id=vaccination_data'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--situation-page', help='Situation page snapshot written by snapshot_situation_page')
+        parser.add_argument('--unchanged', action='store_true', help='The situation page is the same as the last processed one, so point this timestamp at it')
+        parser.add_argument('--cdc', action='store_true', help='Download and archive the CDC vaccine data json')
+        parser.add_argument('--timestamp', help='<date>_<time> for the archived names. Defaults to the snapshot\'s, or now.')
+        parser.add_argument('--bucket', default=settings.RAW_ARCHIVE_BUCKET)
+        parser.add_argument('--prefix', default=settings.RAW_ARCHIVE_PREFIX)
+        parser.add_argument('--no-raw-copy', action='store_true', help="Only store the compressed object and pointer, not the plain copy under the payload's own name")
+        parser.add_argument('--archive-dir', help='Archive to this directory instead of S3')
+        parser.add_argument('--dictionary', default=settings.HTML_ARCHIVE_ZSTD_DICTIONARY, help='zstd dictionary to compress situation pages with')
+
+    def get_timestamp(self, options):
+        if options['timestamp']:
+            return options['timestamp']
+        match = ARCHIVE_KEY_RE.search(options['situation_page'] or '')
+        if match:
+            return '{}_{}{}'.format(*match.groups())
+        return timezone.localtime().strftime('%Y-%m-%d_%H%M')
+
+    def report(self, key, sha256, new):
+        print('Archived {} -> {} ({})'.format(key, sha256, 'new content' if new else 'same as an earlier payload, pointer only'))
+
+    def archive(self, backend, key, body, content_type, options, dictionary=None):
+        sha256, new = backend.archive(key, body, dictionary)
+        if new and not options['no_raw_copy']:
+            backend.put(key, body, content_type)
+        self.report(key, sha256, new)
+
+    def handle(self, *args, **options):
+        backend = html_archive_backend(options['bucket'], options['prefix'], options['archive_dir'])
+        timestamp = self.get_timestamp(options)
+
+        dictionary = None
+        if options['dictionary']:
+            with open(options['dictionary'], 'rb') as f:
+                dictionary = f.read()
+
+        if options['situation_page']:
+            html = read_situation_page_snapshot(options['situation_page'])
+            key = backend.payload_key('situation', timestamp, 'html')
+            self.archive(backend, key, html, 'text/html', options, dictionary)
+
+            # Only add to an index that's already built, since ArchiveIndex.update() picks up after its last key
+            if settings.HTML_ARCHIVE_INDEX_PATH and os.path.exists(settings.HTML_ARCHIVE_INDEX_PATH):
+                index = ArchiveIndex()
+                if index.last_key(backend.name):
+                    index.add(backend.name, key, html)
+                    index.db.commit()
+                index.close()
+
+        elif options['unchanged']:
+            key = backend.payload_key('situation', timestamp, 'html')
+            sha256 = load_situation_page_state()['processed'].get('sha256')
+            if sha256 and backend.point(key, sha256):
+                self.report(key, sha256, False)
+            else:
+                print("Last processed situation page isn't in the archive. Not archiving {}.".format(key))
+
+        if options['cdc']:
+            r = requests.get(self.CDC_VACCINE_DATA_URL)
+            if r.status_code != requests.codes.ok:
+                raise CommandError("Couldn't download CDC vaccine data ({})".format(r.status_code))
+            key = backend.payload_key('cdc_vac', timestamp, 'json')
+            self.archive(backend, key, r.content, 'text/html', options)  # Same content type the json was always uploaded with
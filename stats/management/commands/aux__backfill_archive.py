@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.module_loading import import_string
+
+from stats.backfill import BACKFILL_EXTRACTORS, run_backfill, add_backfill_arguments, backfill_options
+
+
+class Command(BaseCommand):
+    help = 'Run several of the aux__get_cached_* extractors in one pass over the HTML archive, so each archived page is downloaded and parsed once'
+
+    def add_arguments(self, parser):
+        parser.add_argument('extractors', nargs='*', help='Any of {}. Defaults to all of them.'.format(', '.join(sorted(BACKFILL_EXTRACTORS.keys()))))
+        add_backfill_arguments(parser)
+
+    def handle(self, *args, **options):
+        names = options['extractors'] or sorted(BACKFILL_EXTRACTORS.keys())
+        unknown = [name for name in names if name not in BACKFILL_EXTRACTORS]
+        if unknown:
+            raise CommandError('Unknown extractors: {}'.format(', '.join(unknown)))
+        extractors = [import_string(BACKFILL_EXTRACTORS[name])() for name in names]
+        run_backfill(extractors, **backfill_options(options))
@@ -2,6 +2,7 @@ from django.core.management.base import BaseCommand
 from django.db.models import Window, F
 from django.db.models.functions import Lead
 from stats.models import StatewideHospitalizationsDate, StatewideTotalDate
+from stats.utils import timeseries_as_of
 
 
 class Command(BaseCommand):
@@ -10,13 +11,15 @@ class Command(BaseCommand):
     def get_timeseries_values(self):
         # this is a weird one -- we want the totals as they were reported at the time, not the updated totals. Only needed for the cumulative totals
         hosp_totals_values = {}
-        hosp_scrape_dates =  StatewideHospitalizationsDate.objects.all().values_list('scrape_date', flat=True).distinct()
-        for t in hosp_scrape_dates:
+        for t in StatewideTotalDate.objects.all().values_list('scrape_date', flat=True).distinct():
+            hosp_records = timeseries_as_of(StatewideHospitalizationsDate, t)
+            if not hosp_records.exists():
+                continue
             try:
                 # For most dates now the max value is contained in the "Missing" cell
-                total_record = StatewideHospitalizationsDate.objects.get(scrape_date=t, reported_date=None).__dict__
+                total_record = hosp_records.get(reported_date=None).__dict__
             except:
-                total_record = StatewideHospitalizationsDate.objects.filter(scrape_date=t).latest('reported_date').__dict__
+                total_record = hosp_records.latest('reported_date').__dict__
             hosp_totals_values[t] = total_record
 
         return hosp_totals_values
@@ -0,0 +1,147 @@
+import os
+import glob
+import time
+import datetime
+import statistics
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from stats.utils import make_soup, HTML_PARSER_BACKENDS, timeseries_table_parser, parse_comma_int, lxml_document, table_columns, columns_frame, parse_mdh_date_series
+
+
+class Command(BaseCommand):
+    help = 'Time each HTML parser backend on archived situation pages, and check that every backend pulls the same tables out of them as html.parser. Also times row-dict vs. columnar extraction of the timeseries tables.'
+
+    TABLE_IDS = [
+        'casetable', 'labtable', 'hosptable', 'deathtable',
+        'hosptotal', 'casetotal', 'dailycasetotal', 'testtotal', 'deathtotal', 'noisototal',
+        'maptable', 'agetable', 'dailydeathar', 'dailydeathtotal', 'raceethtable', 'restable', 'dailydeathrt',
+    ]
+    TIMESERIES_TABLE_IDS = ['casetable', 'labtable', 'hosptable', 'deathtable']
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='*', help='Archived situation pages, or directories of them. Defaults to exports/html.')
+        parser.add_argument('--repeat', type=int, default=3, help='Parse each page this many times and keep the fastest')
+        parser.add_argument('--backends', nargs='+', default=HTML_PARSER_BACKENDS, choices=HTML_PARSER_BACKENDS)
+
+    def find_pages(self, paths):
+        pages = []
+        for path in paths or [os.path.join(settings.BASE_DIR, 'exports', 'html')]:
+            if os.path.isdir(path):
+                pages.extend(sorted(glob.glob(os.path.join(path, 'situation_*.html'))))
+            else:
+                pages.append(path)
+        return pages
+
+    def extract(self, soup):
+        '''The bits of the page the scraper actually reads, for comparing backends'''
+        extracted = {}
+        for table_id in self.TABLE_IDS:
+            table = soup.find('table', {'id': table_id})
+            if table:
+                extracted[table_id] = [[c.text for c in row.find_all(['th', 'td'])] for row in table.find_all('tr')]
+        update_node = soup.find('strong', text=lambda t: t and t.startswith('Updated'))
+        extracted['update_date'] = update_node.text if update_node else None
+        return extracted
+
+    def parse_row_dicts(self, soup):
+        '''The old way: a dict per row, then parse_comma_int cell by cell'''
+        for table_id in self.TIMESERIES_TABLE_IDS:
+            table = soup.find('table', {'id': table_id})
+            for row in timeseries_table_parser(table):
+                for k, (col, value) in enumerate(row.items()):
+                    if k > 0:
+                        parse_comma_int(value) if value.strip() else None
+                    else:
+                        try:
+                            month, day, year = value.split()[-1].split('/')
+                            datetime.date(int('20' + year), int(month), int(day))
+                        except ValueError:
+                            pass
+
+    def parse_columns(self, doc):
+        '''Columnar: whole columns converted at once'''
+        for table_id in self.TIMESERIES_TABLE_IDS:
+            columns = table_columns(doc.get_element_by_id(table_id))
+            col_names = list(columns.keys())
+            frame = columns_frame(columns, int_columns=col_names[1:])
+            parse_mdh_date_series(frame[col_names[0]].replace('Admitted on or before 3/5/20', '3/5/20'))  # Like update_mn_data does for hosptable
+
+    def time_best(self, fn, repeat):
+        best = None
+        for n in range(repeat):
+            start = time.perf_counter()
+            fn()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    def benchmark_extraction(self, pages, repeat):
+        timings = {'row dicts': [], 'columnar': [], 'row dicts + parse': [], 'columnar + parse': []}
+        for page in pages:
+            with open(page, 'rb') as f:
+                html = f.read()
+            soup = make_soup(html, 'html.parser')
+            doc = lxml_document(html)
+            if not all(doc.get_element_by_id(table_id, None) is not None for table_id in self.TIMESERIES_TABLE_IDS):
+                continue
+
+            timings['row dicts'].append(self.time_best(lambda: self.parse_row_dicts(soup), repeat))
+            timings['columnar'].append(self.time_best(lambda: self.parse_columns(doc), repeat))
+            timings['row dicts + parse'].append(self.time_best(lambda: self.parse_row_dicts(make_soup(html, 'html.parser')), repeat))
+            timings['columnar + parse'].append(self.time_best(lambda: self.parse_columns(lxml_document(html)), repeat))
+
+        if not timings['row dicts']:
+            return
+        print('\nTimeseries tables ({}) on {} pages:'.format(', '.join(self.TIMESERIES_TABLE_IDS), len(timings['row dicts'])))
+        print('{:<18} {:>10} {:>9}'.format('extraction', 'median ms', 'speedup'))
+        for method, baseline_method in [('row dicts', 'row dicts'), ('columnar', 'row dicts'), ('row dicts + parse', 'row dicts + parse'), ('columnar + parse', 'row dicts + parse')]:
+            median = statistics.median(timings[method])
+            print('{:<18} {:>10.1f} {:>8.1f}x'.format(method, median * 1000, statistics.median(timings[baseline_method]) / median))
+
+    def handle(self, *args, **options):
+        pages = self.find_pages(options['paths'])
+        if not pages:
+            raise CommandError('No archived pages found.')
+        print('Benchmarking {} on {} pages...'.format(', '.join(options['backends']), len(pages)))
+
+        timings = {b: [] for b in options['backends']}
+        mismatches = {b: [] for b in options['backends']}
+        for page in pages:
+            with open(page, 'rb') as f:
+                html = f.read()
+
+            reference = self.extract(make_soup(html, 'html.parser'))
+            for backend in options['backends']:
+                best = None
+                for n in range(options['repeat']):
+                    start = time.perf_counter()
+                    soup = make_soup(html, backend)
+                    elapsed = time.perf_counter() - start
+                    best = elapsed if best is None else min(best, elapsed)
+                timings[backend].append(best)
+
+                extracted = self.extract(soup)
+                if extracted != reference:
+                    differing = [k for k in reference.keys() | extracted.keys() if reference.get(k) != extracted.get(k)]
+                    mismatches[backend].append((os.path.basename(page), differing))
+
+        baseline = statistics.median(timings['html.parser']) if 'html.parser' in timings else None
+        print('{:<12} {:>10} {:>10} {:>10} {:>9} {:>11}'.format('backend', 'median ms', 'mean ms', 'total s', 'speedup', 'mismatches'))
+        for backend in options['backends']:
+            median = statistics.median(timings[backend])
+            print('{:<12} {:>10.1f} {:>10.1f} {:>10.2f} {:>9} {:>11}'.format(
+                backend,
+                median * 1000,
+                statistics.mean(timings[backend]) * 1000,
+                sum(timings[backend]),
+                '{:.1f}x'.format(baseline / median) if baseline else '-',
+                len(mismatches[backend]),
+            ))
+
+        for backend in options['backends']:
+            for page, differing in mismatches[backend]:
+                print('{} differs from html.parser on {}: {}'.format(backend, page, ', '.join(sorted(differing))))
+
+        self.benchmark_extraction(pages, options['repeat'])
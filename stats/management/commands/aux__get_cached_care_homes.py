@@ -1,63 +1,83 @@
 import os
 import csv
-import boto3
-from bs4 import BeautifulSoup
+import ast
+import datetime
 from django.conf import settings
 from django.core.management.base import BaseCommand
 
-from stats.utils import get_matching_s3_cached_html, find_filename_date_matchs, get_s3_file_contents
+from stats.backfill import ArchiveExtractor, run_backfill, add_backfill_arguments, backfill_options
 
-class Command(BaseCommand):
-    help = 'Find the first date that each care home appears on the situation page'
 
-    S3_HTML_BUCKET = 'static.startribune.com'
-    S3_HTML_PATH = settings.S3_EXPORT_PREFIX
+class CareHomesExtractor(ArchiveExtractor):
+    ''' Every care home listed on each noon page '''
+    name = 'care_homes'
+    hour = 12
+    csv_path = os.path.join(settings.BASE_DIR, 'exports', 'care_facilities_dates.csv')
 
-    def handle(self, *args, **options):
-        session = boto3.Session(
-            aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-        )
-        s3 = session.client('s3')
-
-        matching_files = get_matching_s3_cached_html(self.S3_HTML_BUCKET, self.S3_HTML_PATH, s3)
-        noon_files = find_filename_date_matchs(matching_files, 12)
-
-        facilities = {}
-
-        for f in noon_files:
-            soup = BeautifulSoup(get_s3_file_contents(f, self.S3_HTML_BUCKET, s3), 'html.parser')
-
-            homes_table = None
-            homes_th = soup.find('th', text='Facility')
-            if homes_th:
-                homes_table = homes_th.find_parent('table')
-                for row in homes_table.find_all('tr')[1:]:
-                    cells = row.find_all(['th', 'td'])
-                    # print(cells)
-                    facility_name = cells[1].text
-                    county = cells[0].text
+    def extract(self, page, scrape_date):
+        homes = []
+        homes_table = None
+        homes_th = page.soup.find('th', text='Facility')
+        if homes_th:
+            homes_table = homes_th.find_parent('table')
+            for row in homes_table.find_all('tr')[1:]:
+                cells = row.find_all(['th', 'td'])
+                # print(cells)
+                homes.append({'name': cells[1].text, 'county': cells[0].text})
+        return homes
 
+    def start(self, append=False):
+        self.facilities = {}
+        if append and os.path.exists(self.csv_path):
+            # Pick up the dates found last time
+            with open(self.csv_path) as csvfile:
+                for row in csv.DictReader(csvfile):
                     home_lookup = {
-                        'name': facility_name.strip(),
-                        'county': county.strip(),
+                        'name': row['name'].strip(),
+                        'county': row['county'].strip(),
+                    }
+                    self.facilities[hash(frozenset(home_lookup.items()))] = {
+                        'name': row['name'],
+                        'county': row['county'],
+                        'dates': [datetime.datetime.strptime(d, '%Y-%m-%d').date() for d in ast.literal_eval(row['dates'])],
                     }
-                    print(home_lookup)
-                    hashed_lookup = hash(frozenset(home_lookup.items()))
-                    if hashed_lookup not in facilities.keys():
-                        facilities[hashed_lookup] = {'name': facility_name, 'county': county, 'dates': [f['scrape_date']]}
-                    else:
-                        facilities[hashed_lookup]['dates'].append(f['scrape_date'])
-
-        final_facilities = [item for key, item in facilities.items()]
+
+    def write(self, scrape_date, records):
+        for home in records:
+            facility_name = home['name']
+            county = home['county']
+
+            home_lookup = {
+                'name': facility_name.strip(),
+                'county': county.strip(),
+            }
+            print(home_lookup)
+            hashed_lookup = hash(frozenset(home_lookup.items()))
+            if hashed_lookup not in self.facilities.keys():
+                self.facilities[hashed_lookup] = {'name': facility_name, 'county': county, 'dates': [scrape_date]}
+            else:
+                self.facilities[hashed_lookup]['dates'].append(scrape_date)
+
+    def finish(self):
+        final_facilities = [item for key, item in self.facilities.items()]
         for f in final_facilities:
             f['min_date'] = min(f['dates'])
             f['max_date'] = max(f['dates'])
             f['dates'] = [d.strftime('%Y-%m-%d') for d in f['dates']]
 
         print(final_facilities)
-        with open(os.path.join(settings.BASE_DIR, 'exports', 'care_facilities_dates.csv'), 'w') as csvfile:
+        with open(self.csv_path, 'w') as csvfile:
 
             writer = csv.DictWriter(csvfile, fieldnames=final_facilities[0].keys())
             writer.writeheader()
             writer.writerows(final_facilities)
+
+
+class Command(BaseCommand):
+    help = 'Find the first date that each care home appears on the situation page'
+
+    def add_arguments(self, parser):
+        add_backfill_arguments(parser)
+
+    def handle(self, *args, **options):
+        run_backfill([CareHomesExtractor()], **backfill_options(options))
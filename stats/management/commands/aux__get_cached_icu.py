@@ -1,43 +1,15 @@
-import os
-import csv
 import datetime
-import boto3
-from bs4 import BeautifulSoup
-from django.conf import settings
 from django.core.management.base import BaseCommand
 
 from stats.models import StatewideHospitalizationsDate
-from stats.utils import get_matching_s3_cached_html, find_filename_date_matchs, get_s3_file_contents
+from stats.backfill import ArchiveExtractor, run_backfill, add_backfill_arguments, backfill_options
 
-class Command(BaseCommand):
-    help = 'Find the first date that each care home appears on the situation page'
-
-    S3_HTML_BUCKET = 'static.startribune.com'
-    S3_HTML_PATH = settings.S3_EXPORT_PREFIX
-
-    def full_table_parser(self, table):
-        ''' should work on multiple columns '''
-        # table = soup.find("th", text=find_str).find_parent("table")
-        rows = table.find_all("tr")
-        num_rows = len(rows)
-        data_rows = []
-        for k, row in enumerate(rows):
-            # print(row)
-            if k == 0:
-                first_row = row.find_all("th")
-                col_names = [' '.join(th.text.split()).replace('<br>', ' ') for th in first_row]
-                # print(col_names)
-            else:
-                data_row = {}
-                cells = row.find_all(["th", "td"])
-                if len(cells) > 0:  # Filter out bad TRs
-                    for k, c in enumerate(col_names):
-                        # print(cells[k].text)
-
-                        data_row[c] = cells[k].text
-                    data_rows.append(data_row)
-
-        return data_rows
+
+class IcuExtractor(ArchiveExtractor):
+    ''' Statewide hospitalization and ICU totals by date, from the last cached page of each day '''
+    name = 'icu'
+    streams = True
+    LAST_SCRAPE_DATE = datetime.date(2020, 9, 23)  # The main scraper has the hospitalizations timeseries after this
 
     def parse_comma_int(self, input):
         if input.strip() in ['-', '-\xa0\xa0']:
@@ -64,7 +36,7 @@ class Command(BaseCommand):
             # existing_today_records.delete()
             hosp_objs = []
             for c in hosp_timeseries:
-                if c['scrape_date'] <= datetime.date(2020, 9, 23):
+                if c['scrape_date'] <= self.LAST_SCRAPE_DATE:
                     std = StatewideHospitalizationsDate(
                         reported_date=c['reported_date'],
                         total_hospitalizations=c['total_hospitalizations'],
@@ -103,7 +75,14 @@ class Command(BaseCommand):
       {"reported_date": "4/10", "total_hospitalizations": 317, "total_icu_admissions": 131}
     ]
 
-    def handle(self, *args, **options):
+    def start(self, append=False):
+        if append:  # Already loaded
+            return
+
+        # Starting over, so remove the snapshot rows the last backfill wrote
+        old_records = StatewideHospitalizationsDate.objects.filter(valid_from__isnull=True, scrape_date__lte=self.LAST_SCRAPE_DATE)
+        print('Removing {} records of hospitalizations timeseries data'.format(old_records.count()))
+        old_records.delete()
 
         icu_dates = []
 
@@ -121,74 +100,72 @@ class Command(BaseCommand):
                         'total_hospitalizations': d['total_hospitalizations']
                     })
 
-        # Now move on to the cached files.
-        session = boto3.Session(
-            aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-        )
-        s3 = session.client('s3')
-
-        matching_files = get_matching_s3_cached_html(self.S3_HTML_BUCKET, self.S3_HTML_PATH, s3)
-        last_files_of_day = find_filename_date_matchs(matching_files)
-
-        for f in last_files_of_day:
-            soup = BeautifulSoup(get_s3_file_contents(f, self.S3_HTML_BUCKET, s3), 'html.parser')
-
-            hosp_table = None
-            hosp_div = soup.find('div', id='hosp')
-            if hosp_div:
-                hosp_table = hosp_div.find('table')
-                if hosp_table:
-                    print(f['scrape_date'])
-
-                    table_data = self.full_table_parser(hosp_table)
-                    for row in table_data:
-                        if f['scrape_date'] <= datetime.date(2020, 9, 23):
-
-                            if 'Date reported' in row:
-                                reported_date = self.parse_date(row['Date reported'])
-                            elif 'Date' in row:
-                                reported_date = self.parse_date(row['Date'])
-                            else:
-                                print(row)
-                                reported_date = 'HEY SOMETHING IS WRONG'
-
-                            # if f['scrape_date'] != reported_date:
-                            #     print(f['scrape_date'], reported_date)
-                            #     print('DATE MISMATCH.')
-
-                            # print(row)
-                            # if 'Cases admitted to a hospital' in row:
-                            #     new_hospitalizations = self.parse_comma_int(c['Cases admitted to a hospital'])
-                            # elif 'Hospitalized, not in ICU (daily)' in row:
-                            #     new_hospitalizations = self.parse_comma_int(row['Hospitalized, not in ICU (daily)']) + self.parse_comma_int(row['Hospitalized in ICU (daily)'])
-                            # else:
-                            #     print(row)
-                            #     new_hospitalizations = 'HEY SOMETHING IS WRONG'
-
-                            if 'Total ICU hospitalizations' in row:
-                                total_icu_admissions = self.parse_comma_int(row['Total ICU hospitalizations'])
-                            elif 'Total ICU hospitalizations (cumulative)' in row:
-                                total_icu_admissions = self.parse_comma_int(row['Total ICU hospitalizations (cumulative)'])
-                            else:
-                                print(row)
-                                total_icu_admissions = 'HEY SOMETHING IS WRONG'
-
-                            if 'Total hospitalizations' in row:
-                                total_hospitalizations = self.parse_comma_int(row['Total hospitalizations'])
-                            elif 'Total hospitalizations (cumulative)' in row:
-                                total_hospitalizations = self.parse_comma_int(row['Total hospitalizations (cumulative)'])
-                            else:
-                                print(row)
-                                total_hospitalizations = 'HEY SOMETHING IS WRONG'
-
-                            print(reported_date, total_icu_admissions, total_hospitalizations)
-                            icu_dates.append({
-                                'reported_date': reported_date,
-                                'scrape_date': f['scrape_date'],
-                                'total_icu_admissions': total_icu_admissions,
-                                'total_hospitalizations': total_hospitalizations,
-                            })
-
-        print(icu_dates)
         self.add_statewide_hospitalizations_timeseries(icu_dates)
+
+    def extract(self, page, scrape_date):
+        icu_dates = []
+
+        table_data = page.div_rows('hosp')  # From the table cache if this page has been read before
+        if table_data is not None:
+            for row in table_data:
+                if scrape_date <= self.LAST_SCRAPE_DATE:
+
+                    if 'Date reported' in row:
+                        reported_date = self.parse_date(row['Date reported'])
+                    elif 'Date' in row:
+                        reported_date = self.parse_date(row['Date'])
+                    else:
+                        print(row)
+                        reported_date = 'HEY SOMETHING IS WRONG'
+
+                    # if scrape_date != reported_date:
+                    #     print(scrape_date, reported_date)
+                    #     print('DATE MISMATCH.')
+
+                    # print(row)
+                    # if 'Cases admitted to a hospital' in row:
+                    #     new_hospitalizations = self.parse_comma_int(c['Cases admitted to a hospital'])
+                    # elif 'Hospitalized, not in ICU (daily)' in row:
+                    #     new_hospitalizations = self.parse_comma_int(row['Hospitalized, not in ICU (daily)']) + self.parse_comma_int(row['Hospitalized in ICU (daily)'])
+                    # else:
+                    #     print(row)
+                    #     new_hospitalizations = 'HEY SOMETHING IS WRONG'
+
+                    if 'Total ICU hospitalizations' in row:
+                        total_icu_admissions = self.parse_comma_int(row['Total ICU hospitalizations'])
+                    elif 'Total ICU hospitalizations (cumulative)' in row:
+                        total_icu_admissions = self.parse_comma_int(row['Total ICU hospitalizations (cumulative)'])
+                    else:
+                        print(row)
+                        total_icu_admissions = 'HEY SOMETHING IS WRONG'
+
+                    if 'Total hospitalizations' in row:
+                        total_hospitalizations = self.parse_comma_int(row['Total hospitalizations'])
+                    elif 'Total hospitalizations (cumulative)' in row:
+                        total_hospitalizations = self.parse_comma_int(row['Total hospitalizations (cumulative)'])
+                    else:
+                        print(row)
+                        total_hospitalizations = 'HEY SOMETHING IS WRONG'
+
+                    print(reported_date, total_icu_admissions, total_hospitalizations)
+                    icu_dates.append({
+                        'reported_date': reported_date,
+                        'scrape_date': scrape_date,
+                        'total_icu_admissions': total_icu_admissions,
+                        'total_hospitalizations': total_hospitalizations,
+                    })
+
+        return icu_dates
+
+    def write(self, scrape_date, records):
+        self.add_statewide_hospitalizations_timeseries(records)
+
+
+class Command(BaseCommand):
+    help = 'Backfill statewide hospitalization and ICU totals from cached situation pages'
+
+    def add_arguments(self, parser):
+        add_backfill_arguments(parser)
+
+    def handle(self, *args, **options):
+        run_backfill([IcuExtractor()], **backfill_options(options))
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+
+from stats.utils import ArchiveIndex, html_archive, add_archive_arguments
+
+
+class Command(BaseCommand):
+    help = 'Add newly archived situation pages to the archive index (HTML_ARCHIVE_INDEX_PATH) that the backfills pick pages from'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bucket', default=settings.RAW_ARCHIVE_BUCKET)
+        parser.add_argument('--prefix', default=settings.RAW_ARCHIVE_PREFIX)
+        parser.add_argument('--full', action='store_true', help='Relist the whole archive, to pick up pages uploaded out of order')
+        add_archive_arguments(parser)
+
+    def handle(self, *args, **options):
+        archive = html_archive(options['bucket'], options['prefix'], options['archive_dir'], options['workers'])
+        index = ArchiveIndex()
+        print('Indexed {} newly archived pages from {}'.format(index.update(archive, full=options['full']), archive.name))
+
+        days = index.pages(archive.name)
+        if days:
+            print('{} days indexed, {} to {}'.format(len(days), days[0]['scrape_date'], days[-1]['scrape_date']))
+        index.close()
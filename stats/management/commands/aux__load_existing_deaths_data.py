@@ -4,7 +4,7 @@ import csv
 
 from django.conf import settings
 from django.core.management.base import BaseCommand
-from stats.models import County, Death
+from stats.models import County, Death, DeathCountDate
 
 
 class Command(BaseCommand):
@@ -27,6 +27,7 @@ class Command(BaseCommand):
         with open(os.path.join(settings.BASE_DIR, 'data', 'mn-covid-tracker-deaths-manual-entry.csv'), 'r') as csvfile:
             reader = csv.DictReader(csvfile)
             records = {}
+            scrape_dates = set()
             for row in reader:
                 print(row['COUNTY'])
 
@@ -38,6 +39,9 @@ class Command(BaseCommand):
                     bool_ltc=self.tf(row['LONG-TERM CARE?'])
                 )
                 death.save()
+                scrape_dates.add(death.scrape_date)
+
+        DeathCountDate.sync(scrape_dates)
 
     def handle(self, *args, **options):
         self.load_deaths_data()
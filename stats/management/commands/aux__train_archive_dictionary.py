@@ -0,0 +1,39 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from stats.utils import content_hash, html_archive, add_archive_arguments, ARCHIVE_KEY_RE
+
+
+class Command(BaseCommand):
+    help = '''Train a zstd dictionary on the most recent archived situation pages for archive_raw_payloads to compress with. Consecutive pages share nearly all their markup, so pages compressed with it come out much smaller than on their own.'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', default=settings.HTML_ARCHIVE_ZSTD_DICTIONARY, help='Where to write the dictionary (default HTML_ARCHIVE_ZSTD_DICTIONARY)')
+        parser.add_argument('--samples', type=int, default=200, help='Train on this many of the latest archived pages')
+        parser.add_argument('--size', type=int, default=256 * 1024, help='Dictionary size in bytes')
+        parser.add_argument('--bucket', default=settings.RAW_ARCHIVE_BUCKET)
+        parser.add_argument('--prefix', default=settings.RAW_ARCHIVE_PREFIX)
+        add_archive_arguments(parser)
+
+    def handle(self, *args, **options):
+        try:
+            import zstandard
+        except ImportError:
+            raise CommandError('Training a dictionary needs zstandard installed')
+        if not options['path']:
+            raise CommandError('Give a path for the dictionary or set HTML_ARCHIVE_ZSTD_DICTIONARY')
+
+        archive = html_archive(options['bucket'], options['prefix'], options['archive_dir'], options['workers'])
+        keys = [k for k in archive.list_keys() if ARCHIVE_KEY_RE.search(k)]
+
+        files = [{'key': k, 'scrape_date': k} for k in keys[-options['samples']:]]
+        samples = {}
+        for key, html in archive.prefetch(files):
+            samples.setdefault(content_hash(html), html)  # Repeats of the same page would only skew it
+        if len(samples) < 8:
+            raise CommandError('Only {} distinct pages in the archive, not enough to train on'.format(len(samples)))
+
+        dictionary = zstandard.train_dictionary(options['size'], list(samples.values()))
+        with open(options['path'], 'wb') as f:
+            f.write(dictionary.as_bytes())
+        print('Trained dictionary {} on {} pages, {} bytes, written to {}'.format(dictionary.dict_id(), len(samples), len(dictionary.as_bytes()), options['path']))
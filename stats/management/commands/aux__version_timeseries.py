@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from stats.models import StatewideCasesBySampleDate, StatewideTestsDate, StatewideHospitalizationsDate, StatewideDeathsDate
+from stats.utils import write_timeseries_versions
+
+
+class Command(BaseCommand):
+    help = 'Replay the whole-table timeseries snapshots already saved, oldest first, into valid_from/valid_to versions, so VERSIONED_TIMESERIES can be turned on without losing history. With --delete-snapshots the snapshots are removed afterwards.'
+
+    TIMESERIES = [
+        (StatewideCasesBySampleDate, 'sample_date'),
+        (StatewideTestsDate, 'reported_date'),
+        (StatewideHospitalizationsDate, 'reported_date'),
+        (StatewideDeathsDate, 'reported_date'),
+    ]
+
+    def add_arguments(self, parser):
+        parser.add_argument('--delete-snapshots', action='store_true', help='Delete the whole-table snapshot rows once they have been turned into versions')
+
+    def snapshot_versions(self, model, date_field, scrape_date):
+        ''' Unsaved copies of one day's snapshot rows, the last saved winning if a date came in twice '''
+        copy_fields = [f.attname for f in model._meta.concrete_fields if f.attname not in ['id', 'scrape_date', 'valid_from', 'valid_to', 'confirmed_update_date']]
+        rows = {}
+        for row in model.objects.filter(valid_from__isnull=True, scrape_date=scrape_date).order_by('id'):
+            rows[getattr(row, date_field)] = model(**{f: getattr(row, f) for f in copy_fields})
+        return list(rows.values())
+
+    def handle(self, *args, **options):
+        for model, date_field in self.TIMESERIES:
+            if model.objects.filter(valid_from__isnull=False).exists():
+                raise CommandError('{} already has versioned rows. Versions can only be built from snapshots before any are written.'.format(model.__name__))
+
+        for model, date_field in self.TIMESERIES:
+            snapshot_rows = model.objects.filter(valid_from__isnull=True)
+            scrape_dates = snapshot_rows.order_by('scrape_date').values_list('scrape_date', flat=True).distinct()
+            written_total = 0
+            for scrape_date in scrape_dates:
+                written, closed = write_timeseries_versions(model, self.snapshot_versions(model, date_field, scrape_date), date_field, scrape_date)
+                written_total += written
+                print('{} {}: {} new versions, {} closed'.format(model.__name__, scrape_date, written, closed))
+            print('{}: {} snapshot rows from {} scrape dates became {} versions'.format(model.__name__, snapshot_rows.count(), len(scrape_dates), written_total))
+
+            if options['delete_snapshots']:
+                deleted, _ = snapshot_rows.delete()
+                print('Deleted {} {} snapshot rows'.format(deleted, model.__name__))
@@ -1,15 +1,17 @@
 import os
 import csv
 import json
+import numpy as np
 import pandas as pd
 import datetime
 from datetime import timedelta, date
 
 from django.conf import settings
-from django.db.models import Sum, Min, Max, Avg, F, RowRange, ValueRange, Window, Case, When, Value, FloatField
+from django.db.models import Sum, Min, Max, Avg, F, Q, RowRange, ValueRange, Window, Case, When, Value, FloatField
 from django.db.models.functions import Lead
 from django.core.management.base import BaseCommand
 from stats.models import County, CountyTestDate, StatewideTotalDate
+from stats.utils import consistent_read, round_like_python, group_starts, rolling_mean_by_group, diff_by_group
 
 
 class Command(BaseCommand):
@@ -22,149 +24,78 @@ class Command(BaseCommand):
             yield date1 + timedelta(n)
 
     def dump_all_counties_timeseries(self):
+        ''' Every county on every date since the first scrape, from one query. Dates a county has no record for get 0 for daily cases, deaths and cumulative deaths, and carry its last cumulative case count forward. '''
         print('Dumping all-county timeseries...')
         start_date = CountyTestDate.objects.aggregate(Min('scrape_date'))['scrape_date__min']
         end_date = datetime.date.today()
+        if self.today_statewide_cases == 0:
+            end_date -= timedelta(days=1)  # Ignore if there's no new results for today
         dates = list(self.daterange(start_date, end_date))
 
-        # print(start_date)
-        records_by_county = []
-        for c in County.objects.all().order_by('name'):
-            records = CountyTestDate.objects.filter(county=c).values('scrape_date', 'update_date', 'county__name', 'daily_total_cases', 'cumulative_count', 'daily_deaths', 'cumulative_deaths')
-            county_running_total = 0
-            # print(records)
-            for d in dates:
-                if d == datetime.date.today() and self.today_statewide_cases == 0:
-                    pass  # Ignore if there's no new results for today
-                else:
-                    try:
-                        county_date_record = [r for r in records if r['scrape_date'] == d][0]
-                        county_running_total = county_date_record['cumulative_count']
-                    except:
-                        # print('missing date', county_running_total, d)
-                        county_date_record = {
-                            'scrape_date': d,
-                            'update_date': d,
-                            'county__name': c.name,
-                            'daily_total_cases': 0,
-                            'cumulative_count': county_running_total,
-                            'daily_deaths': 0,
-                            'cumulative_deaths': 0
-                        }
-                    records_by_county.append(county_date_record)
-
-        fieldnames = ['date', 'county', 'daily_cases', 'cumulative_cases', 'daily_deaths', 'cumulative_deaths']
-        rows = []
-        for r in records_by_county:
-            # if not r['update_date'] or r['update_date'] <= datetime.date.today():
-            row = {
-                'date': r['scrape_date'].strftime('%Y-%m-%d'),
-                'county': r['county__name'],
-                'daily_cases': r['daily_total_cases'],
-                'cumulative_cases': r['cumulative_count'],
-                'daily_deaths': r['daily_deaths'],
-                'cumulative_deaths': r['cumulative_deaths']
-            }
-            rows.append(row)
+        counties = list(County.objects.all().order_by('name').values_list('id', 'name'))
+        value_columns = ['daily_total_cases', 'cumulative_count', 'daily_deaths', 'cumulative_deaths']
+        records = pd.DataFrame.from_records(
+            CountyTestDate.objects.filter(scrape_date__gte=start_date, scrape_date__lte=end_date).order_by('pk').values_list('county_id', 'scrape_date', *value_columns),
+            columns=['county_id', 'scrape_date'] + value_columns,
+        ).astype({c: 'Int64' for c in value_columns})
+        records['found'] = True
+        records = records.drop_duplicates(['county_id', 'scrape_date'])  # First record for a county and date wins
+
+        grid = records.set_index(['county_id', 'scrape_date']).reindex(pd.MultiIndex.from_product([[c[0] for c in counties], dates]))
+        found = grid['found'].notna().to_numpy()
+
+        def values(series):
+            return series.to_numpy(dtype=object, na_value=None)  # Plain Python values with None for blanks, for the csv module
+
+        rows = pd.DataFrame({
+            'date': [d.strftime('%Y-%m-%d') for d in dates] * len(counties),
+            'county': np.repeat([c[1] for c in counties], len(dates)),
+            'daily_cases': values(grid['daily_total_cases'].where(found, 0)),
+            'cumulative_cases': values(grid['cumulative_count'].groupby(level=0).ffill().fillna(0)),
+            'daily_deaths': values(grid['daily_deaths'].where(found, 0)),
+            'cumulative_deaths': values(grid['cumulative_deaths'].where(found, 0)),
+        })
 
         with open(os.path.join(settings.BASE_DIR, 'exports', 'mn_covid_data', 'mn_county_timeseries_all_counties.csv'), 'w') as csvfile:
 
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            writer.writeheader()
-            writer.writerows(rows)
+            writer = csv.writer(csvfile)
+            writer.writerow(rows.columns)
+            writer.writerows(rows.itertuples(index=False))
 
     def dump_tall_timeseries(self):
         print('Dumping tall county timeseries...')
 #         fieldnames = ['date', 'county', 'fips', 'daily_cases', 'daily_cases_per_1k', 'cumulative_cases', 'cases_per_1k', 'daily_deaths', 'cumulative_deaths', 'deaths_per_1k', 'cases_rolling',
 # 'deaths_rolling', 'cases_weekly_chg', 'cases_weekly_per_1k', 'cases_weekly_pct_chg',]
         # 'pct_chg', 'pct_chg_7day',
-        rows = []
-
-        # TODO: county by county
-        for county in County.objects.all():
-            for c in CountyTestDate.objects.filter(county=county
-            # ).annotate(
-            #     cases_rolling=Window(
-            #         expression=Avg('daily_total_cases'),
-            #         order_by=F('scrape_date').asc(),
-            #         frame=RowRange(start=-6,end=0)
-            #     )
-            # ).annotate(
-            #     deaths_rolling=Window(
-            #         expression=Avg('daily_deaths'),
-            #         order_by=F('scrape_date').asc(),
-            #         frame=RowRange(start=-6,end=0)
-            #     )
-            # ).annotate(
-            #     cases_total_weekago=Window(
-            #         expression=Lead('cumulative_count', offset=7, default=0),
-            #         order_by=F('scrape_date').desc()
-            #     )
-            # ).annotate(
-                # cases_weekly_pct_chg=Case(
-                #     When(cases_total_weekago__gt=0, then=(F('cumulative_count') - F('cases_total_weekago') * 1.0) / F('cases_total_weekago')),
-                #     default=Value(0),
-                #     output_field=FloatField()
-                # )
-            ).values(
-                'scrape_date',
-                'update_date',
-                'county__name',
-                'county__fips',
-                'daily_total_cases',
-                'cumulative_count',
-                'daily_deaths',
-                'cumulative_deaths',
-                # 'cases_rolling',
-                # 'deaths_rolling',
-                # 'pct_chg',
-                # 'pct_chg_7day',
-                # 'cases_total_weekago',
-                # 'cases_weekly_pct_chg',
-            ).order_by('scrape_date', 'county__name'):
-                # print(c['update_date'], datetime.date.today(), c['update_date'] == datetime.date.today())
-                # if not c['update_date'] or c['update_date'] <= datetime.date.today():
-                if c['scrape_date'] < datetime.date.today() or c['update_date'] == datetime.date.today():
-                #     pass  # Ignore if there's no new results for today
-                # else:
-                #     # print(c.scrape_date, c.county.name, c.cumulative_count)
-                    # print(c['county__name'], c['daily_total_cases'], c['pct_chg'], c['pct_chg_7day'])
-                    # cases_weekly_change = c['cumulative_count'] - c['cases_total_weekago']
-                    #
-                    # if c['cumulative_count'] < 100:
-                    #     cases_weekly_pct_chg = None
-                    # else:
-                    #     cases_weekly_pct_chg = round(c['cases_weekly_pct_chg'], 3)
-
-                    row = {
-                        'date': c['scrape_date'].strftime('%Y-%m-%d'),
-                        'county': c['county__name'],
-                        'fips': c['county__fips'],
-                        'pop_2019': county.pop_2019,
-                        'daily_cases': c['daily_total_cases'],
-                        'daily_cases_per_1k': round(c['daily_total_cases'] / (county.pop_2019 / 1000), 1),
-                        'cumulative_cases': c['cumulative_count'],
-                        'cases_per_1k': round(c['cumulative_count'] / (county.pop_2019 / 1000), 1),
-                        'daily_deaths': c['daily_deaths'],
-                        'cumulative_deaths': c['cumulative_deaths'],
-                        'deaths_per_1k': round(c['cumulative_deaths'] / (county.pop_2019 / 1000), 1),
-                        # 'cases_rolling': round(c['cases_rolling'], 1),
-                        # 'deaths_rolling': round(c['deaths_rolling'], 2),
-                        # 'cases_weekly_chg': cases_weekly_change,
-                        # 'cases_weekly_per_1k': round(cases_weekly_change / (county.pop_2019 / 1000), 1),
-                        # 'cases_weekly_pct_chg': cases_weekly_pct_chg,
-                    }
-                    rows.append(row)
-
-        # Run through pandas to calculate diffs and rolling averages.
-        ts_df = pd.DataFrame(rows)
-        ts_df['cases_rolling'] = ts_df.groupby('county')['daily_cases'].transform(lambda x: x.rolling(window=7, min_periods=1).mean().round(1))
-        ts_df['deaths_rolling'] = ts_df.groupby('county')['daily_deaths'].transform(lambda x: x.rolling(window=7, min_periods=1).mean().round(2))
-        ts_df['cases_weekly_chg'] = ts_df.groupby('county')['cumulative_cases'].transform(lambda x: x.diff(periods=7))
-        ts_df['deaths_weekly_chg'] = ts_df.groupby('county')['cumulative_deaths'].transform(lambda x: x.diff(periods=7))
-        ts_df['cases_weekly_per_1k'] =  round(ts_df['cases_weekly_chg'] / (ts_df['pop_2019'] / 1000), 1)
-
-        ts_df.drop(columns=['pop_2019'], inplace=True)
+        today = datetime.date.today()
+        columns = ['scrape_date', 'county', 'fips', 'pop_2019', 'daily_total_cases', 'cumulative_count', 'daily_deaths', 'cumulative_deaths']
+        records = pd.DataFrame.from_records(CountyTestDate.objects.filter(
+            Q(scrape_date__lt=today) | Q(update_date=today)  # Ignore today if there's no new results for today
+        ).order_by('county_id', 'scrape_date').values_list(
+            'scrape_date', 'county__name', 'county__fips', 'county__pop_2019', 'daily_total_cases', 'cumulative_count', 'daily_deaths', 'cumulative_deaths'
+        ), columns=columns)
+
+        pop_1k = records['pop_2019'] / 1000
+        ts_df = pd.DataFrame({
+            'date': [d.strftime('%Y-%m-%d') for d in records['scrape_date']],
+            'county': records['county'],
+            'fips': records['fips'],
+            'daily_cases': records['daily_total_cases'],
+            'daily_cases_per_1k': round_like_python(records['daily_total_cases'] / pop_1k, 1),
+            'cumulative_cases': records['cumulative_count'],
+            'cases_per_1k': round_like_python(records['cumulative_count'] / pop_1k, 1),
+            'daily_deaths': records['daily_deaths'],
+            'cumulative_deaths': records['cumulative_deaths'],
+            'deaths_per_1k': round_like_python(records['cumulative_deaths'] / pop_1k, 1),
+        })
+
+        # Rolling averages and weekly changes within each county, whose rows are together and in date order
+        starts = group_starts(records['county'])
+        ts_df['cases_rolling'] = np.round(rolling_mean_by_group(ts_df['daily_cases'], starts, 7), 1)
+        ts_df['deaths_rolling'] = np.round(rolling_mean_by_group(ts_df['daily_deaths'], starts, 7), 2)
+        ts_df['cases_weekly_chg'] = diff_by_group(ts_df['cumulative_cases'], starts, 7)
+        ts_df['deaths_weekly_chg'] = diff_by_group(ts_df['cumulative_deaths'], starts, 7)
+        ts_df['cases_weekly_per_1k'] = np.round(ts_df['cases_weekly_chg'] / pop_1k, 1)
 
 
         # ts_df['daily_pct_positive_rolling'] = ts_df['daily_pct_positive'].rolling(window=7, min_periods=1).mean().round(3)
@@ -207,6 +138,7 @@ class Command(BaseCommand):
         # with open(os.path.join(settings.BASE_DIR, 'exports', 'mn_county_timeseries.json'), 'w') as jsonfile:
         #     jsonfile.write(json.dumps(skinny_rows))
 
+    @consistent_read()
     def handle(self, *args, **options):
         today_statewide = StatewideTotalDate.objects.filter(scrape_date=datetime.date.today())
         previous_statewide = StatewideTotalDate.objects.all().values('scrape_date', 'cumulative_positive_tests').order_by('-scrape_date')[1]
@@ -9,6 +9,7 @@ from django.conf import settings
 from django.db.models import Max, Count, Sum
 from django.core.management.base import BaseCommand
 from stats.models import County, AgeGroupPop, CountyTestDate, StatewideAgeDate, StatewideTotalDate, StatewideDeathsDate, Death
+from stats.utils import timeseries_as_of, consistent_read
 
 
 class Command(BaseCommand):
@@ -70,7 +71,7 @@ class Command(BaseCommand):
             writer.writeheader()
 
             latest = StatewideTotalDate.objects.all().order_by('-scrape_date').first()
-            latest_deaths = StatewideDeathsDate.objects.filter(scrape_date=latest.scrape_date).order_by('-reported_date').first()
+            latest_deaths = timeseries_as_of(StatewideDeathsDate, latest.scrape_date).order_by('-reported_date').first()
             writer.writerow({
                 'total_confirmed_cases': latest.cumulative_positive_tests,
                 'cases_daily_change': latest.cases_daily_change,
@@ -206,6 +207,7 @@ class Command(BaseCommand):
     #         with open(os.path.join(settings.BASE_DIR, 'exports', 'mn_death_ages_detailed_latest.json'), 'w') as jsonfile:
     #             jsonfile.write(json.dumps(rows))
 
+    @consistent_read()
     def handle(self, *args, **options):
         self.dump_county_latest()
         self.dump_state_latest()
@@ -1,6 +1,7 @@
 import os
 import csv
 import datetime
+import numpy as np
 import pandas as pd
 from datetime import timedelta
 
@@ -8,161 +9,129 @@ from django.conf import settings
 from django.db.models import Min, Max
 from django.core.management.base import BaseCommand
 from stats.models import StatewideTotalDate, StatewideCasesBySampleDate, StatewideTestsDate, StatewideDeathsDate, StatewideHospitalizationsDate
+from stats.utils import timeseries_as_of, consistent_read, round_like_python
 
 
 class Command(BaseCommand):
     help = 'Calculate change per day to export cumulative and daily counts'
 
+    TOPLINE_FIELDS = [
+        'cumulative_positive_tests', 'cases_daily_change', 'cases_newly_reported', 'removed_cases', 'cumulative_completed_tests',
+        'hospitalized_total_daily_change', 'icu_total_daily_change', 'cumulative_hospitalized', 'cumulative_icu', 'currently_hospitalized', 'currently_in_icu',
+        'cumulative_statewide_deaths', 'cumulative_statewide_recoveries',
+    ]
+    OLD_TESTS_CUTOFF = datetime.date(2020, 3, 28)  # Test counts on and before this date aren't usable
+
+    def timeseries_frame(self, queryset, date_field, int_fields, other_fields=[]):
+        ''' One table's rows as a frame indexed by date, the last one winning if a date comes up twice. Counts are nullable ints so blanks stay blank. '''
+        fields = int_fields + other_fields
+        frame = pd.DataFrame.from_records(list(queryset.values_list(date_field, *fields)), columns=['date'] + fields)
+        frame = frame[frame['date'].notna()].drop_duplicates('date', keep='last').set_index('date')
+        for f in int_fields:
+            frame[f] = frame[f].astype('Int64')
+        return frame
+
+    def as_row_column(self, column):
+        ''' The dtype pd.DataFrame(rows) gave a column when the rows were built as dicts: whole numbers with a blank anywhere become floats, all blanks stay None '''
+        if column.isna().all():
+            return pd.Series([None] * len(column), index=column.index, dtype=object)
+        if isinstance(column.dtype, pd.Int64Dtype):
+            if column.isna().any():
+                return pd.Series(column.to_numpy(dtype='float64', na_value=np.nan), index=column.index)
+            return column.astype('int64')
+        return column
+
+    @consistent_read()
     def handle(self, *args, **options):
-        print("Gathering cases by sample date ...")
-        # Cases: Get max scrape date for each sample date
-        cases_timeseries_values = {}
-        max_date = StatewideCasesBySampleDate.objects.aggregate(Max('scrape_date'))['scrape_date__max']
-        cases_by_sample_date = StatewideCasesBySampleDate.objects.filter(scrape_date=max_date).values().order_by('sample_date')
-        for sd in cases_by_sample_date:
-            cases_timeseries_values[sd['sample_date']] = sd
+        today = datetime.date.today()
 
+        print("Gathering cases by sample date ...")
+        cases = self.timeseries_frame(timeseries_as_of(StatewideCasesBySampleDate).order_by('sample_date'), 'sample_date', ['new_cases', 'total_cases'])
 
         print("Gathering tests ...")
-        # Tests: Get max scrape date for each real date
-        tests_timeseries_values = {}
-        max_date = StatewideTestsDate.objects.aggregate(Max('scrape_date'))['scrape_date__max']
-        tests_by_reported_date = StatewideTestsDate.objects.filter(scrape_date=max_date).values().order_by('reported_date')
-        for sd in tests_by_reported_date:
-            tests_timeseries_values[sd['reported_date']] = sd
+        tests = self.timeseries_frame(timeseries_as_of(StatewideTestsDate).order_by('reported_date'), 'reported_date', ['new_tests', 'total_tests'])
 
         print("Gathering new hospitalizations ...")
-        # Hospitalizations: Get max scrape date for each real date
-        hosp_timeseries_values = {}
-        max_date = StatewideHospitalizationsDate.objects.aggregate(Max('scrape_date'))['scrape_date__max']
-        hosp_by_reported_date = StatewideHospitalizationsDate.objects.filter(scrape_date=max_date).values().order_by('reported_date')
-        for sd in hosp_by_reported_date:
-            hosp_timeseries_values[sd['reported_date']] = sd
+        hosp = self.timeseries_frame(timeseries_as_of(StatewideHospitalizationsDate).order_by('reported_date'), 'reported_date', ['new_hosp_admissions', 'new_icu_admissions'])
 
         print("Gathering deaths ...")
-        # Deaths: Get max scrape date for each real date
-        deaths_timeseries_values = {}
-        max_date = StatewideDeathsDate.objects.aggregate(Max('scrape_date'))['scrape_date__max']
-        deaths_by_reported_date = StatewideDeathsDate.objects.filter(scrape_date=max_date).values().order_by('reported_date')
-        for sd in deaths_by_reported_date:
-            deaths_timeseries_values[sd['reported_date']] = sd
+        deaths = self.timeseries_frame(timeseries_as_of(StatewideDeathsDate).order_by('reported_date'), 'reported_date', ['new_deaths'])
 
         print("Gathering topline totals ...")
-        # Topline records: get all by date
-        topline_timeseries_values = {}
-        topline_data = StatewideTotalDate.objects.all().values()
-
-        for s in topline_data:
-            topline_timeseries_values[s['scrape_date']] = s
+        topline = self.timeseries_frame(StatewideTotalDate.objects.all(), 'scrape_date', self.TOPLINE_FIELDS, ['update_date'])
 
         min_date = StatewideCasesBySampleDate.objects.all().aggregate(min_date=Min('sample_date'))['min_date']
         max_date = StatewideTotalDate.objects.filter(cumulative_positive_tests__gt=0).aggregate(max_date=Max('scrape_date'))['max_date']
-        current_date = min_date
-
-        total_cases_sample_date = 0
-        previous_total_deaths = 0
-        previous_total_tests = 0
-
-        total_hospitalizations = 0
-        total_icu_admissions = 0
-        rows = []
-        # Go through all dates and check for either timeseries or, failing that, topline data
-        while current_date <= max_date:
-
-            # print(current_date)
-            topline_data = topline_timeseries_values[current_date]
-            # print(current_date, topline_data['update_date'])
-            if current_date < datetime.date.today() or topline_data['update_date'] == datetime.date.today():
-                # Don't output today if an update hasn't run yet today
-                if current_date in deaths_timeseries_values:
-                    death_data = deaths_timeseries_values[current_date]
-                    if not death_data['new_deaths']:
-                        new_deaths = 0  # Translate nulls, which come on "no report" dates like holidays, to a 0 for output/rolling avg purposes
-                    else:
-                        new_deaths = death_data['new_deaths']
-                else:
-                    new_deaths = 0
-
-                previous_total_deaths = topline_data['cumulative_statewide_deaths']
-
-                if current_date in cases_timeseries_values:
-                    cr = cases_timeseries_values[current_date]
-                    new_cases_sample_date = cr['new_cases']
-                    total_cases_sample_date = cr['total_cases']
-                else:
-                    # This will usually just be today's values because no samples have come back yet
-                    new_cases_sample_date = 0
-
-                if current_date in hosp_timeseries_values:
-                    # print('timeseries')
-                    cr = hosp_timeseries_values[current_date]
-                    new_hosp_admissions = cr['new_hosp_admissions']
-                    new_icu_admissions = cr['new_icu_admissions']
-
-                else:
-                    # This will usually just be today's values because no samples have come back yet
-                    new_hosp_admissions = 0
-                    new_icu_admissions = 0
-
-                total_cases = topline_data['cumulative_positive_tests']
-
-                if current_date <= datetime.date(2020, 3, 28):  # Temp conditional for old test dates
-                    new_tests = 0
-                    total_tests = 0
-                    daily_pct_positive = None
-                else:
-                    if current_date - timedelta(days=1) in tests_timeseries_values:
-                        tr = tests_timeseries_values[current_date - timedelta(days=1)]
-                        new_tests = tr['new_tests']
-                        total_tests = tr['total_tests']
-                        # print('using shifted mdh timeseries')
-                    elif current_date in topline_timeseries_values:
-                        tr = topline_timeseries_values[current_date]
-
-                        new_tests = tr['cumulative_completed_tests'] - previous_total_tests
-                        # new_tests_rolling = None
-                        total_tests = tr['cumulative_completed_tests']
-
-                    else:
-                        new_tests = 0
-                        total_tests = previous_total_tests
-
-                    if new_tests > 0 and topline_data['cases_daily_change'] is not None:  # Test for null on cases_daily_change e.g. July 4
-                        daily_pct_positive = round((topline_data['cases_daily_change']*1.0) / new_tests, 3)
-                    else:
-                        daily_pct_positive = None
-
-                previous_total_tests = total_tests
-
-                row = {
-                    'date': current_date.strftime('%Y-%m-%d'),
-                    'total_confirmed_cases': topline_data['cumulative_positive_tests'],
-                    'cases_daily_change': topline_data['cases_daily_change'],
-                    'cases_newly_reported': topline_data['cases_newly_reported'],
-                    'cases_removed': topline_data['removed_cases'],
-                    'cases_sample_date': new_cases_sample_date,
-                    'cases_total_sample_date': total_cases_sample_date,
-                    'new_hosp_admissions': new_hosp_admissions,
-                    'new_icu_admissions': new_icu_admissions,
-                    'hosp_total_daily_change': topline_data['hospitalized_total_daily_change'],
-                    'icu_total_daily_change': topline_data['icu_total_daily_change'],
-                    'total_hospitalized': topline_data['cumulative_hospitalized'],
-                    'total_icu_admissions': topline_data['cumulative_icu'],
-                    'currently_hospitalized': topline_data['currently_hospitalized'],
-                    'currently_in_icu': topline_data['currently_in_icu'],
-                    'total_statewide_deaths': topline_data['cumulative_statewide_deaths'],
-                    'new_statewide_deaths': new_deaths,
-                    'total_statewide_recoveries': topline_data['cumulative_statewide_recoveries'],
-                    'total_completed_tests': None if current_date <= datetime.date(2020, 3, 28) else total_tests,
-                    'new_completed_tests': None if current_date <= datetime.date(2020, 3, 28) else new_tests,
-                    'daily_pct_positive': daily_pct_positive,
-                }
-                rows.append(row)
-
-            current_date += timedelta(days=1)
-
-        # Run through pandas to calculate rolling averages.
-        ts_df = pd.DataFrame(rows)
+
+        # Every date needs a topline record, so this is a KeyError if one is missing
+        dates = pd.Index([min_date + timedelta(days=n) for n in range((max_date - min_date).days + 1)])
+        days = topline.loc[dates]
+
+        # Don't output today if an update hasn't run yet today
+        output_dates = (dates < today) | (days['update_date'] == today).to_numpy()
+        dates = dates[output_dates]
+        days = days[output_dates].reset_index(drop=True)
+
+        def on_dates(frame, field, dates):
+            return frame[field].reindex(dates).reset_index(drop=True)
+
+        # Nulls, which come on "no report" dates like holidays, become 0 for output/rolling avg purposes, as do dates with no row
+        new_deaths = on_dates(deaths, 'new_deaths', dates).fillna(0)
+
+        # Dates with no sample date row (usually just the latest, because no samples have come back yet) have no new cases and keep the last total
+        has_cases = dates.isin(cases.index)
+        new_cases_sample_date = on_dates(cases, 'new_cases', dates).where(has_cases, 0)
+        last_cases_row = np.maximum.accumulate(np.where(has_cases, np.arange(len(dates)), -1))
+        total_cases_sample_date = pd.Series(on_dates(cases, 'total_cases', dates).array.take(last_cases_row, allow_fill=True))
+        total_cases_sample_date[last_cases_row < 0] = 0
+
+        has_hosp = dates.isin(hosp.index)
+        new_hosp_admissions = on_dates(hosp, 'new_hosp_admissions', dates).where(has_hosp, 0)
+        new_icu_admissions = on_dates(hosp, 'new_icu_admissions', dates).where(has_hosp, 0)
+
+        # Tests are shifted a day. Dates with no row fall back to the topline total, with new tests counted against the day before's total.
+        old_tests = dates <= self.OLD_TESTS_CUTOFF
+        tests_dates = pd.Index([d - timedelta(days=1) for d in dates])
+        has_tests = tests_dates.isin(tests.index)
+        total_tests = on_dates(tests, 'total_tests', tests_dates).where(has_tests, days['cumulative_completed_tests']).mask(old_tests, 0)
+        previous_total_tests = total_tests.shift(1, fill_value=0)
+        new_tests = on_dates(tests, 'new_tests', tests_dates).where(has_tests, days['cumulative_completed_tests'] - previous_total_tests).mask(old_tests, 0)
+
+        # Test for null on cases_daily_change e.g. July 4
+        pct_positive_dates = (new_tests > 0).to_numpy(dtype=bool, na_value=False) & days['cases_daily_change'].notna().to_numpy() & ~old_tests
+        daily_pct_positive = pd.Series(np.where(
+            pct_positive_dates,
+            round_like_python(days['cases_daily_change'].to_numpy(dtype='float64', na_value=np.nan) / new_tests.to_numpy(dtype='float64', na_value=np.nan), 3),
+            np.nan,
+        ))
+
+        ts_df = pd.DataFrame({
+            'date': [d.strftime('%Y-%m-%d') for d in dates],
+            'total_confirmed_cases': days['cumulative_positive_tests'],
+            'cases_daily_change': days['cases_daily_change'],
+            'cases_newly_reported': days['cases_newly_reported'],
+            'cases_removed': days['removed_cases'],
+            'cases_sample_date': new_cases_sample_date,
+            'cases_total_sample_date': total_cases_sample_date,
+            'new_hosp_admissions': new_hosp_admissions,
+            'new_icu_admissions': new_icu_admissions,
+            'hosp_total_daily_change': days['hospitalized_total_daily_change'],
+            'icu_total_daily_change': days['icu_total_daily_change'],
+            'total_hospitalized': days['cumulative_hospitalized'],
+            'total_icu_admissions': days['cumulative_icu'],
+            'currently_hospitalized': days['currently_hospitalized'],
+            'currently_in_icu': days['currently_in_icu'],
+            'total_statewide_deaths': days['cumulative_statewide_deaths'],
+            'new_statewide_deaths': new_deaths,
+            'total_statewide_recoveries': days['cumulative_statewide_recoveries'],
+            'total_completed_tests': total_tests.mask(old_tests),
+            'new_completed_tests': new_tests.mask(old_tests),
+            'daily_pct_positive': daily_pct_positive,
+        })
+        for column in ts_df.columns:
+            ts_df[column] = self.as_row_column(ts_df[column])
+
+        # Rolling averages
         ts_df['daily_pct_positive_rolling'] = ts_df['daily_pct_positive'].rolling(window=7, min_periods=1).mean().round(3)
         ts_df['cases_daily_change_rolling'] = ts_df['cases_daily_change'].rolling(window=7, min_periods=1).mean().round(1)
         ts_df['cases_sample_date_rolling'] = ts_df['cases_sample_date'].rolling(window=7, min_periods=1).mean().round(1)
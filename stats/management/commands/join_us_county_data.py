@@ -1,6 +1,8 @@
 import os
+import io
 import csv
-import geojson
+import glob
+import shutil
 import requests
 import pandas as pd
 import numpy as np
@@ -10,12 +12,15 @@ from datetime import datetime, timedelta
 from django.conf import settings
 from django.core.management.base import BaseCommand
 
+from stats.utils import write_points_geojson
+
 
 class Command(BaseCommand):
     help = 'Grab the latest NYT timeseries data (https://github.com/nytimes/covid-19-data/blob/master/us-counties.csv) and join it to get centroids of counties (with some extra cities)'
 
     NYT_COUNTY_TIMESERIES_URL = 'https://raw.githubusercontent.com/nytimes/covid-19-data/master/us-counties.csv'
     NYT_COUNTY_TIMESERIES_LOCAL = os.path.join(settings.BASE_DIR, 'data', 'nyt-us-counties.csv')
+    NYT_COUNTY_STORE_DIR = os.path.join(settings.BASE_DIR, 'data', 'nyt-us-counties')  # Joined rows, one Parquet file per date, plus each county's latest rows
     COUNTY_CENTROIDS_PATH = os.path.join(settings.BASE_DIR, 'data', 'us_county_centroids_tl_2019_4326.csv')
     POP_ESTIMATES_PATH = os.path.join(settings.BASE_DIR, 'data', 'county_pops_2019.csv')
 
@@ -45,34 +50,131 @@ class Command(BaseCommand):
         }
     ]
 
-    def download_nyt_data(self):
-        print('Downloading NYT timeseries csv...')
+    LATEST_JSON_PROPERTIES = ['fips', 'state', 'county', 'cases', 'deaths', 'pop_2019', 'cases_p_100k', 'deaths_p_100k', 'date']
 
-        r = requests.get(self.NYT_COUNTY_TIMESERIES_URL)
+    NYT_DTYPES = {'fips': object, 'state': 'category', 'county': 'category', 'cases': 'Int32', 'deaths': 'Int32'}
+    CHANGE_LAGS = {'daily': 1, 'weekly': 7}  # Days back each change column compares to
+    CHANGE_COLUMNS = ['{}_{}'.format(col, name) for name in CHANGE_LAGS for col in ['cases', 'deaths']]
+    STORE_VERSION = 2  # Bump when the stored columns change, so the next run rebuilds the store
+    STORE_COLUMNS = ['state_fips', 'fips', 'state', 'county', 'cases', 'deaths', 'pop_2019', 'cases_p_100k', 'deaths_p_100k', 'latitude', 'longitude'] + CHANGE_COLUMNS + ['cases_weekly_per10k', 'deaths_weekly_per10k']
+    STORE_DTYPES = dict({'state_fips': 'category', 'fips': 'category', 'state': 'category', 'county': 'category', 'cases': 'Int32', 'deaths': 'Int32'}, **{col: 'Int32' for col in CHANGE_COLUMNS})
 
-        with open(self.NYT_COUNTY_TIMESERIES_LOCAL, 'wb') as f:
-            f.write(r.content)
-            return self.NYT_COUNTY_TIMESERIES_LOCAL
-        return False
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true', help='Rebuild the local store from the whole NYT file, to pick up NYT revisions to past dates')
 
-    def df_to_geojson(self, df):
-        features = []
-        insert_features = lambda x: features.append(
-            geojson.Feature(geometry=geojson.Point((x["longitude"],
-                                                    x["latitude"])),
-                            properties={k: v for k, v in x.items() if k not in ['longtitude', 'latitude']}
-                        ))
-        df.dropna().apply(insert_features, axis=1)
+    def store_version(self):
+        try:
+            with open(os.path.join(self.NYT_COUNTY_STORE_DIR, 'version')) as f:
+                return int(f.read())
+        except FileNotFoundError:
+            return None
+
+    def stored_dates(self):
+        return sorted(os.path.basename(p)[len('date='):] for p in glob.glob(os.path.join(self.NYT_COUNTY_STORE_DIR, 'date=*')))
+
+    def download_nyt_data(self, after_date=None):
+        ''' Stream the NYT file to NYT_COUNTY_TIMESERIES_LOCAL, keeping only the rows dated after after_date in memory. The file is in date order, so those are the last lines. Returns them as a typed DataFrame, or None if the download failed. '''
+        print('Downloading NYT timeseries csv...')
 
-        with open(self.LATEST_JSON_EXPORT_PATH, 'w', encoding='utf8') as fp:
-            geojson.dump(geojson.FeatureCollection(features), fp, sort_keys=True, ensure_ascii=False)
+        r = requests.get(self.NYT_COUNTY_TIMESERIES_URL, stream=True)
+        if r.status_code != requests.codes.ok:
+            return None
+
+        after_date = after_date.encode('utf-8') if after_date else b''
+        header = None
+        new_lines = []
+        with open(self.NYT_COUNTY_TIMESERIES_LOCAL + '.tmp', 'wb') as f:
+            for line in r.iter_lines(chunk_size=1024 * 1024):
+                f.write(line + b'\n')
+                if header is None:
+                    header = line
+                elif line[:10] > after_date:
+                    new_lines.append(line)
+        os.replace(self.NYT_COUNTY_TIMESERIES_LOCAL + '.tmp', self.NYT_COUNTY_TIMESERIES_LOCAL)
+
+        return pd.read_csv(io.BytesIO(b'\n'.join([header] + new_lines)), dtype=self.NYT_DTYPES)
+
+    def write_store(self, df):
+        ''' One file per date, each written whole before it's renamed into place '''
+        for date, date_df in df.groupby('date', sort=True):
+            partition = os.path.join(self.NYT_COUNTY_STORE_DIR, 'date={}'.format(date))
+            os.makedirs(partition + '.tmp', exist_ok=True)
+            date_df[self.STORE_COLUMNS].astype(self.STORE_DTYPES).to_parquet(os.path.join(partition + '.tmp', 'part.parquet'), index=False)
+            os.replace(partition + '.tmp', partition)
+
+    def read_store(self, since=None):
+        dfs = []
+        for date in self.stored_dates():
+            if since and date < since:
+                continue
+            date_df = pd.read_parquet(os.path.join(self.NYT_COUNTY_STORE_DIR, 'date={}'.format(date), 'part.parquet'))
+            date_df['date'] = date
+            dfs.append(date_df)
+        return pd.concat(dfs, ignore_index=True) if dfs else None
+
+    def sort_by_county(self, df):
+        ''' Sort by county_key and date, and number the counties in that order. fips is the key, or state and name for the places NYT has no fips for (like "Unknown"), so same-named counties in different states stay apart. '''
+        county_key = df['fips'].astype(object).where(df['fips'].notna(), df['state'].astype(str) + '|' + df['county'].astype(str))
+        df = df.assign(county_key=county_key).sort_values(['county_key', 'date'], kind='mergesort').reset_index(drop=True)
+        county_codes = pd.factorize(df['county_key'])[0].astype('int64')  # Increasing, since the keys are sorted
+        return df.drop(columns='county_key'), county_codes
+
+    def add_changes(self, df):
+        ''' cases and deaths minus the same county's from 1 and 7 days before, or NA if it has no row that day. Rows are matched by searching the sorted (county, day) array, so gaps in a county's dates don't shift anything. '''
+        df, county_codes = self.sort_by_county(df)
+        days = pd.to_datetime(df['date']).values.astype('datetime64[D]').astype('int64')
+        county_days = county_codes * 100000 + days
+
+        for name, lag in self.CHANGE_LAGS.items():
+            before = np.minimum(np.searchsorted(county_days, county_days - lag), len(df) - 1)
+            found = county_days[before] == county_days - lag
+            for col in ['cases', 'deaths']:
+                values = df[col].to_numpy(dtype='float64', na_value=np.nan)
+                df['{}_{}'.format(col, name)] = pd.Series(np.where(found, values - values[before], np.nan)).astype('Int32')
+
+        df['cases_weekly_per10k'] = round(df['cases_weekly'].astype('float64') / (df['pop_2019'] / 10000), 2)
+        df['deaths_weekly_per10k'] = round(df['deaths_weekly'].astype('float64') / (df['pop_2019'] / 10000), 2)
+        return df
+
+    def latest_rows(self, df):
+        ''' Each county's row from its most recent date: the last row of each county once sorted, found in one pass '''
+        df, county_codes = self.sort_by_county(df)
+        bool_last = np.append(county_codes[1:] != county_codes[:-1], True)
+        return df[bool_last].reset_index(drop=True)
+
+    def update_latest(self, new_df):
+        ''' Each county's latest row, carried over from the last run and updated with the new rows, so the whole history never has to be reread '''
+        latest_path = os.path.join(self.NYT_COUNTY_STORE_DIR, 'latest.parquet')
+        if os.path.exists(latest_path):
+            previous_df = pd.read_parquet(latest_path)
+        else:
+            previous_df = self.read_store()  # Includes new_df, which was just stored
+            new_df = new_df.iloc[0:0]
+
+        df = pd.concat([previous_df, new_df[self.STORE_COLUMNS + ['date']]], ignore_index=True).astype(self.STORE_DTYPES)
+        latest_df = self.latest_rows(df)
+
+        latest_df.to_parquet(latest_path + '.tmp', index=False)
+        os.replace(latest_path + '.tmp', latest_path)
+        return latest_df
+
+    def df_to_geojson(self, df):
+        write_points_geojson(df.dropna(), self.LATEST_JSON_EXPORT_PATH, properties=self.LATEST_JSON_PROPERTIES, precision=4, compact=True)
 
     def handle(self, *args, **options):
 
-        nyt_csv = self.download_nyt_data()
-        if nyt_csv:
+        if (options['full'] or self.store_version() != self.STORE_VERSION) and os.path.exists(self.NYT_COUNTY_STORE_DIR):
+            shutil.rmtree(self.NYT_COUNTY_STORE_DIR)
+        os.makedirs(self.NYT_COUNTY_STORE_DIR, exist_ok=True)
+        with open(os.path.join(self.NYT_COUNTY_STORE_DIR, 'version'), 'w') as f:
+            f.write(str(self.STORE_VERSION))
+        stored_dates = self.stored_dates()
+
+        nyt_timeseries_df = self.download_nyt_data(stored_dates[-1] if stored_dates else None)
+        if nyt_timeseries_df is not None:
+            print('{} new rows after {}'.format(len(nyt_timeseries_df), stored_dates[-1] if stored_dates else 'nothing stored'))
 
-            nyt_timeseries_df = pd.read_csv(self.NYT_COUNTY_TIMESERIES_LOCAL, dtype={'fips': object})
+            # Only the new rows need joining. Everything older is already joined in the store.
 
             county_centroids_df = pd.read_csv(self.COUNTY_CENTROIDS_PATH, dtype={'STATEFP': object, 'COUNTYFP': object})
             county_centroids_df['full_fips'] = county_centroids_df['STATEFP'] + county_centroids_df['COUNTYFP']
@@ -147,23 +249,20 @@ class Command(BaseCommand):
             # print('Exporting national timeseries...')
             # df_subset.to_csv(self.TIMESERIES_EXPORT_PATH, index=False)
 
-            # Get diff data
-            df_subset['cases_weekly'] = df_subset['cases'].diff(periods=-7)
-            df_subset['deaths_weekly'] = df_subset['deaths'].diff(periods=-7)
+            # Get diff data. The week before the new dates comes from the store.
+            if len(df_subset):
+                since = (pd.to_datetime(df_subset['date'].min()) - timedelta(days=max(self.CHANGE_LAGS.values()))).strftime('%Y-%m-%d')
+                history_df = self.read_store(since)
+                df_changes = self.add_changes(pd.concat([history_df, df_subset], ignore_index=True) if history_df is not None else df_subset)
+                df_subset = df_changes[df_changes['date'].isin(df_subset['date'].unique())]
+            else:
+                df_subset = df_subset.reindex(columns=['date'] + self.STORE_COLUMNS)
 
-            # 2019 annual esimate: https://www.census.gov/newsroom/press-kits/2019/national-state-estimates.html
-            us_pop = 328239523
-            df_subset['cases_weekly_per10k'] = round(df_subset['cases_weekly'] / (us_pop / 10000), 2)
-            df_subset['deaths_weekly_per10k'] = round(df_subset['deaths_weekly'] / (us_pop / 10000), 2)
-            # combined_df['cases_weekly_change_per10k'] = round(combined_df['cumulative_positive_tests'].diff(periods=-7) / (mn_pop / 10000), 2)
+            self.write_store(df_subset)
 
-            # Now let's get the latest date for each county
-            latest_dates = df_subset[['county', 'date']].groupby(['county']).agg({'date': 'max'})
-            latest_df = latest_dates.merge(
-                df_subset,
-                how="left",
-                on=['county', 'date']
-            )
+            # Now let's get the latest date for each county, in name order
+            latest_df = self.update_latest(df_subset)
+            latest_df = latest_df.iloc[np.lexsort([latest_df['state'].astype(str), latest_df['county'].astype(str)])]
 
             print('Exporting latest observations...')
             out_df = latest_df[[
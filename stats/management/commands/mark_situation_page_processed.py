@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from stats.utils import read_situation_page_snapshot, mark_situation_page_processed
+
+
+class Command(BaseCommand):
+    help = '''Record a snapshot as the last situation page processed, so the next conditional fetch of the same page comes back "unchanged". Run this only once every stage and the publish have succeeded for the snapshot, so a failed run gets retried.'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Snapshot written by snapshot_situation_page')
+        parser.add_argument('--snapshot-hash', help='Refuse to mark the snapshot if it does not have this SHA-256')
+
+    def handle(self, *args, **options):
+        html = read_situation_page_snapshot(options['path'], options['snapshot_hash'])
+        mark_situation_page_processed(html)
+        print('Marked {} as processed'.format(options['path']))
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from stats.utils import get_situation_page_content, write_situation_page_snapshot, slack_latest, PAGE_UNCHANGED
+
+
+class Command(BaseCommand):
+    help = '''Download the situation page once per run and save it as a snapshot for the update_* commands to read with --snapshot. Prints the snapshot's SHA-256, or "unchanged" if MDH hasn't changed the page since the last processed run.'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Where to write the snapshot html')
+        parser.add_argument('--force', action='store_true', help='Snapshot the page even if it matches the last processed page')
+
+    def handle(self, *args, **options):
+        html = get_situation_page_content(conditional=not options['force'])
+        if html is PAGE_UNCHANGED:
+            self.stdout.write('unchanged')
+            return
+        if not html:
+            slack_latest("COVID scraper ERROR: snapshot_situation_page.py can't find page HTML. Not proceeding.", '#robot-dojo')
+            raise CommandError("Couldn't download situation page.")
+
+        sha256 = write_situation_page_snapshot(html, options['path'])
+        self.stdout.write(sha256)
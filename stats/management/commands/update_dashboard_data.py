@@ -1,16 +1,19 @@
 import os
-import csv
+import glob
+import json
+import fnmatch
 import requests
 import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 from django.core.management.base import BaseCommand
-from stats.utils import slack_latest
+from stats.utils import slack_latest, content_hash
 
 from django.conf import settings
 
 
 class Command(BaseCommand):
-    help = 'Check for new or updated results from the Minnesota "dashboard": https://mn.gov/covid19/data/response.jsp'
+    help = 'Check for new or updated results from the Minnesota "dashboard": https://mn.gov/covid19/data/response.jsp. Only CSVs whose content changed are saved, and their paths are listed in exports/dashboard/changed_files.txt for the upload. Their new hashes and ETags are held back until the upload has worked and --commit is run, so a failed upload is retried next time.'
 
     # legacy file: 'http://mn.gov/covid19/assets/StateofMNResponseDashboardCSV_tcm1148-427143.csv'
 
@@ -28,19 +31,131 @@ class Command(BaseCommand):
 
     ]
 
-    def get_csv(self):
-        for f in self.FILENAMES:
-            r = requests.get(f['orig_file'])
-            if r.status_code == requests.codes.ok:
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=len(self.FILENAMES), help='Download this many CSVs at once')
+        parser.add_argument('--manifest', default=os.path.join(settings.BASE_DIR, 'exports', 'dashboard', 'changed_files.txt'), help='Where to list the CSVs saved this run')
+        parser.add_argument('--commit', action='store_true', help="Don't download anything, just save the state from the last run once its CSVs have been uploaded")
 
-                # Save a copy of CSV
-                now = datetime.datetime.now().strftime('%Y-%m-%d_%H%M')
-                outpath = os.path.join(settings.BASE_DIR, 'exports', 'dashboard', f['download_base_name']).format(now)
-                with open(outpath, 'w') as csv_file:
-                    csv_file.write(r.text)
-                    csv_file.close()
-            else:
-                slack_latest('WARNING: Dashboard CSV scraper error.: {}'.format(f['orig_file']), '#robot-dojo')
+    def load_state(self):
+        ''' ETag/Last-Modified and SHA-256 of the last saved copy of each CSV, by URL '''
+        try:
+            with open(settings.DASHBOARD_STATE_PATH) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def load_pending(self):
+        ''' What the last run saved for --commit: the state it would save, and the CSVs it listed for upload. None if it was committed. '''
+        try:
+            with open(settings.DASHBOARD_STATE_PATH + '.pending') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def save_pending(self, state, changed):
+        with open(settings.DASHBOARD_STATE_PATH + '.pending.tmp', 'w') as f:
+            json.dump({'state': state, 'changed': changed}, f)
+        os.replace(settings.DASHBOARD_STATE_PATH + '.pending.tmp', settings.DASHBOARD_STATE_PATH + '.pending')
+
+    def commit_state(self):
+        ''' The upload worked, so save the state it was waiting on '''
+        try:
+            with open(settings.DASHBOARD_STATE_PATH + '.pending') as f:
+                pending = json.load(f)
+        except FileNotFoundError:
+            print('No dashboard state waiting to be saved')
+            return
+        with open(settings.DASHBOARD_STATE_PATH + '.tmp', 'w') as f:
+            json.dump(pending['state'], f)
+        os.replace(settings.DASHBOARD_STATE_PATH + '.tmp', settings.DASHBOARD_STATE_PATH)
+        os.remove(settings.DASHBOARD_STATE_PATH + '.pending')
+        print('Saved dashboard state')
+
+    def last_saved_hash(self, f, state):
+        ''' From the state file, or failing that the newest copy already in exports/dashboard '''
+        if f['orig_file'] in state:
+            return state[f['orig_file']]['sha256']
+        saved = sorted(glob.glob(os.path.join(settings.BASE_DIR, 'exports', 'dashboard', f['download_base_name'].format('*'))))
+        if saved:
+            with open(saved[-1], 'rb') as csv_file:
+                return content_hash(csv_file.read())
+        return None
+
+    def fetch(self, session, f, validators):
+        headers = {}
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+        try:
+            return session.get(f['orig_file'], headers=headers, timeout=60)
+        except requests.RequestException as e:
+            print('{}: {}'.format(f['orig_file'], e))
+            return None
+
+    def get_csv(self, options):
+        state = self.load_state()
+        not_uploaded = []
+
+        pending = self.load_pending()
+        if pending is not None:
+            # An earlier run's upload didn't finish. Its CSVs go out again with this run's, and new downloads are compared with what it saved, so the same CSV isn't saved and queued twice.
+            committed_state = state
+            state = pending['state']
+            for path in pending['changed']:
+                if os.path.exists(path):
+                    not_uploaded.append(path)
+                else:
+                    # Gone before it was uploaded, so fetch and save that CSV again
+                    for f in self.FILENAMES:
+                        if fnmatch.fnmatch(os.path.basename(path), f['download_base_name'].format('*')):
+                            state.pop(f['orig_file'], None)
+                            if f['orig_file'] in committed_state:
+                                state[f['orig_file']] = committed_state[f['orig_file']]
+            print('{} dashboard CSVs from an earlier run still need uploading'.format(len(not_uploaded)))
+        changed = []
+
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=options['workers'])
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        with ThreadPoolExecutor(max_workers=options['workers']) as pool:
+            responses = pool.map(lambda f: self.fetch(session, f, state.get(f['orig_file'], {})), self.FILENAMES)
+
+            now = datetime.datetime.now().strftime('%Y-%m-%d_%H%M')
+            for f, r in zip(self.FILENAMES, responses):
+                if r is not None and r.status_code == requests.codes.not_modified:
+                    print('Unchanged (304): {}'.format(f['download_base_name'].format('*')))
+                    continue
+                if r is None or r.status_code != requests.codes.ok:
+                    slack_latest('WARNING: Dashboard CSV scraper error.: {}'.format(f['orig_file']), '#robot-dojo')
+                    continue
+
+                sha256 = content_hash(r.text.encode('utf-8'))  # What ends up on disk
+                if sha256 != self.last_saved_hash(f, state):
+                    # Save a copy of CSV
+                    outpath = os.path.join(settings.BASE_DIR, 'exports', 'dashboard', f['download_base_name']).format(now)
+                    with open(outpath, 'w', encoding='utf-8') as csv_file:
+                        csv_file.write(r.text)
+                    changed.append(outpath)
+                    print('Changed: {}'.format(outpath))
+                else:
+                    print('Unchanged: {}'.format(f['download_base_name'].format('*')))
+
+                state[f['orig_file']] = {
+                    'sha256': sha256,
+                    'etag': r.headers.get('ETag'),
+                    'last_modified': r.headers.get('Last-Modified'),
+                }
+
+        to_upload = not_uploaded + [path for path in changed if path not in not_uploaded]
+        self.save_pending(state, to_upload)
+        with open(options['manifest'], 'w') as manifest:
+            manifest.writelines(path + '\n' for path in to_upload)
+        print('{} of {} dashboard CSVs changed'.format(len(changed), len(self.FILENAMES)))
 
     def handle(self, *args, **options):
-        self.get_csv()
+        if options['commit']:
+            self.commit_state()
+        else:
+            self.get_csv(options)
@@ -1,20 +1,23 @@
 import datetime
-from bs4 import BeautifulSoup
 
 from django.core.management.base import BaseCommand
 from django.conf import settings
-from django.core.exceptions import ObjectDoesNotExist
+from django.db.models import OuterRef, Subquery
 
 from stats.models import County, CountyTestDate
-from stats.utils import get_situation_page_content, timeseries_table_parser, parse_comma_int, slack_latest, updated_today
+from stats.utils import get_situation_page_content, add_snapshot_arguments, parse_comma_int, slack_latest, upsert_rows, ingest_stage, SituationPage
 
 class Command(BaseCommand):
     help = '''County data, broken out from the situation page.'''
 
-    def get_county_data(self, soup):
+    DULUTH_COUNTIES = ['St. Louis', 'Carlton', 'Itasca', 'Lake', 'Cook']
+    ST_CLOUD_COUNTIES = ['Stearns', 'Benton', 'Sherburne']
+    UNIQUE_FIELDS = ['county', 'scrape_date']
+    UPDATE_FIELDS = ['update_date', 'daily_total_cases', 'cumulative_count', 'daily_deaths', 'cumulative_deaths', 'cumulative_confirmed_cases', 'cumulative_probable_cases', 'last_scrape']
+
+    def get_county_data(self, page):
         county_data = []
-        county_table = soup.find("table", {'id': 'maptable'})
-        county_list = timeseries_table_parser(county_table)
+        county_list = page.rows('maptable')
 
         for county in county_list:
             county_name = ' '.join(county['County'].split()).replace(' County', '')
@@ -30,13 +33,27 @@ class Command(BaseCommand):
         return county_data
 
     def update_county_records(self, county_data, update_date):
-        msg_output = ''
-
+        ''' Write today's row for every county in a few queries: one for the counties, one for each county's previous observation, one for which counties already have a row today, then one upsert '''
         today = datetime.date.today()
 
+        counties = {c.name.lower(): c for c in County.objects.all()}
+
+        # Each county's most recent row from before today
+        previous_scrape_date = CountyTestDate.objects.filter(county=OuterRef('county'), scrape_date__lt=today).order_by('-scrape_date').values('scrape_date')[:1]
+        previous_observations = {o.county_id: o for o in CountyTestDate.objects.filter(scrape_date__lt=today, scrape_date=Subquery(previous_scrape_date))}
+
+        counties_seen_today = set(CountyTestDate.objects.filter(scrape_date=today).values_list('county_id', flat=True))
+
         bool_any_changes = False  # Used to decide on Slack alert
+        observations = []
         for observation in county_data:
-            previous_county_observation = CountyTestDate.objects.filter(county__name__iexact=observation['county'].strip(), scrape_date__lt=today).order_by('-scrape_date').first()
+            county = counties.get(observation['county'].strip().lower())
+            if county is None:
+                e = County.DoesNotExist('No county named {}'.format(observation['county']))
+                slack_latest('SCRAPER ERROR: {}'.format(e), '#robot-dojo')
+                raise e
+
+            previous_county_observation = previous_observations.get(county.id)
             if previous_county_observation:
                 previous_county_cases_total = previous_county_observation.cumulative_count
                 previous_county_deaths_total = previous_county_observation.cumulative_deaths
@@ -48,42 +65,24 @@ class Command(BaseCommand):
             daily_deaths = observation['cumulative_deaths'] - previous_county_deaths_total
 
             # Check if there is already an entry today
-            try:
-                county_observation = CountyTestDate.objects.get(
-                    county__name__iexact=observation['county'].strip(),
-                    scrape_date=today
-                )
+            if county.id in counties_seen_today:
                 print('Updating {} County: {}'.format(observation['county'], observation['cumulative_count']))
-                county_observation.update_date = update_date
-                county_observation.daily_total_cases = daily_cases
-                county_observation.cumulative_count = observation['cumulative_count']
-                county_observation.daily_deaths = daily_deaths
-                county_observation.cumulative_deaths = observation['cumulative_deaths']
-
-                county_observation.cumulative_confirmed_cases = observation['cumulative_confirmed_cases']
-                county_observation.cumulative_probable_cases = observation['cumulative_probable_cases']
-
-                county_observation.save()
-            except ObjectDoesNotExist:
-                try:
-                    print('Creating 1st {} County record of day: {}'.format(observation['county'], observation['cumulative_count']))
-                    bool_any_changes = True
-                    county_observation = CountyTestDate(
-                        county=County.objects.get(name__iexact=observation['county'].strip()),
-                        scrape_date=today,
-                        update_date=update_date,
-                        daily_total_cases=daily_cases,
-                        cumulative_count=observation['cumulative_count'],
-                        daily_deaths=daily_deaths,
-                        cumulative_deaths=observation['cumulative_deaths'],
-
-                        cumulative_confirmed_cases = observation['cumulative_confirmed_cases'],
-                        cumulative_probable_cases = observation['cumulative_probable_cases'],
-                    )
-                    county_observation.save()
-                except Exception as e:
-                    slack_latest('SCRAPER ERROR: {}'.format(e), '#robot-dojo')
-                    raise
+            else:
+                print('Creating 1st {} County record of day: {}'.format(observation['county'], observation['cumulative_count']))
+                bool_any_changes = True
+
+            county_observation = CountyTestDate(county=county, scrape_date=today)
+            county_observation.update_date = update_date
+            county_observation.daily_total_cases = daily_cases
+            county_observation.cumulative_count = observation['cumulative_count']
+            county_observation.daily_deaths = daily_deaths
+            county_observation.cumulative_deaths = observation['cumulative_deaths']
+
+            county_observation.cumulative_confirmed_cases = observation['cumulative_confirmed_cases']
+            county_observation.cumulative_probable_cases = observation['cumulative_probable_cases']
+            observations.append(county_observation)
+
+        upsert_rows(CountyTestDate, observations, self.UNIQUE_FIELDS, self.UPDATE_FIELDS)
 
         return bool_any_changes
 
@@ -109,34 +108,40 @@ class Command(BaseCommand):
         slack_latest(msg, channel)
         # slack_latest(msg, '#robot-dojo')
 
+    def add_arguments(self, parser):
+        add_snapshot_arguments(parser)
+
     def handle(self, *args, **options):
-        html = get_situation_page_content()
+        html = get_situation_page_content(snapshot=options['snapshot'], snapshot_hash=options['snapshot_hash'])
         if not html:
             slack_latest("COVID scraper ERROR: update_mn_county_data.py can't find page HTML. Not proceeding.", '#robot-dojo')
         else:
 
-            soup = BeautifulSoup(html, 'html.parser')
-            bool_updated_today, update_date = updated_today(soup)
+            page = SituationPage.from_html(html)
+            bool_updated_today, update_date = page.updated_today()
 
             if bool_updated_today:
                 print('Updated today')
-                county_data = self.get_county_data(soup)
+                county_data = self.get_county_data(page)
 
                 if len(county_data) > 0:
-                    bool_any_changes = self.update_county_records(county_data, update_date)
+                    with ingest_stage('update_mn_county_data'):
+                        bool_any_changes = self.update_county_records(county_data, update_date)
 
                     if bool_any_changes:
+                        today = datetime.date.today()
+                        last_week = today - datetime.timedelta(days=7)
+                        records = {(r.county.name, r.scrape_date): r for r in CountyTestDate.objects.filter(
+                            county__name__in=self.DULUTH_COUNTIES + self.ST_CLOUD_COUNTIES, scrape_date__in=[today, last_week]
+                        ).select_related('county')}
+
                         slack_latest('*COVID daily update*\n\n', '#duluth_live')
-                        for county in ['St. Louis', 'Carlton', 'Itasca', 'Lake', 'Cook']:
-                            record = CountyTestDate.objects.get(county__name=county, scrape_date=datetime.date.today())
-                            record_last_week = CountyTestDate.objects.get(county__name=county, scrape_date=datetime.date.today() - datetime.timedelta(days=7))
-                            self.slack_county_of_interest(record, record_last_week, '#duluth_live')
+                        for county in self.DULUTH_COUNTIES:
+                            self.slack_county_of_interest(records[(county, today)], records[(county, last_week)], '#duluth_live')
 
                         slack_latest('*COVID daily update*\n\n', '#stcloud_live')
-                        for county in ['Stearns', 'Benton', 'Sherburne']:
-                            record = CountyTestDate.objects.get(county__name=county, scrape_date=datetime.date.today())
-                            record_last_week = CountyTestDate.objects.get(county__name=county, scrape_date=datetime.date.today() - datetime.timedelta(days=7))
-                            self.slack_county_of_interest(record, record_last_week, '#stcloud_live')
+                        for county in self.ST_CLOUD_COUNTIES:
+                            self.slack_county_of_interest(records[(county, today)], records[(county, last_week)], '#stcloud_live')
 
                 else:
                     slack_latest('COVID scraper warning: No county records found.', '#robot-dojo')
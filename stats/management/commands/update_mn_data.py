@@ -3,15 +3,13 @@ import os
 import csv
 import datetime
 from datetime import timedelta
-from bs4 import BeautifulSoup
 
 from django.db.models import Count
 from django.core.management.base import BaseCommand
-from django.core.exceptions import ObjectDoesNotExist
 from django.conf import settings
 
 from stats.models import County, CountyTestDate, StatewideTotalDate, Death, StatewideCasesBySampleDate, StatewideTestsDate, StatewideDeathsDate, StatewideHospitalizationsDate
-from stats.utils import get_situation_page_content, timeseries_table_parser, parse_comma_int, updated_today, slack_latest
+from stats.utils import get_situation_page_content, add_snapshot_arguments, SituationPage, frame_records, parse_mdh_date_series, parse_comma_int, slack_latest, upsert_rows, write_timeseries_versions, ingest_stage
 
 
 class Command(BaseCommand):
@@ -48,10 +46,10 @@ class Command(BaseCommand):
     def totals_table_parser(self, table):
         ''' First row is totals, others are breakouts '''
         data = {}
-        rows = table.find_all("tr")
+        rows = table.iter("tr")
         for k, row in enumerate(rows):
-            label = ' '.join(row.find("th").text.split())
-            data[label] = row.find("td").text.strip()
+            label = ' '.join(row.find(".//th").text_content().split())
+            data[label] = row.find(".//td").text_content().strip()
         return data
 
     def pct_filter(self, input_str):
@@ -63,242 +61,190 @@ class Command(BaseCommand):
         except:
             return None
 
-    def get_statewide_cases_timeseries(self, soup, update_date):
+    def save_timeseries(self, model, objs, date_field, label):
+        ''' Replace today's rows, or with VERSIONED_TIMESERIES write only the ones MDH revised '''
+        today = datetime.date.today()
+        if settings.VERSIONED_TIMESERIES:
+            written, closed = write_timeseries_versions(model, objs, date_field, today)
+            print('Wrote {} new versions of {} timeseries data, closed {}'.format(written, label, closed))
+        else:
+            existing_today_records = model.objects.filter(scrape_date=today, valid_from__isnull=True)
+            print('Removing {} records of {} timeseries data'.format(existing_today_records.count(), label))
+            existing_today_records.delete()
+            print('Adding {} records of {} timeseries data'.format(len(objs), label))
+            model.objects.bulk_create(objs)
+
+    def get_statewide_cases_timeseries(self, page, update_date):
         '''How to deal with back-dated statewide totals if they use sample dates'''
         print('Parsing statewide cases timeseries...')
 
-        cases_table = soup.find("table", {'id': 'casetable'})
-        cases_timeseries = timeseries_table_parser(cases_table)
-        # print(cases_timeseries)
+        cases_timeseries = page.frame(
+            'casetable',
+            int_columns=['Confirmed cases (PCR positive)', 'Probable cases (Antigen positive)', 'Total positive cases (cumulative)', 'Total confirmed cases (cumulative)', 'Total probable cases (cumulative)'],
+            date_columns=['Specimen collection date'],  # 'Unknown/missing' comes out as None, any other non-date raises
+        )
+        # Old dates have no antigen cases
+        cases_timeseries['new_cases'] = cases_timeseries['Confirmed cases (PCR positive)'] + cases_timeseries['Probable cases (Antigen positive)'].fillna(0)
+
         if len(cases_timeseries) > 0:
             today = datetime.date.today()
-            # Remove old records from today
-            existing_today_records = StatewideCasesBySampleDate.objects.filter(scrape_date=today)
-            print('Removing {} records of case timeseries data'.format(existing_today_records.count()))
-            existing_today_records.delete()
             case_objs = []
-            for c in cases_timeseries:
-                if c['Specimen collection date'] == 'Unknown/missing':
-                    sample_date = None
-                else:
-                    sample_date = self.parse_mdh_date(c['Specimen collection date'], today)
-                new_pcr_tests = parse_comma_int(c['Confirmed cases (PCR positive)'])
-                new_antigen_tests = parse_comma_int(c['Probable cases (Antigen positive)'])
-
-                if new_antigen_tests:  # Handle old dates
-                    new_cases = int(new_pcr_tests) + int(new_antigen_tests)
-                else:
-                    new_cases = new_pcr_tests
-                # print(sample_date, new_pcr_tests, new_antigen_tests, new_cases)
-
+            for c in frame_records(cases_timeseries):
                 co = StatewideCasesBySampleDate(
-                    sample_date=sample_date,
-                    new_cases=new_cases,
-                    total_cases=parse_comma_int(c['Total positive cases (cumulative)']),
+                    sample_date=c['Specimen collection date'],
+                    new_cases=c['new_cases'],
+                    total_cases=c['Total positive cases (cumulative)'],
 
-                    new_pcr_tests = new_pcr_tests,
-                    new_antigen_tests = new_antigen_tests,
-                    total_pcr_tests = parse_comma_int(c['Total confirmed cases (cumulative)']),
-                    total_antigen_tests = parse_comma_int(c['Total probable cases (cumulative)']),
+                    new_pcr_tests = c['Confirmed cases (PCR positive)'],
+                    new_antigen_tests = c['Probable cases (Antigen positive)'],
+                    total_pcr_tests = c['Total confirmed cases (cumulative)'],
+                    total_antigen_tests = c['Total probable cases (cumulative)'],
 
                     update_date=update_date,
                     scrape_date=today,
                 )
                 case_objs.append(co)
-            print('Adding {} records of case timeseries data'.format(len(case_objs)))
-            StatewideCasesBySampleDate.objects.bulk_create(case_objs)
+            self.save_timeseries(StatewideCasesBySampleDate, case_objs, 'sample_date', 'case')
 
-    def get_statewide_tests_timeseries(self, soup, update_date):
+    def get_statewide_tests_timeseries(self, page, update_date):
         print('Parsing statewide tests timeseries...')
 
-        tests_table = soup.find("table", {'id': 'labtable'})
-        tests_timeseries = timeseries_table_parser(tests_table)
+        tests_timeseries = page.frame(
+            'labtable',
+            int_columns=['Completed PCR tests reported from the MDH Public Health Lab', 'Completed PCR tests reported from external laboratories', 'Total approximate number of completed tests (cumulative)', 'Completed antigen tests reported from external laboratories', 'Total approximate number of completed PCR tests (cumulative)', 'Total approximate number of completed antigen tests (cumulative)'],
+            date_columns=['Date reported to MDH'],
+        )
+        tests_timeseries['new_pcr_tests'] = tests_timeseries['Completed PCR tests reported from the MDH Public Health Lab'] + tests_timeseries['Completed PCR tests reported from external laboratories']
+        tests_timeseries['new_tests'] = tests_timeseries['new_pcr_tests'] + tests_timeseries['Completed antigen tests reported from external laboratories'].fillna(0)
 
         if len(tests_timeseries) > 0:
             today = datetime.date.today()
-            # Remove old records from today
-            existing_today_records = StatewideTestsDate.objects.filter(scrape_date=today)
-            print('Removing {} records of test timeseries data'.format(existing_today_records.count()))
-            existing_today_records.delete()
             test_objs = []
-            for c in tests_timeseries:
-                if c['Date reported to MDH'] == 'Unknown/missing':
-                    reported_date = None
-                else:
-                    reported_date = self.parse_mdh_date(c['Date reported to MDH'], today)
-
-                new_state_tests = parse_comma_int(c['Completed PCR tests reported from the MDH Public Health Lab'])
-                new_external_tests = parse_comma_int(c['Completed PCR tests reported from external laboratories'])
-
-                total_tests = parse_comma_int(c['Total approximate number of completed tests (cumulative)'])
-
-                new_antigen_tests = parse_comma_int(c['Completed antigen tests reported from external laboratories'])
-                total_pcr_tests = parse_comma_int(c['Total approximate number of completed PCR tests (cumulative)'])
-                total_antigen_tests = parse_comma_int(c['Total approximate number of completed antigen tests (cumulative)'])
-
-                new_pcr_tests = new_state_tests + new_external_tests
-                if new_antigen_tests:
-                    new_tests = new_pcr_tests + new_antigen_tests
-                else:
-                    new_tests = new_pcr_tests
+            for c in frame_records(tests_timeseries):
+                total_tests = c['Total approximate number of completed tests (cumulative)']
+                new_tests = c['new_tests']
 
                 std = StatewideTestsDate(
-                    reported_date=reported_date,
-                    new_state_tests=new_state_tests,
-                    new_external_tests=new_external_tests,
+                    reported_date=c['Date reported to MDH'],
+                    new_state_tests=c['Completed PCR tests reported from the MDH Public Health Lab'],
+                    new_external_tests=c['Completed PCR tests reported from external laboratories'],
                     new_tests=new_tests,
                     total_tests=total_tests,
 
-                    new_pcr_tests=new_pcr_tests,
-                    new_antigen_tests=new_antigen_tests,
-                    total_pcr_tests=total_pcr_tests,
-                    total_antigen_tests=total_antigen_tests,
+                    new_pcr_tests=c['new_pcr_tests'],
+                    new_antigen_tests=c['Completed antigen tests reported from external laboratories'],
+                    total_pcr_tests=c['Total approximate number of completed PCR tests (cumulative)'],
+                    total_antigen_tests=c['Total approximate number of completed antigen tests (cumulative)'],
 
                     update_date=update_date,
                     scrape_date=today,
                 )
                 test_objs.append(std)
-            print('Adding {} records of test timeseries data'.format(len(test_objs)))
-            StatewideTestsDate.objects.bulk_create(test_objs)
+            self.save_timeseries(StatewideTestsDate, test_objs, 'reported_date', 'test')
 
         msg_output = '*{}* total tests completed (*{}* today)\n\n'.format(f'{total_tests:,}', self.change_sign(new_tests))
         print(msg_output)
 
         return msg_output
 
-    def get_statewide_hospitalizations_timeseries(self, soup, update_date):
+    def get_statewide_hospitalizations_timeseries(self, page, update_date):
         print('Parsing statewide hospitalizations timeseries...')
 
-        hosp_table = table = soup.find("table", {'id': 'hosptable'})
-        hosp_timeseries = timeseries_table_parser(hosp_table)
+        hosp_timeseries = page.frame(
+            'hosptable',
+            int_columns=['Cases admitted to a hospital', 'Cases admitted to an ICU', 'Total hospitalizations (cumulative)', 'Total ICU hospitalizations (cumulative)'],  # Hyphens in cells come out as None
+        )
+        hosp_timeseries['reported_date'] = parse_mdh_date_series(hosp_timeseries['Date'].replace('Admitted on or before 3/5/20', '3/5/20'))
 
         if len(hosp_timeseries) > 0:
             today = datetime.date.today()
-            # Remove old records from today
-            existing_today_records = StatewideHospitalizationsDate.objects.filter(scrape_date=today)
-            print('Removing {} records of hospitalizations timeseries data'.format(existing_today_records.count()))
-            existing_today_records.delete()
             hosp_objs = []
-            for c in hosp_timeseries:
-                if c['Date'] == 'Unknown/missing':
-                    reported_date = None
-                elif c['Date'] == 'Admitted on or before 3/5/20':
-                    reported_date = self.parse_mdh_date('3/5/20', today)
-                else:
-                    reported_date = self.parse_mdh_date(c['Date'], today)
-
-                # check for hyphen in table cell, set to null if hyphen exists
-                if c['Cases admitted to a hospital'] in ['-', '-\xa0\xa0 ']:
-                    new_hospitalizations = None
-                else:
-                    new_hospitalizations = parse_comma_int(c['Cases admitted to a hospital'])
-
-                if c['Cases admitted to an ICU'] in ['-', '-\xa0\xa0 ']:
-                    new_icu_admissions = None
-                else:
-                    new_icu_admissions = parse_comma_int(c['Cases admitted to an ICU'])
-
-                total_hospitalizations = parse_comma_int(c['Total hospitalizations (cumulative)'])
-                total_icu_admissions = parse_comma_int(c['Total ICU hospitalizations (cumulative)'])
+            for c in frame_records(hosp_timeseries):
+                total_hospitalizations = c['Total hospitalizations (cumulative)']
 
                 std = StatewideHospitalizationsDate(
-                    reported_date=reported_date,
-                    new_hosp_admissions=new_hospitalizations,
-                    new_icu_admissions=new_icu_admissions,
+                    reported_date=c['reported_date'],
+                    new_hosp_admissions=c['Cases admitted to a hospital'],
+                    new_icu_admissions=c['Cases admitted to an ICU'],
                     total_hospitalizations=total_hospitalizations,
-                    total_icu_admissions=total_icu_admissions,
+                    total_icu_admissions=c['Total ICU hospitalizations (cumulative)'],
                     update_date=update_date,
                     scrape_date=today,
                 )
                 hosp_objs.append(std)
 
-            print('Adding {} records of hospitalizations timeseries data'.format(len(hosp_objs)))
-            StatewideHospitalizationsDate.objects.bulk_create(hosp_objs)
+            self.save_timeseries(StatewideHospitalizationsDate, hosp_objs, 'reported_date', 'hospitalizations')
 
         return total_hospitalizations
 
-    def get_statewide_deaths_timeseries(self, soup, update_date):
+    def get_statewide_deaths_timeseries(self, page, update_date):
         print('Parsing statewide deaths timeseries...')
 
-        deaths_table = table = soup.find("table", {'id': 'deathtable'})
-        deaths_timeseries = timeseries_table_parser(deaths_table)
-        # print(deaths_timeseries)
+        deaths_timeseries = page.frame(
+            'deathtable',
+            int_columns=['Newly reported deaths', 'Total deaths (cumulative)'],  # Blanks and hyphens come out as None
+            date_columns=['Date reported'],
+        )
 
         if len(deaths_timeseries) > 0:
             today = datetime.date.today()
-            # Remove old records from today
-            existing_today_records = StatewideDeathsDate.objects.filter(scrape_date=today)
-            print('Removing {} records of deaths timeseries data'.format(existing_today_records.count()))
-            existing_today_records.delete()
             death_objs = []
-            for c in deaths_timeseries:
-                if c['Date reported'] == 'Unknown/missing':
-                  reported_date = None
-                else:
-                  reported_date = self.parse_mdh_date(c['Date reported'], today)
-
-                # check for hyphen in deaths table, set to null if hyphen exists
-                if c['Newly reported deaths'] in ['', '-', '-\xa0\xa0 ']:
-                  new_deaths = None
-                else:
-                  new_deaths = parse_comma_int(c['Newly reported deaths'])
-
-                total_deaths = parse_comma_int(c['Total deaths (cumulative)'])
+            for c in frame_records(deaths_timeseries):
+                new_deaths = c['Newly reported deaths']
+                total_deaths = c['Total deaths (cumulative)']
 
                 std = StatewideDeathsDate(
-                  reported_date=reported_date,
+                  reported_date=c['Date reported'],
                   new_deaths=new_deaths,
                   total_deaths=total_deaths,
                   update_date=update_date,
                   scrape_date=today,
                 )
                 death_objs.append(std)
-            print('Adding {} records of deaths timeseries data'.format(len(death_objs)))
-            StatewideDeathsDate.objects.bulk_create(death_objs)
+            self.save_timeseries(StatewideDeathsDate, death_objs, 'reported_date', 'deaths')
 
             msg_output = '*{}* total deaths (*{}* reported today)\n\n'.format(f'{total_deaths:,}', self.change_sign(new_deaths))
             print(msg_output)
 
             return msg_output
 
-    def get_statewide_data(self, soup):
+    def get_statewide_data(self, page):
         output = {}
 
-        hosp_table = soup.find("table", {'id': 'hosptotal'})
+        hosp_table = page.hosptotal
         hosp_table_latest = self.totals_table_parser(hosp_table)
         output['cumulative_hospitalized'] = parse_comma_int(hosp_table_latest['Total cases hospitalized (cumulative)'])
         output['cumulative_icu'] = parse_comma_int(hosp_table_latest['Total cases hospitalized in ICU (cumulative)'])
 
-        cumulative_cases_table = soup.find("table", {'id': 'casetotal'})
+        cumulative_cases_table = page.casetotal
         cumulative_cases_latest = self.totals_table_parser(cumulative_cases_table)
         output['cumulative_positive_tests'] = parse_comma_int(cumulative_cases_latest['Total positive cases (cumulative)'])
         output['cumulative_confirmed_cases'] = parse_comma_int(cumulative_cases_latest['Total confirmed cases (PCR positive) (cumulative)'])
         output['cumulative_probable_cases'] = parse_comma_int(cumulative_cases_latest['Total probable cases (Antigen positive) (cumulative)'])
 
-        new_cases_table = soup.find("table", {'id': 'dailycasetotal'})
+        new_cases_table = page.dailycasetotal
         new_cases_latest = self.totals_table_parser(new_cases_table)
         output['cases_newly_reported'] = parse_comma_int(new_cases_latest['Newly reported cases'])
         output['confirmed_cases_newly_reported'] = parse_comma_int(new_cases_latest['Newly reported confirmed cases'])
         output['probable_cases_newly_reported'] = parse_comma_int(new_cases_latest['Newly reported probable cases'])
 
-        cumulative_tests_table = soup.find("table", {'id': 'testtotal'})
+        cumulative_tests_table = page.testtotal
         cumulative_tests_latest = self.totals_table_parser(cumulative_tests_table)
         output['total_statewide_tests'] = parse_comma_int(cumulative_tests_latest['Total approximate completed tests (cumulative)'])
         output['cumulative_pcr_tests'] = parse_comma_int(cumulative_tests_latest['Total approximate number of completed PCR tests (cumulative)'])
         output['cumulative_antigen_tests'] = parse_comma_int(cumulative_tests_latest['Total approximate number of completed antigen tests (cumulative)'])
 
-        deaths_table = soup.find("table", {'id': 'deathtotal'})
+        deaths_table = page.deathtotal
         deaths_table_latest = self.totals_table_parser(deaths_table)
         output['cumulative_statewide_deaths'] = parse_comma_int(deaths_table_latest['Total deaths (cumulative)'])
         output['cumulative_confirmed_statewide_deaths'] = parse_comma_int(deaths_table_latest['Deaths from confirmed cases (cumulative)'])
         output['cumulative_probable_statewide_deaths'] = parse_comma_int(deaths_table_latest['Deaths from probable cases (cumulative)'])
 
-        recoveries_table = soup.find("table", {'id': 'noisototal'})
+        recoveries_table = page.noisototal
         recoveries_latest = self.totals_table_parser(recoveries_table)
         output['cumulative_statewide_recoveries'] = parse_comma_int(recoveries_latest['Patients no longer needing isolation (cumulative)'])
 
-        uls = soup.find_all('ul')
-        for ul in uls:
+        for ul in page.uls:
 
             daily_cases_removed_match = self.ul_regex('Cases removed', ul.text)
             if daily_cases_removed_match is not False:
@@ -341,26 +287,17 @@ class Command(BaseCommand):
             'update_date': update_date
         }
 
-        try:
-            current_statewide_observation = StatewideTotalDate.objects.get(
-                scrape_date=today
-            )
+        if StatewideTotalDate.objects.filter(scrape_date=today).exists():
             print('Updating existing statewide for {}'.format(today))
+        else:
+            print('Creating 1st statewide record for {}'.format(today))
 
-            for k, v in base_record_obj.items():
-                setattr(current_statewide_observation, k, v)
-            current_statewide_observation.save()
-
-        except ObjectDoesNotExist:
-            try:
-                print('Creating 1st statewide record for {}'.format(today))
-                base_record_obj['scrape_date'] = today
-
-                current_statewide_observation = StatewideTotalDate(**base_record_obj)
-                current_statewide_observation.save()
-            except Exception as e:
-                slack_latest('SCRAPER ERROR: {}'.format(e), '#robot-dojo')
-                raise
+        current_statewide_observation = StatewideTotalDate(scrape_date=today, **base_record_obj)
+        try:
+            upsert_rows(StatewideTotalDate, [current_statewide_observation], ['scrape_date'], list(base_record_obj.keys()) + ['last_update'])
+        except Exception as e:
+            slack_latest('SCRAPER ERROR: {}'.format(e), '#robot-dojo')
+            raise
 
         msg_output = ''
 
@@ -378,27 +315,31 @@ class Command(BaseCommand):
 
         return final_msg
 
+    def add_arguments(self, parser):
+        add_snapshot_arguments(parser)
+
     def handle(self, *args, **options):
-        html = get_situation_page_content()
+        html = get_situation_page_content(snapshot=options['snapshot'], snapshot_hash=options['snapshot_hash'])
         if not html:
             slack_latest('WARNING: Scraper error. Not proceeding.', '#robot-dojo')
         else:
             previous_statewide_cases = StatewideTotalDate.objects.order_by('-scrape_date').first().cumulative_positive_tests
 
-            soup = BeautifulSoup(html, 'html.parser')
+            page = SituationPage.from_html(html)
 
-            bool_updated_today, update_date = updated_today(soup)
+            bool_updated_today, update_date = page.updated_today()
             print(update_date)
             if bool_updated_today:
                 print('Updated today')
 
-                statewide_data = self.get_statewide_data(soup)
-                statewide_msg_output = self.update_statewide_records(statewide_data, update_date)
+                statewide_data = self.get_statewide_data(page)
+                with ingest_stage('update_mn_data'):
+                    statewide_msg_output = self.update_statewide_records(statewide_data, update_date)
 
-                self.get_statewide_cases_timeseries(soup, update_date)
-                test_msg_output = self.get_statewide_tests_timeseries(soup, update_date)
-                death_msg_output = self.get_statewide_deaths_timeseries(soup, update_date)
-                total_hospitalizations = self.get_statewide_hospitalizations_timeseries(soup, update_date)
+                    self.get_statewide_cases_timeseries(page, update_date)
+                    test_msg_output = self.get_statewide_tests_timeseries(page, update_date)
+                    death_msg_output = self.get_statewide_deaths_timeseries(page, update_date)
+                    total_hospitalizations = self.get_statewide_hospitalizations_timeseries(page, update_date)
 
                 if statewide_data['cumulative_positive_tests'] != previous_statewide_cases:
                     slack_latest(statewide_msg_output + death_msg_output + test_msg_output, '#virus')
@@ -1,18 +1,19 @@
 import datetime
-from bs4 import BeautifulSoup
 
 from django.core.management.base import BaseCommand
 from django.conf import settings
 
 from stats.models import StatewideAgeDate
-from stats.utils import get_situation_page_content, timeseries_table_parser, parse_comma_int, slack_latest
+from stats.utils import get_situation_page_content, add_snapshot_arguments, parse_comma_int, slack_latest, upsert_rows, ingest_stage, SituationPage
 
 class Command(BaseCommand):
     help = 'Age data breakout from main scraper'
 
-    def get_age_data(self, soup):
-        age_table = soup.find("table", {'id': 'agetable'})
-        ages_data = timeseries_table_parser(age_table)
+    UNIQUE_FIELDS = ['scrape_date', 'age_group']
+    UPDATE_FIELDS = ['age_min', 'age_max', 'case_count', 'death_count', 'last_update']
+
+    def get_age_data(self, page):
+        ages_data = page.rows('agetable')
 
         cleaned_ages_data = []
         for d in ages_data:
@@ -24,37 +25,38 @@ class Command(BaseCommand):
 
     def update_age_records(self, age_data):
         today = datetime.date.today()
+        observations = []
         for a in age_data:
-            try:
-                current_observation = StatewideAgeDate.objects.get(
-                  scrape_date=today,
-                  age_group=a['Age Group']
-                )
-                print('Updating existing ages for {} on {}'.format(a['Age Group'], today))
-            except:
-                print('First age record for {} on {}'.format(a['Age Group'], today))
-                current_observation = StatewideAgeDate(
-                  scrape_date=today,
-                  age_group=a['Age Group']
-                )
-            current_observation.case_count = a['Number of Cases']
-            current_observation.death_count = a['Number of Deaths']
-            current_observation.save()
+            print('Saving ages for {} on {}'.format(a['Age Group'], today))
+            current_observation = StatewideAgeDate(
+              scrape_date=today,
+              age_group=a['Age Group'],
+              case_count=a['Number of Cases'],
+              death_count=a['Number of Deaths'],
+            )
+            current_observation.set_age_range()
+            observations.append(current_observation)
+
+        upsert_rows(StatewideAgeDate, observations, self.UNIQUE_FIELDS, self.UPDATE_FIELDS)
 
         return 'COVID scraper: Age records updated.'
 
+    def add_arguments(self, parser):
+        add_snapshot_arguments(parser)
+
     def handle(self, *args, **options):
-        html = get_situation_page_content()
+        html = get_situation_page_content(snapshot=options['snapshot'], snapshot_hash=options['snapshot_hash'])
         if not html:
             slack_latest("COVID scraper ERROR: update_mn_age_data.py can't find page HTML. Not proceeding.", '#robot-dojo')
         else:
 
-            soup = BeautifulSoup(html, 'html.parser')
+            page = SituationPage.from_html(html)
 
-            age_data = self.get_age_data(soup)
+            age_data = self.get_age_data(page)
 
             if len(age_data) > 0:
-                age_msg_output = self.update_age_records(age_data)
+                with ingest_stage('update_mn_race_data'):
+                    age_msg_output = self.update_age_records(age_data)
                 slack_latest(age_msg_output, '#robot-dojo')
             else:
                 slack_latest('COVID scraper warning: No age records found.', '#robot-dojo')
@@ -1,22 +1,20 @@
 import re
 import datetime
-from bs4 import BeautifulSoup
+from collections import Counter
 
 from django.core.management.base import BaseCommand
 from django.conf import settings
-from django.db.models import Count
 
-from stats.models import County, Death
-from stats.utils import get_situation_page_content, timeseries_table_parser, parse_comma_int, slack_latest, updated_today
+from stats.models import County, Death, DeathCountDate
+from stats.utils import get_situation_page_content, add_snapshot_arguments, parse_comma_int, slack_latest, ingest_stage, SituationPage
 
 class Command(BaseCommand):
     help = '''Recent deaths data from the scraper. This isn't currently output anywhere but seems worth collecting.'''
 
-    def get_recent_deaths_data(self, soup, update_date):
+    def get_recent_deaths_data(self, page, update_date):
         # today = datetime.date.today()
-        recent_deaths_table = soup.find("table", {'id': 'dailydeathar'})
-        if recent_deaths_table:
-            recent_deaths_ages = timeseries_table_parser(recent_deaths_table)
+        recent_deaths_ages = page.rows('dailydeathar')
+        if recent_deaths_ages is not None:
 
             cleaned_data = []
 
@@ -40,7 +38,7 @@ class Command(BaseCommand):
             return cleaned_data
         else:
             # Find out if you have an error or if there really were zero deaths
-            deaths_total_table = soup.find("table", {'id': 'dailydeathtotal'})
+            deaths_total_table = page.soup_table('dailydeathtotal')
             last_td = deaths_total_table.find_all("td")[-1]
             num_deaths = int(last_td.text)
             if num_deaths == 0:
@@ -52,63 +50,46 @@ class Command(BaseCommand):
         return None
 
     def load_recent_deaths(self, scraped_deaths, update_date):
-        existing_deaths = Death.objects.filter(scrape_date=update_date).values('scrape_date', 'county__name', 'age_group').annotate(count=Count('pk'))
-
-        date_stripped_scraped = [{i:d[i] for i in d if i != 'scrape_date'} for d in scraped_deaths]
-        date_stripped_existing = [{i:d[i] for i in d if i != 'scrape_date'} for d in existing_deaths]
-
-        bool_changes = [i for i in date_stripped_scraped if i not in date_stripped_existing] != []
-
-        if not bool_changes:
+        ''' Make update_date's Death rows match the scraped count for each (county, age group) in a fixed number of queries: one for the rows already there, one for the counties, then one delete and one bulk insert. DeathCountDate is recounted for the day after. '''
+        scraped = Counter()
+        for sd in scraped_deaths:
+            scraped[(sd['county__name'], sd['age_group'])] += sd['count']
+
+        existing = Counter()
+        existing_ids = {}
+        for pk, county_name, age_group in Death.objects.filter(scrape_date=update_date).order_by('pk').values_list('pk', 'county__name', 'age_group'):
+            existing[(county_name, age_group)] += 1
+            existing_ids.setdefault((county_name, age_group), []).append(pk)
+
+        deaths_to_add = scraped - existing
+        # Groups MDH didn't list this time are left alone
+        deaths_to_remove = {group: count for group, count in (existing - scraped).items() if group in scraped}
+
+        if not deaths_to_add and not deaths_to_remove:
             print("No updates needed.")
-        else:
-
-            deaths_to_add = []
-            deaths_to_remove = []
-            for sd in scraped_deaths:
-                similar = [ed for ed in existing_deaths if ed['county__name'] == sd['county__name'] and ed['age_group'] == sd['age_group']]
-                # print('Similar: ', similar)
-                if len(similar) == 0:
-                    # add all to list
-                    deaths_to_add.append(sd)
-                else:
-                    # Check if we have enough or too many for this grouping
-                    unknown_deaths = sd['count'] - similar[0]['count']
-                    if unknown_deaths > 0:
-                        print('Adding {} deaths: {} {}'.format(unknown_deaths, sd['county__name'], sd['age_group']))
-                        sd['count'] = unknown_deaths
-                        deaths_to_add.append(sd)
-                    elif unknown_deaths < 0:
-                        print('WARNING: Subtracting {} deaths: {} {}'.format(unknown_deaths, sd['county__name'], sd['age_group']))
-                        sd['count'] = unknown_deaths
-                        sd['scrape_date'] = similar[0]['scrape_date']  # If you're going to remove, make sure it's from the max_date, not necessarily today
-                        deaths_to_remove.append(sd)
-
-            # Removing records
-            for group in deaths_to_remove:
-                remove_count = group['count']
-                county = County.objects.get(name=group['county__name'])
-                while remove_count < 0:
-                    Death.objects.filter(scrape_date=group['scrape_date'], age_group=group['age_group'], county=county).last().delete()
-                    remove_count += 1
-
-            # Adding records
-            new_deaths = []
-            for group in deaths_to_add:
-                add_count = group['count']
-                if group['county__name']:
-                    county = County.objects.get(name=group['county__name'])
-                else:
-                    county = None
-                while add_count > 0:
-                    death = Death(
-                        scrape_date=group['scrape_date'],
-                        age_group=group['age_group'],
-                        county=county,
-                    )
-                    new_deaths.append(death)
-                    add_count -= 1
-            Death.objects.bulk_create(new_deaths)
+            return
+
+        # Removing records, the most recently added first
+        ids_to_remove = []
+        for (county_name, age_group), count in deaths_to_remove.items():
+            print('WARNING: Subtracting {} deaths: {} {}'.format(-count, county_name, age_group))
+            ids_to_remove.extend(existing_ids[(county_name, age_group)][-count:])
+        Death.objects.filter(pk__in=ids_to_remove).delete()
+
+        # Adding records
+        counties = {c.name: c for c in County.objects.all()}
+        new_deaths = []
+        for (county_name, age_group), count in deaths_to_add.items():
+            print('Adding {} deaths: {} {}'.format(count, county_name, age_group))
+            if county_name and county_name not in counties:
+                raise County.DoesNotExist('No county named {}'.format(county_name))
+            county = counties[county_name] if county_name else None
+            new_deaths.extend(Death(scrape_date=update_date, age_group=age_group, county=county) for n in range(count))
+        Death.objects.bulk_create(new_deaths)
+        DeathCountDate.sync([update_date])
+
+    def add_arguments(self, parser):
+        add_snapshot_arguments(parser)
 
     def handle(self, *args, **options):
         # archive_list = [
@@ -118,22 +99,23 @@ class Command(BaseCommand):
         # ]
         # for url in archive_list:
             # html = get_situation_page_content(url)  # TEMP MANUAL OVERRIDE
-        html = get_situation_page_content()  # TEMP MANUAL OVERRIDE
+        html = get_situation_page_content(snapshot=options['snapshot'], snapshot_hash=options['snapshot_hash'])  # TEMP MANUAL OVERRIDE
         if not html:
             slack_latest("COVID scraper ERROR: update_mn_recent_deaths.py can't find page HTML. Not proceeding.", '#robot-dojo')
         else:
 
-            soup = BeautifulSoup(html, 'html.parser')
-            # bool_updated_today, update_date = updated_today(soup, True)  # TEMP: MANUAL OVERRIDE
-            bool_updated_today, update_date = updated_today(soup)  # TEMP: MANUAL OVERRIDE
+            page = SituationPage.from_html(html)
+            # bool_updated_today, update_date = page.updated_today(True)  # TEMP: MANUAL OVERRIDE
+            bool_updated_today, update_date = page.updated_today()  # TEMP: MANUAL OVERRIDE
 
             if bool_updated_today:
                 print('Updated today')
-                recent_deaths_data = self.get_recent_deaths_data(soup, update_date)
+                recent_deaths_data = self.get_recent_deaths_data(page, update_date)
                 if recent_deaths_data == None:
                     slack_latest('COVID scraper warning: No recent deaths records found.', '#robot-dojo')
                 elif type(recent_deaths_data) == list and len(recent_deaths_data) > 0:
-                    deaths_msg_output = self.load_recent_deaths(recent_deaths_data, update_date)
+                    with ingest_stage('update_mn_recent_deaths'):
+                        deaths_msg_output = self.load_recent_deaths(recent_deaths_data, update_date)
                     # slack_latest(deaths_msg_output, '#robot-dojo')
                 else:
                     slack_latest('COVID scraper OK: Seems to be 0-death day.', '#robot-dojo')
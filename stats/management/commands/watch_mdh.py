@@ -0,0 +1,120 @@
+import os
+import time
+import datetime
+import subprocess
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+
+from stats.models import StatewideTotalDate
+from stats.utils import get_situation_page_content, get_update_date, write_situation_page_snapshot, mark_situation_page_processed, slack_latest, PAGE_UNCHANGED
+
+
+class Command(BaseCommand):
+    help = '''Stay running and poll the situation page, polling often around MDH's usual release time and rarely otherwise. When the "Updated" date changes, run the same steps as docker-entrypoint-scrape.sh in this process: archive the page and CDC json, run the stages, publish, then update the dashboard CSVs.'''
+
+    # Same order as docker-entrypoint-scrape.sh. Stages that read the page get the run's snapshot.
+    STAGES = [
+        ('update_mn_data', True),
+        ('update_mn_county_data', True),
+        ('dump_mn_latest_counts', False),
+        ('dump_mn_statewide_timeseries', False),
+        ('dump_mn_county_timeseries', False),
+        ('update_mn_age_data', True),
+        ('update_mn_recent_deaths', True),
+    ]
+
+    def add_arguments(self, parser):
+        parser.add_argument('--release-hour', type=int, default=11, help='Hour MDH usually posts, local time')
+        parser.add_argument('--window-before', type=int, default=30, help='Minutes before the release hour to start polling fast')
+        parser.add_argument('--window-after', type=int, default=180, help='Minutes after the release hour to keep polling fast')
+        parser.add_argument('--fast-interval', type=int, default=30, help='Seconds between polls inside the release window')
+        parser.add_argument('--slow-interval', type=int, default=900, help='Seconds between polls outside the release window')
+        parser.add_argument('--max-backoff', type=int, default=1800, help='Longest wait in seconds after repeated errors')
+        parser.add_argument('--publish-script', default='publish-exports.sh', help='Script run after the stages to push exports to S3')
+        parser.add_argument('--dashboard-publish-script', default='publish-dashboard.sh', help='Script run after update_dashboard_data to push the changed dashboard CSVs to S3')
+        parser.add_argument('--no-publish', action='store_true', help="Run the stages but don't run the publish scripts")
+
+    def release_window(self, now, options):
+        release = now.replace(hour=options['release_hour'], minute=0, second=0, microsecond=0)
+        return release - datetime.timedelta(minutes=options['window_before']), release + datetime.timedelta(minutes=options['window_after'])
+
+    def next_poll_delay(self, now, last_update_date, failures, options):
+        '''Back off exponentially after errors, poll fast in the release window until today's update is in, otherwise poll slowly but wake up for the next window'''
+        if failures:
+            return min(options['fast_interval'] * 2 ** failures, options['max_backoff'])
+
+        window_start, window_end = self.release_window(now, options)
+        if last_update_date != now.date() and window_start <= now <= window_end:
+            return options['fast_interval']
+
+        if now < window_start:
+            return max(options['fast_interval'], min(options['slow_interval'], (window_start - now).total_seconds()))
+        return options['slow_interval']
+
+    def run_pipeline(self, html, options):
+        ''' Everything docker-entrypoint-scrape.sh does for an updated page. Anything that fails raises before the page is marked processed, so the next poll fetches it and runs it all again. '''
+        now = datetime.datetime.now()
+        snapshot_path = os.path.join(settings.BASE_DIR, 'exports', 'html', 'situation_{}.html'.format(now.strftime('%Y-%m-%d_%H%M')))
+        snapshot_hash = write_situation_page_snapshot(html, snapshot_path)
+        print('Snapshot {} ({})'.format(snapshot_path, snapshot_hash))
+
+        print('Archiving MDH situation html and CDC vaccine data json...')
+        call_command('archive_raw_payloads', situation_page=snapshot_path, cdc=True)
+
+        for stage, bool_reads_page in self.STAGES:
+            print('Running {}...'.format(stage))
+            if bool_reads_page:
+                call_command(stage, snapshot=snapshot_path, snapshot_hash=snapshot_hash)
+            else:
+                call_command(stage)
+
+        if not options['no_publish']:
+            subprocess.run(['bash', options['publish_script']], check=True)
+
+        mark_situation_page_processed(html)
+
+        # Like the entrypoint, after the page is done, so a dashboard error doesn't make the MDH stages run again
+        print('Running update_dashboard_data...')
+        call_command('update_dashboard_data')
+        if not options['no_publish']:
+            subprocess.run(['bash', options['dashboard_publish_script']], check=True)
+
+    def handle(self, *args, **options):
+        last_run = StatewideTotalDate.objects.order_by('-scrape_date').first()
+        last_update_date = last_run.update_date if last_run else None
+        print('Watching MDH. Last update ingested: {}'.format(last_update_date))
+
+        failures = 0
+        while True:
+            close_old_connections()  # Don't hold on to a connection the database has dropped while we slept
+            try:
+                html = get_situation_page_content(conditional=True)
+                if html is PAGE_UNCHANGED:
+                    pass
+                elif not html:
+                    raise Exception("Can't download situation page")
+                else:
+                    update_date = get_update_date(html)
+                    if update_date is None:
+                        # Likely a markup change. Don't mark the page processed, so it fails loudly until it's fixed.
+                        raise Exception('No "Updated <date>" stamp on the situation page')
+                    if update_date != last_update_date:
+                        print('MDH updated {}, running pipeline...'.format(update_date))
+                        # If this raises, last_update_date stays put and the page isn't marked processed, so it's retried after the backoff
+                        self.run_pipeline(html, options)
+                        last_update_date = update_date
+                    else:
+                        # Same stamp, so nothing to ingest. Don't download and check this version again.
+                        mark_situation_page_processed(html)
+                failures = 0
+            except Exception as e:
+                failures += 1
+                print('Watcher error ({} in a row): {}'.format(failures, e))
+                if failures == 1:
+                    slack_latest('COVID scraper ERROR: watch_mdh: {}'.format(e), '#robot-dojo')
+
+            delay = self.next_poll_delay(datetime.datetime.now(), last_update_date, failures, options)
+            time.sleep(delay)
@@ -0,0 +1,50 @@
+# Generated by Django 3.1.3 on 2026-10-18 16:52
+
+from django.db import migrations, models
+from django.db.models import Count, Max
+
+
+# The daily snapshot tables and the fields that should pick out one row
+SNAPSHOT_KEYS = {
+    'CountyTestDate': ['county', 'scrape_date'],
+    'StatewideAgeDate': ['scrape_date', 'age_group'],
+    'StatewideRaceDate': ['data_date', 'race_eth'],
+    'StatewideTotalDate': ['scrape_date'],
+}
+
+
+def remove_duplicate_snapshots(apps, schema_editor):
+    ''' Keep the last row saved for each key, so the unique constraints can go on '''
+    for model_name, key in SNAPSHOT_KEYS.items():
+        model = apps.get_model('stats', model_name)
+        for dupe in model.objects.values(*key).annotate(last_id=Max('id'), n=Count('id')).filter(n__gt=1):
+            lookup = {k: dupe[k] for k in key}
+            deleted, _ = model.objects.filter(**lookup).exclude(id=dupe['last_id']).delete()
+            print('Removed {} duplicate {} rows for {}'.format(deleted, model_name, lookup))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stats', '0061_auto_20210413_1557'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_snapshots, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='countytestdate',
+            constraint=models.UniqueConstraint(fields=('county', 'scrape_date'), name='unique_countytestdate_county_scrape_date'),
+        ),
+        migrations.AddConstraint(
+            model_name='statewideagedate',
+            constraint=models.UniqueConstraint(fields=('scrape_date', 'age_group'), name='unique_statewideagedate_scrape_date_age_group'),
+        ),
+        migrations.AddConstraint(
+            model_name='statewideracedate',
+            constraint=models.UniqueConstraint(fields=('data_date', 'race_eth'), name='unique_statewideracedate_data_date_race_eth'),
+        ),
+        migrations.AddConstraint(
+            model_name='statewidetotaldate',
+            constraint=models.UniqueConstraint(fields=('scrape_date',), name='unique_statewidetotaldate_scrape_date'),
+        ),
+    ]
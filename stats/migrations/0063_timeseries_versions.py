@@ -0,0 +1,22 @@
+# Generated by Django 3.1.3 on 2026-10-18 16:54
+
+from django.db import migrations, models
+
+
+# The TimeseriesVersion fields, on each model that inherits them
+VERSIONED_MODELS = ['statewidecasesbysampledate', 'statewidedeathsdate', 'statewidehospitalizationsdate', 'statewidetestsdate']
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stats', '0062_snapshot_unique_constraints'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name=model_name,
+            name=name,
+            field=models.DateField(db_index=True, null=True),
+        ) for model_name in VERSIONED_MODELS for name in ['valid_from', 'valid_to']
+    ]
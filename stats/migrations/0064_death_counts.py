@@ -0,0 +1,46 @@
+# Generated by Django 3.1.3 on 2026-10-18 16:59
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import Count
+
+
+def collapse_deaths(apps, schema_editor):
+    ''' One DeathCountDate row per group of existing Death rows '''
+    Death = apps.get_model('stats', 'Death')
+    DeathCountDate = apps.get_model('stats', 'DeathCountDate')
+    groups = Death.objects.values('scrape_date', 'county', 'age_group', 'bool_ltc').annotate(count=Count('id')).order_by()
+    DeathCountDate.objects.bulk_create([DeathCountDate(
+        scrape_date=g['scrape_date'],
+        county_id=g['county'],
+        age_group=g['age_group'],
+        bool_ltc=g['bool_ltc'],
+        count=g['count'],
+    ) for g in groups], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stats', '0063_timeseries_versions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeathCountDate',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('scrape_date', models.DateField(db_index=True)),
+                ('age_group', models.CharField(db_index=True, max_length=100)),
+                ('bool_ltc', models.BooleanField(null=True)),
+                ('count', models.IntegerField()),
+                ('last_update', models.DateTimeField(auto_now=True)),
+                ('county', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='stats.county')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='deathcountdate',
+            index=models.Index(fields=['scrape_date', 'county', 'age_group', 'bool_ltc'], name='deathcountdate_group'),
+        ),
+        migrations.RunPython(collapse_deaths, migrations.RunPython.noop),
+    ]
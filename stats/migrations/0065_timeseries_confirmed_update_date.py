@@ -0,0 +1,30 @@
+# Generated by Django 3.1.3 on 2026-10-18 17:32
+
+from django.db import migrations, models
+
+
+# The TimeseriesVersion models, like 0063_timeseries_versions
+VERSIONED_MODELS = ['statewidecasesbysampledate', 'statewidedeathsdate', 'statewidehospitalizationsdate', 'statewidetestsdate']
+
+
+def confirm_existing_versions(apps, schema_editor):
+    ''' Versions already saved were last confirmed by their own update_date, as far as we know '''
+    for model_name in VERSIONED_MODELS:
+        apps.get_model('stats', model_name).objects.filter(valid_from__isnull=False).update(confirmed_update_date=models.F('update_date'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stats', '0064_death_counts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name=model_name,
+            name='confirmed_update_date',
+            field=models.DateField(null=True),
+        ) for model_name in VERSIONED_MODELS
+    ] + [
+        migrations.RunPython(confirm_existing_versions, migrations.RunPython.noop),
+    ]
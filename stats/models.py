@@ -33,6 +33,34 @@ class Death(models.Model):
     last_update = models.DateTimeField(auto_now=True)
 
 
+class DeathCountDate(models.Model):
+    ''' Death rows collapsed to a count per scrape_date, county, age group and long-term care flag, so totals are a sum over a few rows instead of a count over every death. Kept in sync by update_mn_recent_deaths. '''
+    scrape_date = models.DateField(db_index=True)
+    county = models.ForeignKey(County, null=True, on_delete=models.CASCADE)
+    age_group = models.CharField(max_length=100, db_index=True)
+    bool_ltc = models.BooleanField(null=True)
+    count = models.IntegerField()
+    last_update = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['scrape_date', 'county', 'age_group', 'bool_ltc'], name='deathcountdate_group'),
+        ]
+
+    @classmethod
+    def sync(cls, scrape_dates):
+        ''' Recount these scrape dates from Death '''
+        groups = Death.objects.filter(scrape_date__in=scrape_dates).values('scrape_date', 'county', 'age_group', 'bool_ltc').annotate(count=models.Count('pk')).order_by()
+        cls.objects.filter(scrape_date__in=scrape_dates).delete()
+        cls.objects.bulk_create([cls(
+            scrape_date=g['scrape_date'],
+            county_id=g['county'],
+            age_group=g['age_group'],
+            bool_ltc=g['bool_ltc'],
+            count=g['count'],
+        ) for g in groups])
+
+
 class StatewideAgeDate(models.Model):
     scrape_date = models.DateField(db_index=True)
     age_group = models.CharField(max_length=100)
@@ -44,8 +72,12 @@ class StatewideAgeDate(models.Model):
     death_count = models.IntegerField(default=None, null=True)
     last_update = models.DateTimeField(auto_now=True)
 
-    def save(self, *args, **kwargs):
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['scrape_date', 'age_group'], name='unique_statewideagedate_scrape_date_age_group'),
+        ]
 
+    def set_age_range(self):
         split_ages = self.age_group.replace(' years', '').split('-')
 
         if self.age_group == '100+ years':
@@ -54,6 +86,9 @@ class StatewideAgeDate(models.Model):
         elif len(split_ages) == 2:
             self.age_min = split_ages[0]
             self.age_max = split_ages[1]
+
+    def save(self, *args, **kwargs):
+        self.set_age_range()
         super(StatewideAgeDate, self).save(*args, **kwargs)
 
 
@@ -65,11 +100,26 @@ class StatewideRaceDate(models.Model):
     bool_ethnicity_paired = models.BooleanField(default=True)
     last_update = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['data_date', 'race_eth'], name='unique_statewideracedate_data_date_race_eth'),
+        ]
+
     def __str__ (self):
         return '{}: {}'.format(self.data_date, self.race_eth)
 
 
-class StatewideCasesBySampleDate(models.Model):
+class TimeseriesVersion(models.Model):
+    '''A timeseries saved either as whole-table snapshots, one per scrape_date, or as versions (settings.VERSIONED_TIMESERIES). Snapshot rows leave valid_from/valid_to None. A version is valid from the first scrape_date with its values until valid_to, the scrape_date it was replaced, or None while it's still current. Its update_date is MDH's from when the values first appeared, and confirmed_update_date MDH's latest one that still had them.'''
+    valid_from = models.DateField(null=True, db_index=True)
+    valid_to = models.DateField(null=True, db_index=True)
+    confirmed_update_date = models.DateField(null=True)
+
+    class Meta:
+        abstract = True
+
+
+class StatewideCasesBySampleDate(TimeseriesVersion):
     '''used for timeseries and charts'''
     sample_date = models.DateField(null=True, db_index=True)
     new_cases = models.IntegerField(default=0, null=True)
@@ -85,7 +135,7 @@ class StatewideCasesBySampleDate(models.Model):
     scrape_date = models.DateField(db_index=True)
 
 
-class StatewideHospitalizationsDate(models.Model):
+class StatewideHospitalizationsDate(TimeseriesVersion):
     reported_date = models.DateField(null=True, db_index=True)
     new_hosp_admissions = models.IntegerField(default=0, null=True)
     # new_non_icu_admissions_rolling = models.FloatField(default=0, null=True)
@@ -97,7 +147,7 @@ class StatewideHospitalizationsDate(models.Model):
     scrape_date = models.DateField(db_index=True)
 
 
-class StatewideDeathsDate(models.Model):
+class StatewideDeathsDate(TimeseriesVersion):
     reported_date = models.DateField(null=True, db_index=True)
     new_deaths = models.IntegerField(default=0, null=True)
     new_deaths_rolling = models.FloatField(default=0, null=True)  # No longer calculated at DB level
@@ -106,7 +156,7 @@ class StatewideDeathsDate(models.Model):
     scrape_date = models.DateField(db_index=True)
 
 
-class StatewideTestsDate(models.Model):
+class StatewideTestsDate(TimeseriesVersion):
     '''used for timeseries and charts'''
     reported_date = models.DateField(null=True, db_index=True)
     new_state_tests = models.IntegerField(default=0, null=True)
@@ -155,6 +205,11 @@ class StatewideTotalDate(models.Model):
     scrape_date = models.DateField(db_index=True)
     last_update = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['scrape_date'], name='unique_statewidetotaldate_scrape_date'),
+        ]
+
     def backfill_new_deaths(self):
         if self.new_deaths == 0:
             try:
@@ -187,6 +242,11 @@ class CountyTestDate(models.Model):
 
     last_scrape = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['county', 'scrape_date'], name='unique_countytestdate_county_scrape_date'),
+        ]
+
     def __str__(self):
         return '{} {}: {}'.format(self.county.name, self.scrape_date, self.daily_total_cases)
 
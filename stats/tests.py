@@ -1,3 +1,75 @@
+import datetime
+
 from django.test import TestCase
 
-# Create your tests here.
+from stats.models import StatewideAgeDate, StatewideDeathsDate
+from stats.utils import upsert_rows, write_timeseries_versions, timeseries_as_of
+
+
+def date(day):
+    return datetime.date(2020, 11, day)
+
+
+class TimeseriesVersionsTest(TestCase):
+    def scrape(self, scrape_day, deaths):
+        ''' One scrape's deaths timeseries, {reported day: new deaths}, written as versions '''
+        objs = [StatewideDeathsDate(reported_date=date(day), new_deaths=n, total_deaths=n, update_date=date(scrape_day)) for day, n in deaths.items()]
+        return write_timeseries_versions(StatewideDeathsDate, objs, 'reported_date', date(scrape_day))
+
+    def as_of(self, scrape_day=None):
+        return {r.reported_date.day: (r.new_deaths, r.update_date.day, r.confirmed_update_date.day) for r in timeseries_as_of(StatewideDeathsDate, date(scrape_day) if scrape_day else None)}
+
+    def test_round_trip(self):
+        self.assertEqual(self.scrape(10, {1: 1, 2: 2, 3: 3}), (3, 0))
+        self.assertEqual(self.scrape(11, {1: 1, 2: 5, 3: 3}), (1, 1))  # Revised
+        self.assertEqual(self.scrape(12, {1: 1, 2: 5}), (0, 1))  # Dropped
+        self.assertEqual(StatewideDeathsDate.objects.count(), 4)
+
+        self.assertEqual(self.as_of(10), {1: (1, 10, 12), 2: (2, 10, 10), 3: (3, 10, 11)})
+        self.assertEqual(self.as_of(11), {1: (1, 10, 12), 2: (5, 11, 12), 3: (3, 10, 11)})
+        self.assertEqual(self.as_of(12), {1: (1, 10, 12), 2: (5, 11, 12)})
+        self.assertEqual(self.as_of(), self.as_of(12))
+
+        # Running the same day again replaces what it wrote, including bringing back the dropped date
+        self.assertEqual(self.scrape(12, {1: 1, 2: 5, 3: 4}), (1, 1))
+        self.assertEqual(StatewideDeathsDate.objects.count(), 5)
+        self.assertEqual(self.as_of(11), {1: (1, 10, 12), 2: (5, 11, 12), 3: (3, 10, 11)})
+        self.assertEqual(self.as_of(12), {1: (1, 10, 12), 2: (5, 11, 12), 3: (4, 12, 12)})
+
+    def test_snapshots_win_on_their_scrape_date(self):
+        self.scrape(10, {1: 1})
+        StatewideDeathsDate.objects.create(reported_date=date(1), new_deaths=7, total_deaths=7, update_date=date(11), scrape_date=date(11))
+        self.assertEqual([r.new_deaths for r in timeseries_as_of(StatewideDeathsDate, date(11))], [7])
+        self.assertEqual([r.new_deaths for r in timeseries_as_of(StatewideDeathsDate, date(10))], [1])
+
+    def test_duplicate_dates_rejected(self):
+        objs = [StatewideDeathsDate(reported_date=date(1), new_deaths=n, update_date=date(10)) for n in [1, 2]]
+        with self.assertRaises(ValueError):
+            write_timeseries_versions(StatewideDeathsDate, objs, 'reported_date', date(10))
+
+
+class UpsertRowsTest(TestCase):
+    UNIQUE_FIELDS = ['scrape_date', 'age_group']
+    UPDATE_FIELDS = ['case_count', 'death_count', 'last_update']
+
+    def observations(self, counts):
+        return [StatewideAgeDate(scrape_date=date(10), age_group=age_group, case_count=cases, death_count=0) for age_group, cases in counts.items()]
+
+    def test_rerun_updates_in_place(self):
+        upsert_rows(StatewideAgeDate, self.observations({'0-4 years': 10, '5-9 years': 20}), self.UNIQUE_FIELDS, self.UPDATE_FIELDS)
+        ids = dict(StatewideAgeDate.objects.values_list('age_group', 'id'))
+
+        upsert_rows(StatewideAgeDate, self.observations({'0-4 years': 11, '5-9 years': 20, '10-14 years': 30}), self.UNIQUE_FIELDS, self.UPDATE_FIELDS)
+        self.assertEqual(StatewideAgeDate.objects.count(), 3)
+        self.assertEqual(dict(StatewideAgeDate.objects.values_list('age_group', 'case_count')), {'0-4 years': 11, '5-9 years': 20, '10-14 years': 30})
+        self.assertEqual({k: v for k, v in StatewideAgeDate.objects.values_list('age_group', 'id') if k in ids}, ids)
+
+    def test_small_batches(self):
+        counts = {'{}-{} years'.format(n, n + 4): n for n in range(0, 100, 5)}
+        for _ in range(2):
+            upsert_rows(StatewideAgeDate, self.observations(counts), self.UNIQUE_FIELDS, self.UPDATE_FIELDS, batch_size=3)
+        self.assertEqual(StatewideAgeDate.objects.count(), len(counts))
+
+    def test_unknown_field(self):
+        with self.assertRaises(ValueError):
+            upsert_rows(StatewideAgeDate, self.observations({'0-4 years': 1}), self.UNIQUE_FIELDS, ['not_a_field'])
@@ -1,22 +1,195 @@
+import os
 import re
 import datetime
 import json
+import gzip
 import math
+import hashlib
+import sqlite3
+import itertools
+import threading
+import time
+import boto3
 import requests
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from functools import cached_property
+from urllib.parse import quote
+import lxml.html
+import numpy as np
+import pandas as pd
+from bs4 import BeautifulSoup, SoupStrainer, UnicodeDammit
+from bs4.builder._htmlparser import HTMLParserTreeBuilder
 
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections, router, transaction
+from django.db.models import Max, Q
+from django.core.management.base import CommandError
+
+SITUATION_PAGE_URL = 'https://www.health.state.mn.us/diseases/coronavirus/situation.html'
+SNAPSHOT_MISMATCH_RETURNCODE = 3
+
+
+class SnapshotMismatchError(CommandError):
+    ''' A stage would read a different page than the one snapshotted at the start of the run. Exits with its own return code so the entrypoint can stop the run. '''
+    def __init__(self, *args):
+        super().__init__(*args, returncode=SNAPSHOT_MISMATCH_RETURNCODE)
+
+
+class PageUnchanged:
+    ''' Returned by get_situation_page_content(conditional=True) when the page is the same one the last run processed '''
+    def __repr__(self):
+        return 'PAGE_UNCHANGED'
+
+PAGE_UNCHANGED = PageUnchanged()
+
+
+def get_situation_page_content(url_override=False, snapshot=None, snapshot_hash=None, conditional=False):
+    ''' With conditional=True, send the validators saved from the last processed page and return PAGE_UNCHANGED on a 304 or an identical body '''
+    if snapshot:
+        return read_situation_page_snapshot(snapshot, snapshot_hash)
 
-def get_situation_page_content(url_override=False):
     headers = {'user-agent': 'Michael Corey, Star Tribune, michael.corey@startribune.com'}
+    if conditional:
+        state = load_situation_page_state()
+        if state['processed'].get('etag'):
+            headers['If-None-Match'] = state['processed']['etag']
+        if state['processed'].get('last_modified'):
+            headers['If-Modified-Since'] = state['processed']['last_modified']
+
     if url_override:
         r = requests.get(url_override, headers=headers)
     else:
-        r = requests.get('https://www.health.state.mn.us/diseases/coronavirus/situation.html', headers=headers)
+        r = requests.get(SITUATION_PAGE_URL, headers=headers)
+
+    if conditional and r.status_code == requests.codes.not_modified:
+        return PAGE_UNCHANGED
     if r.status_code == requests.codes.ok:
+        if conditional:
+            sha256 = content_hash(r.content)
+            if sha256 == state['processed'].get('sha256'):
+                return PAGE_UNCHANGED
+
+            # Hold on to the validators until a run actually finishes processing this page
+            state['fetched'] = {
+                'sha256': sha256,
+                'etag': r.headers.get('ETag'),
+                'last_modified': r.headers.get('Last-Modified'),
+            }
+            save_situation_page_state(state)
         return r.content
     else:
         return False
 
+def load_situation_page_state():
+    try:
+        with open(settings.SITUATION_PAGE_STATE_PATH) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'processed': {}, 'fetched': {}}
+
+def save_situation_page_state(state):
+    with open(settings.SITUATION_PAGE_STATE_PATH + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(settings.SITUATION_PAGE_STATE_PATH + '.tmp', settings.SITUATION_PAGE_STATE_PATH)
+
+def mark_situation_page_processed(html):
+    ''' Record this page as the last one processed, so conditional fetches of the same page short-circuit '''
+    sha256 = content_hash(html)
+    state = load_situation_page_state()
+    if state['fetched'].get('sha256') == sha256:
+        state['processed'] = state['fetched']
+    else:
+        state['processed'] = {'sha256': sha256}
+    save_situation_page_state(state)
+
+def content_hash(content):
+    return hashlib.sha256(content).hexdigest()
+
+def write_situation_page_snapshot(html, path):
+    ''' Save one copy of the page for the whole run, with a sidecar .json holding its SHA-256. Returns the hash. '''
+    sha256 = content_hash(html)
+    meta = {
+        'sha256': sha256,
+        'fetched_at': datetime.datetime.now().isoformat(),
+    }
+
+    # Write to a temp file and rename so a stage never sees a half-written snapshot
+    with open(path + '.tmp', 'wb') as f:
+        f.write(html)
+    os.replace(path + '.tmp', path)
+    with open(path + '.json', 'w') as f:
+        json.dump(meta, f)
+
+    return sha256
+
+def read_situation_page_snapshot(path, expected_hash=None):
+    ''' Read a snapshot written by write_situation_page_snapshot, refusing it if the bytes don't match the recorded hash (or the hash this run started with) '''
+    with open(path, 'rb') as f:
+        html = f.read()
+    with open(path + '.json') as f:
+        meta = json.load(f)
+
+    sha256 = content_hash(html)
+    if sha256 != meta['sha256']:
+        raise SnapshotMismatchError('Snapshot {} has hash {} but was recorded as {}'.format(path, sha256, meta['sha256']))
+    if expected_hash and sha256 != expected_hash:
+        raise SnapshotMismatchError('Snapshot {} has hash {} but this run started with {}'.format(path, sha256, expected_hash))
+
+    return html
+
+def add_snapshot_arguments(parser):
+    parser.add_argument('--snapshot', help='Read the situation page from a snapshot written by snapshot_situation_page instead of downloading it')
+    parser.add_argument('--snapshot-hash', help='Refuse to run if the snapshot does not have this SHA-256')
+
+HTML_PARSER_BACKENDS = ['html.parser', 'lxml', 'selectolax']
+
+
+class SelectolaxTreeBuilder(HTMLParserTreeBuilder):
+    ''' Lets BeautifulSoup use selectolax's lexbor parser. Decoding is inherited from the html.parser builder, then the lexbor tree is replayed into the soup. '''
+    NAME = 'selectolax'
+    features = [NAME]
+
+    def feed(self, markup):
+        try:
+            from selectolax.lexbor import LexborHTMLParser
+        except ImportError:
+            raise ImproperlyConfigured('HTML_PARSER_BACKEND is selectolax but selectolax is not installed')
+
+        soup = self.soup
+        node = LexborHTMLParser(markup).root
+        depth = 0
+        while node is not None:
+            tag = node.tag
+            if tag == '-text':
+                soup.handle_data(node.text(deep=False))
+            elif tag[0] not in '-_!':  # Skip comments and doctypes
+                soup.handle_starttag(tag, None, None, {k: v or '' for k, v in node.attributes.items()})
+                if node.child is not None:
+                    node = node.child
+                    depth += 1
+                    continue
+                soup.handle_endtag(tag)
+
+            # Done with this node, so move to its next sibling, closing parents as we run out
+            while node.next is None and depth > 0:
+                node = node.parent
+                depth -= 1
+                soup.handle_endtag(node.tag)
+            node = node.next if depth > 0 else None
+
+
+def make_soup(html, parser=None, parse_only=None):
+    ''' BeautifulSoup with the backend from settings.HTML_PARSER_BACKEND (or the one passed in) '''
+    parser = parser or settings.HTML_PARSER_BACKEND
+    if parser not in HTML_PARSER_BACKENDS:
+        raise ImproperlyConfigured('Unknown HTML parser backend {}. Choose from {}'.format(parser, HTML_PARSER_BACKENDS))
+    if parser == 'selectolax':
+        return BeautifulSoup(html, builder=SelectolaxTreeBuilder, parse_only=parse_only)
+    return BeautifulSoup(html, parser, parse_only=parse_only)
+
 def timeseries_table_parser(table):
     ''' should work on multiple columns '''
     rows = table.find_all("tr")
@@ -37,6 +210,284 @@ def timeseries_table_parser(table):
 
     return data_rows
 
+def lxml_document(html):
+    ''' Parse the page with lxml directly, for the columnar extractors. Decoded the same way BeautifulSoup does it. '''
+    if isinstance(html, bytes):
+        html = UnicodeDammit(html, is_html=True).unicode_markup
+    return lxml.html.document_fromstring(html)
+
+def table_columns(table):
+    ''' Columnar version of timeseries_table_parser for an lxml table: returns {header: [cell text, ...]} '''
+    rows = table.iter('tr')
+    col_names = [' '.join(th.text_content().split()) for th in next(rows).iter('th')]
+    columns = [[] for c in col_names]
+    for row in rows:
+        cells = [c for c in row if c.tag in ('th', 'td')]
+        if len(cells) > 0:  # Filter out bad TRs
+            for k, column in enumerate(columns):
+                cell = cells[k]
+                column.append(cell.text_content() if len(cell) else (cell.text or ''))  # text_content() is an XPath call, and most cells are bare text
+
+    return dict(zip(col_names, columns))
+
+def parse_comma_int_series(series):
+    ''' parse_comma_int for a whole column at once. '-' placeholders (with or without trailing nbsps) and empty cells become <NA>. '''
+    stripped = series.str.strip()
+    cleaned = stripped.mask(stripped.isin(['-', ''])).str.replace('[.,]', '', regex=True)
+    return pd.to_numeric(cleaned).astype('Int64')
+
+MDH_MISSING_DATE = 'Unknown/missing'
+
+
+def parse_mdh_date_series(series):
+    ''' m/d/yy dates for a whole column at once. 'Unknown/missing' becomes None. Anything else that isn't a date raises ValueError, like parse_mdh_date() did, so a format change stops the run instead of writing null dates. '''
+    stripped = series.str.strip()
+    missing = stripped == MDH_MISSING_DATE
+    dates = pd.to_datetime(stripped.mask(missing), format='%m/%d/%y', errors='coerce')
+    unparsed = dates.isna() & ~missing
+    if unparsed.any():
+        raise ValueError('Unrecognized MDH dates: {}'.format(', '.join(sorted(set(series[unparsed].astype(str))))))
+    return dates.dt.date.where(dates.notna(), None)
+
+def table_frame(table, int_columns=[], date_columns=[]):
+    ''' A table as a DataFrame, with comma-int and date columns converted in bulk. Other columns stay as raw cell text. '''
+    return columns_frame(table_columns(table), int_columns, date_columns)
+
+def columns_frame(columns, int_columns=[], date_columns=[]):
+    ''' table_frame() for columns already pulled out by table_columns(). The int columns are stacked and converted in one pass, since most of the cost is per call, not per cell. '''
+    frame = pd.DataFrame(columns)
+    if int_columns:
+        ints = parse_comma_int_series(pd.Series(np.concatenate([frame[c].to_numpy(dtype=object) for c in int_columns]), dtype=object)).array
+        for k, c in enumerate(int_columns):
+            frame[c] = ints[k * len(frame):(k + 1) * len(frame)]
+    for c in date_columns:
+        frame[c] = parse_mdh_date_series(frame[c])
+    return frame
+
+def frame_records(frame):
+    ''' DataFrame rows as dicts of plain Python values, with None for missing, ready for model constructors '''
+    return frame.astype(object).where(frame.notna(), None).to_dict('records')
+
+TABLE_EXTRACTOR_VERSION = 1  # Bump when table_columns() or timeseries_table_parser() change their output, so cached tables get re-extracted
+_table_cache_size = None
+
+
+def table_cache_path(sha256, table_id, extractor):
+    return os.path.join(settings.TABLE_CACHE_DIR, sha256[:2], '{}.{}.{}.v{}.json.gz'.format(sha256, table_id, extractor, TABLE_EXTRACTOR_VERSION))
+
+def read_table_cache(sha256, table_id, extractor):
+    ''' Returns (hit, extracted). A table the page doesn't have is a hit with None. '''
+    if not settings.TABLE_CACHE_DIR:
+        return False, None
+    path = table_cache_path(sha256, table_id, extractor)
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            extracted = json.load(f)
+    except (OSError, EOFError, ValueError):  # Missing, or cut short by a crash
+        return False, None
+
+    os.utime(path)  # Mark as recently used
+    return True, extracted
+
+def write_table_cache(sha256, table_id, extractor, extracted):
+    global _table_cache_size
+    if not settings.TABLE_CACHE_DIR:
+        return
+    path = table_cache_path(sha256, table_id, extractor)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with gzip.open(path + '.tmp', 'wt', encoding='utf-8') as f:
+        json.dump(extracted, f)
+    os.replace(path + '.tmp', path)
+
+    if _table_cache_size is None:
+        _table_cache_size = sum(size for path, mtime, size in table_cache_entries())
+    else:
+        _table_cache_size += os.path.getsize(path)
+    if _table_cache_size > settings.TABLE_CACHE_MAX_BYTES:
+        evict_table_cache()
+
+def table_cache_entries():
+    entries = []
+    for root, dirs, files in os.walk(settings.TABLE_CACHE_DIR):
+        for filename in files:
+            path = os.path.join(root, filename)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:  # Evicted by another process
+                continue
+            entries.append((path, stat.st_mtime, stat.st_size))
+    return entries
+
+def evict_table_cache():
+    ''' Delete least recently used tables until the cache is down to 80% of TABLE_CACHE_MAX_BYTES, so we aren't evicting on every write '''
+    global _table_cache_size
+    entries = sorted(table_cache_entries(), key=lambda e: e[1])
+    _table_cache_size = sum(size for path, mtime, size in entries)
+    for path, mtime, size in entries:
+        if _table_cache_size <= settings.TABLE_CACHE_MAX_BYTES * 0.8:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        _table_cache_size -= size
+
+SITUATION_PAGE_MEMO_SIZE = 4
+_situation_pages = OrderedDict()
+
+
+class SituationPage:
+    ''' The situation page, parsed one table at a time and only when asked for. Each table's markup is cut out of the page by its id and parsed on its own, then kept. Use SituationPage.from_html() so stages handed the same page share one object. '''
+    TABLE_IDS = [
+        'casetable', 'labtable', 'hosptable', 'deathtable',
+        'hosptotal', 'casetotal', 'dailycasetotal', 'testtotal', 'deathtotal', 'noisototal',
+    ]
+
+    def __init__(self, html):
+        self.html = html
+        self.sha256 = content_hash(html)
+        self._tables = {}
+        self._soup_tables = {}
+        self._extracted = {}
+
+    @classmethod
+    def from_html(cls, html):
+        ''' One SituationPage per page hash, so every stage in a process reuses the tables already parsed '''
+        sha256 = content_hash(html)
+        if sha256 in _situation_pages:
+            _situation_pages.move_to_end(sha256)
+        else:
+            _situation_pages[sha256] = cls(html)
+            if len(_situation_pages) > SITUATION_PAGE_MEMO_SIZE:
+                _situation_pages.popitem(last=False)
+        return _situation_pages[sha256]
+
+    def __getattr__(self, name):
+        # page.casetable, page.hosptotal etc.
+        if name in self.TABLE_IDS:
+            return self.table(name)
+        raise AttributeError(name)
+
+    @cached_property
+    def text(self):
+        ''' The page decoded the same way BeautifulSoup and lxml_document do it '''
+        return UnicodeDammit(self.html, is_html=True).unicode_markup
+
+    def element_markup(self, tag_name, start):
+        ''' The markup from the <tag_name ...> at start through its matching close tag, counting nested ones '''
+        depth = 0
+        for tag in re.compile(r'<(/?){}\b'.format(tag_name), re.IGNORECASE).finditer(self.text, start):
+            depth += -1 if tag.group(1) else 1
+            if depth == 0:
+                return self.text[start:self.text.index('>', tag.end()) + 1]
+        return self.text[start:]  # Unclosed, so let the parser close it like it would in the full page
+
+    def table_markup(self, table_id):
+        ''' Just the <table>...</table> with this id, found without parsing the page. None if it isn't there. '''
+        match = re.search(r'<table\b[^>]*\bid\s*=\s*["\']?{}["\'\s/>]'.format(re.escape(table_id)), self.text, re.IGNORECASE)
+        if not match:
+            return None
+        return self.element_markup('table', match.start())
+
+    def table(self, table_id):
+        ''' A table as an lxml element, for table_frame() and friends '''
+        if table_id not in self._tables:
+            markup = self.table_markup(table_id)
+            self._tables[table_id] = lxml.html.fragment_fromstring(markup) if markup else None
+        return self._tables[table_id]
+
+    def soup_table(self, table_id):
+        ''' A table as a BeautifulSoup tag, for the parsers that still use bs4 '''
+        if table_id not in self._soup_tables:
+            markup = self.table_markup(table_id)
+            self._soup_tables[table_id] = make_soup(markup).find('table') if markup else None
+        return self._soup_tables[table_id]
+
+    def extracted(self, table_id, extractor, extract):
+        ''' Run an extractor on one table, or get its output from this object or the table cache if some stage already did '''
+        key = (table_id, extractor)
+        if key not in self._extracted:
+            hit, extracted = read_table_cache(self.sha256, table_id, extractor)
+            if not hit:
+                extracted = extract()
+                write_table_cache(self.sha256, table_id, extractor, extracted)
+            self._extracted[key] = extracted
+        return self._extracted[key]
+
+    def columns(self, table_id):
+        ''' table_columns() of a table. None if the page doesn't have it. '''
+        def extract():
+            table = self.table(table_id)
+            return table_columns(table) if table is not None else None
+        return self.extracted(table_id, 'columns', extract)
+
+    def rows(self, table_id):
+        ''' timeseries_table_parser() of a table. None if the page doesn't have it. The rows are copies, so callers can clean them up in place. '''
+        def extract():
+            table = self.soup_table(table_id)
+            return timeseries_table_parser(table) if table is not None else None
+        rows = self.extracted(table_id, 'rows', extract)
+        return [dict(row) for row in rows] if rows is not None else None
+
+    def cells(self, table_id):
+        ''' Each row's th and td cells as [tag name, text] pairs, for tables that mix header and data cells within rows. None if the page doesn't have it. '''
+        def extract():
+            table = self.soup_table(table_id)
+            if table is None:
+                return None
+            return [[[cell.name, cell.text] for cell in row.find_all(['th', 'td'])] for row in table.find_all('tr')]
+        return self.extracted(table_id, 'cells', extract)
+
+    def div_table_markup(self, div_id):
+        ''' The first <table>...</table> inside the <div> with this id, like soup.find('div', id=div_id).find('table'). None if either isn't there. '''
+        match = re.search(r'<div\b[^>]*\bid\s*=\s*["\']?{}["\'\s/>]'.format(re.escape(div_id)), self.text, re.IGNORECASE)
+        if not match:
+            return None
+        table = re.search(r'<table\b', self.element_markup('div', match.start()), re.IGNORECASE)
+        if not table:
+            return None
+        return self.element_markup('table', match.start() + table.start())
+
+    def div_rows(self, div_id):
+        ''' timeseries_table_parser() of the first table in a <div>, for older pages where the table has no id. None if there isn't one. '''
+        def extract():
+            markup = self.div_table_markup(div_id)
+            return timeseries_table_parser(make_soup(markup).find('table')) if markup else None
+        rows = self.extracted('div-' + div_id, 'rows', extract)
+        return [dict(row) for row in rows] if rows is not None else None
+
+    def frame(self, table_id, int_columns=[], date_columns=[]):
+        ''' table_frame() of a table, from cached columns when there are some '''
+        return columns_frame(self.columns(table_id), int_columns, date_columns)
+
+    @cached_property
+    def soup(self):
+        ''' The whole page as BeautifulSoup, for code that searches by text rather than table id '''
+        return make_soup(self.html)
+
+    @cached_property
+    def uls(self):
+        ''' Every <ul> on the page (nested ones too, like find_all), parsed without the rest of the page '''
+        fragments = []
+        end = 0
+        for match in re.finditer(r'<ul\b', self.text, re.IGNORECASE):
+            if match.start() >= end:  # Nested lists come along with their parent
+                fragments.append(self.element_markup('ul', match.start()))
+                end = match.start() + len(fragments[-1])
+        return make_soup(''.join(fragments)).find_all('ul')
+
+    @cached_property
+    def update_date(self):
+        return get_update_date(self.html)
+
+    def updated_today(self, manual_override=False):
+        ''' Same as updated_today(soup), which also fails if the page has no "Updated <date>" stamp '''
+        if self.update_date is None:
+            slack_latest("WARNING: Scraper error. Can't find the situation page's update date. Not proceeding.", '#robot-dojo')
+            raise ValueError('No "Updated <date>" stamp on the situation page')
+        return manual_override or self.update_date == datetime.datetime.now().date(), self.update_date
+
+
 def parse_comma_int(input_str):
     ''' Warning: Only run on fields you know will be integers. It currently replaces periods because sometimes MDH puts one in by mistake '''
     if input_str.strip() == '-':
@@ -58,6 +509,23 @@ def updated_today(soup, manual_override=False):
 
     return bool_updated, update_date
 
+UPDATE_DATE_RE = re.compile(r'Updated ([A-z]+ \d{1,2}, \d{4})')
+UPDATE_DATE_STRONG_RE = re.compile(rb'<(?i:strong)\b[^>]*>[^<]*Updated ([A-z]+ \d{1,2}, \d{4})')
+
+
+def get_update_date(html):
+    ''' The "Updated <date>" stamp in a <strong>, like updated_today() reads it. Found with a regex on the page bytes when the stamp is plain text in its tag, otherwise from the text of each <strong>. Other "Updated ..." text on the page is ignored. '''
+    match = UPDATE_DATE_STRONG_RE.search(html)
+    if match:
+        return datetime.datetime.strptime(match.group(1).decode('utf-8'), '%B %d, %Y').date()
+
+    # Stamp is broken up by markup or entities, so check each <strong> on its own
+    for strong in make_soup(html, parse_only=SoupStrainer('strong')).find_all('strong'):
+        match = UPDATE_DATE_RE.search(' '.join(strong.get_text().split()))
+        if match:
+            return datetime.datetime.strptime(match.group(1), '%B %d, %Y').date()
+    return None
+
 def slack_latest(text, channel):
     MAX_BLOCK_LENGTH = 3000
 
@@ -119,16 +587,19 @@ def slack_latest(text, channel):
         print(r.text)
 
 #### Things for reading cached HTML stored on S3 ####
-def get_matching_s3_cached_html(bucket, prefix, s3):
+def get_matching_s3_cached_html(bucket, prefix, s3, start_after=None):
+    ''' With start_after, only keys that sort after it, which for situation_<date>_<time>.html means pages archived since '''
     keys = []
 
     kwargs = {
         'Bucket': bucket,
         'Prefix': '{}/html/situation'.format(prefix)
     }
+    if start_after:
+        kwargs['StartAfter'] = start_after
     while True:
         resp = s3.list_objects_v2(**kwargs)
-        for obj in resp['Contents']:
+        for obj in resp.get('Contents', []):
             keys.append(obj['Key'])
 
         try:
@@ -169,3 +640,572 @@ def find_filename_date_matchs(matching_files, hour=None, slice='first'):
 def get_s3_file_contents(key, bucket, s3):
     response = s3.get_object(Bucket=bucket, Key=key['key'])
     return response['Body'].read()
+
+
+ARCHIVE_POINTER_SUFFIX = '.ptr'
+ARCHIVE_ZSTD_LEVEL = 19
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+def compress_payload(body, dictionary=None):
+    ''' zstd, with the trained dictionary if there is one, or gzip if zstandard isn't installed. Both are recognized by their magic bytes when read back, and zstd frames carry their dictionary's id. '''
+    try:
+        import zstandard
+    except ImportError:
+        return gzip.compress(body, mtime=0)
+    dict_data = zstandard.ZstdCompressionDict(dictionary) if dictionary else None
+    return zstandard.ZstdCompressor(level=ARCHIVE_ZSTD_LEVEL, dict_data=dict_data).compress(body)
+
+def zstd_dictionary_id(data):
+    ''' The dictionary id of a zstd frame or dictionary, 0 for none '''
+    import zstandard
+    if data.startswith(ZSTD_MAGIC):
+        return zstandard.get_frame_parameters(data).dict_id
+    return zstandard.ZstdCompressionDict(data).dict_id()
+
+def decompress_payload(data, get_dictionary):
+    ''' Undo compress_payload(). get_dictionary(dict_id) returns a zstd dictionary's bytes. Anything else is returned as is. '''
+    if data.startswith(GZIP_MAGIC):
+        return gzip.decompress(data)
+    if data.startswith(ZSTD_MAGIC):
+        try:
+            import zstandard
+        except ImportError:
+            raise ImproperlyConfigured('The archive has zstd-compressed payloads but zstandard is not installed')
+        dict_id = zstd_dictionary_id(data)
+        dict_data = zstandard.ZstdCompressionDict(get_dictionary(dict_id)) if dict_id else None
+        return zstandard.ZstdDecompressor(dict_data=dict_data).decompress(data)
+    return data
+
+
+class HtmlArchiveBackend:
+    ''' Where archived payloads live. Each situation_<date>_<time>.html (or cdc_vac_<date>_<time>.json) is either the raw file, as archived before archive_raw_payloads, or a pointer (key + '.ptr') naming a compressed object stored once per SHA-256 under <prefix>/html/objects/. Subclasses provide list_stored(), get(), exists() and put(). '''
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.pointer_keys = set()
+        self.dictionaries = {}
+
+    def object_key(self, sha256):
+        return '{}/html/objects/{}/{}'.format(self.prefix, sha256[:2], sha256)
+
+    def dictionary_key(self, dict_id):
+        return '{}/html/dictionaries/{}.zdict'.format(self.prefix, dict_id)
+
+    def payload_key(self, name, timestamp, extension):
+        return '{}/html/{}_{}.{}'.format(self.prefix, name, timestamp, extension)
+
+    def list_keys(self, start_after=None):
+        ''' Archived situation page keys in order, with pointers listed under the key they stand for '''
+        keys = set()
+        for key in self.list_stored(start_after):
+            if key.endswith(ARCHIVE_POINTER_SUFFIX):
+                key = key[:-len(ARCHIVE_POINTER_SUFFIX)]
+                self.pointer_keys.add(key)
+            if not start_after or key > start_after:
+                keys.add(key)
+        return sorted(keys)
+
+    def get_dictionary(self, dict_id):
+        if dict_id not in self.dictionaries:
+            dictionary = self.get(self.dictionary_key(dict_id))
+            if dictionary is None:
+                raise FileNotFoundError('zstd dictionary {} is not in {}'.format(dict_id, self.name))
+            self.dictionaries[dict_id] = dictionary
+        return self.dictionaries[dict_id]
+
+    def read_pointer(self, key):
+        pointer = self.get(key + ARCHIVE_POINTER_SUFFIX)
+        if pointer is None:
+            return None
+        pointer = json.loads(pointer)
+        body = decompress_payload(self.get(pointer['object']), self.get_dictionary)
+        if content_hash(body) != pointer['sha256']:
+            raise ValueError('Archived object {} does not match the hash in {}'.format(pointer['object'], key + ARCHIVE_POINTER_SUFFIX))
+        return body
+
+    def read(self, key):
+        ''' The original bytes archived under key, following its pointer if it has one '''
+        body = self.read_pointer(key) if key in self.pointer_keys else self.get(key)
+        if body is None and key not in self.pointer_keys:  # Not listed since this backend was made
+            body = self.read_pointer(key)
+        if body is None:
+            raise FileNotFoundError('{} is not in {}'.format(key, self.name))
+        return body
+
+    def archive(self, key, body, dictionary=None):
+        ''' Point key at body, storing body compressed if no earlier payload had the same bytes. Returns (sha256, True if the content was new). '''
+        sha256 = content_hash(body)
+        new = not self.exists(self.object_key(sha256))
+        if new:
+            if dictionary:
+                dict_key = self.dictionary_key(zstd_dictionary_id(dictionary))
+                if not self.exists(dict_key):
+                    self.put(dict_key, dictionary, 'application/octet-stream')
+            self.put(self.object_key(sha256), compress_payload(body, dictionary), 'application/octet-stream')
+        self.point(key, sha256)
+        return sha256, new
+
+    def point(self, key, sha256):
+        ''' Write key's pointer to an object already in the archive. Returns False if there's no such object. '''
+        if not self.exists(self.object_key(sha256)):
+            return False
+        pointer = {'object': self.object_key(sha256), 'sha256': sha256}
+        self.put(key + ARCHIVE_POINTER_SUFFIX, json.dumps(pointer).encode('utf-8'), 'application/json')
+        self.pointer_keys.add(key)
+        return True
+
+
+class S3HtmlArchive(HtmlArchiveBackend):
+    ''' Archived situation pages in S3 '''
+    def __init__(self, bucket, prefix):
+        super().__init__(prefix)
+        session = boto3.Session(
+            aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
+            aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
+        )
+        self.s3 = session.client('s3')  # Clients can be shared between threads, sessions can't
+        self.bucket = bucket
+        self.name = 's3://{}/{}'.format(bucket, prefix)
+
+    def list_stored(self, start_after=None):
+        return get_matching_s3_cached_html(self.bucket, self.prefix, self.s3, start_after)
+
+    def get(self, key):
+        try:
+            return get_s3_file_contents({'key': key}, self.bucket, self.s3)
+        except self.s3.exceptions.NoSuchKey:
+            return None
+
+    def exists(self, key):
+        resp = self.s3.list_objects_v2(Bucket=self.bucket, Prefix=key, MaxKeys=1)
+        return any(obj['Key'] == key for obj in resp.get('Contents', []))
+
+    def put(self, key, body, content_type):
+        self.s3.put_object(Bucket=self.bucket, Key=key, Body=body, ContentType=content_type, ACL='public-read')
+
+
+class LocalHtmlArchive(HtmlArchiveBackend):
+    ''' A directory standing in for the S3 archive, either a copy of the bucket (<prefix>/html/situation_*.html) or just a folder of situation_*.html files '''
+    def __init__(self, root, prefix):
+        super().__init__(prefix)
+        self.root = root
+        self.name = 'file://{}/{}'.format(os.path.abspath(root), prefix)
+
+    def list_stored(self, start_after=None):
+        keys = []
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename.startswith('situation') and filename.endswith(('.html', '.html' + ARCHIVE_POINTER_SUFFIX)):
+                    keys.append(os.path.relpath(os.path.join(dirpath, filename), self.root).replace(os.sep, '/'))
+
+        bucket_layout = [k for k in keys if k.startswith('{}/html/situation'.format(self.prefix))]
+        return sorted(k for k in bucket_layout or keys if not start_after or k > start_after)
+
+    def get(self, key):
+        try:
+            with open(os.path.join(self.root, key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def exists(self, key):
+        return os.path.exists(os.path.join(self.root, key))
+
+    def put(self, key, body, content_type):
+        path = os.path.join(self.root, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(body)
+        os.replace(path + '.tmp', path)
+
+
+class HtmlArchiveReader:
+    ''' Reads archived pages with a pool of threads, keeping a local mirror so nothing is downloaded twice. The mirror stores each page once under its SHA-256 (objects/), with a pointer file per archive key (keys/). '''
+    def __init__(self, backend, mirror_dir=None, max_workers=None):
+        self.backend = backend
+        self.mirror_dir = mirror_dir if mirror_dir is not None else settings.HTML_ARCHIVE_MIRROR_DIR
+        self.max_workers = max_workers or settings.HTML_ARCHIVE_WORKERS
+        self.name = backend.name
+
+    def list_keys(self, start_after=None):
+        return self.backend.list_keys(start_after)
+
+    def mirror_key_path(self, key):
+        return os.path.join(self.mirror_dir, 'keys', quote(key, safe=''))
+
+    def mirror_object_path(self, sha256):
+        return os.path.join(self.mirror_dir, 'objects', sha256[:2], sha256)
+
+    def read_mirror(self, key):
+        try:
+            with open(self.mirror_key_path(key)) as f:
+                sha256 = f.read().strip()
+            with open(self.mirror_object_path(sha256), 'rb') as f:
+                html = f.read()
+        except FileNotFoundError:
+            return None
+        if content_hash(html) != sha256:  # Cut short somehow, so download it again
+            return None
+        return html
+
+    def write_mirror(self, key, html):
+        sha256 = content_hash(html)
+        object_path = self.mirror_object_path(sha256)
+        key_path = self.mirror_key_path(key)
+        tmp_suffix = '.{}.tmp'.format(threading.get_ident())
+
+        if not os.path.exists(object_path):
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            with open(object_path + tmp_suffix, 'wb') as f:
+                f.write(html)
+            os.replace(object_path + tmp_suffix, object_path)
+
+        os.makedirs(os.path.dirname(key_path), exist_ok=True)
+        with open(key_path + tmp_suffix, 'w') as f:
+            f.write(sha256)
+        os.replace(key_path + tmp_suffix, key_path)
+
+    def read(self, key):
+        ''' One page's bytes, from the mirror if it's there '''
+        html = self.read_mirror(key) if self.mirror_dir else None
+        if html is None:
+            html = self.backend.read(key)
+            if self.mirror_dir:
+                self.write_mirror(key, html)
+        return html
+
+    def prefetch(self, files, in_order=False):
+        ''' Yield (scrape_date, html) for each of find_filename_date_matchs()'s files as its download finishes, or in the order given if in_order. Only a couple of batches are downloaded ahead of the caller, so the whole archive isn't held in memory. '''
+        files = iter(files)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            pending = {}
+            queue = deque()
+
+            def submit(n):
+                for f in itertools.islice(files, n):
+                    future = pool.submit(self.read, f['key'])
+                    pending[future] = f['scrape_date']
+                    if in_order:
+                        queue.append(future)
+
+            submit(self.max_workers * 2)
+            while pending:
+                if in_order:
+                    done = [queue.popleft()]
+                else:
+                    done, not_done = wait(pending, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    scrape_date = pending.pop(future)
+                    submit(1)
+                    yield scrape_date, future.result()
+
+
+ARCHIVE_KEY_RE = re.compile(r'(\d{4}-\d{2}-\d{2})_(\d{2})(\d{2})\.html$')
+ARCHIVE_TABLE_ID_RE = re.compile(rb'<table\b[^>]*\bid\s*=\s*["\']?([\w-]+)', re.IGNORECASE)
+
+
+class ArchiveIndex:
+    ''' SQLite index of archived situation pages: one row per page with its scrape time, size, hash, MDH "Updated" date and table ids, so backfills can pick pages without listing and regexing the whole archive. update() adds pages archived since the last update. '''
+    def __init__(self, path=None):
+        self.db = sqlite3.connect(path or settings.HTML_ARCHIVE_INDEX_PATH)
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS pages (
+                archive TEXT NOT NULL,
+                key TEXT NOT NULL,
+                scrape_date TEXT NOT NULL,
+                scrape_hour INTEGER NOT NULL,
+                scrape_datetime TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                sha256 TEXT NOT NULL,
+                update_date TEXT,
+                table_ids TEXT NOT NULL,
+                PRIMARY KEY (archive, key)
+            );
+            CREATE INDEX IF NOT EXISTS pages_by_day ON pages (archive, scrape_date, key);
+            CREATE INDEX IF NOT EXISTS pages_by_hour ON pages (archive, scrape_hour, scrape_date, key);
+            CREATE INDEX IF NOT EXISTS pages_by_update_date ON pages (archive, update_date, key);
+        ''')
+
+    def add(self, archive_name, key, html):
+        ''' Index one page. Keys that aren't situation_<date>_<time>.html are ignored, like find_filename_date_matchs() does. '''
+        match = ARCHIVE_KEY_RE.search(key)
+        if not match:
+            return False
+        scrape_date, hour, minute = match.groups()
+        update_date = get_update_date(html)
+        table_ids = sorted(set(t.decode('utf-8', 'replace') for t in ARCHIVE_TABLE_ID_RE.findall(html)))
+        self.db.execute(
+            'INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (archive_name, key, scrape_date, int(hour), '{} {}:{}'.format(scrape_date, hour, minute), len(html), content_hash(html), update_date.isoformat() if update_date else None, json.dumps(table_ids))
+        )
+        return True
+
+    def last_key(self, archive_name):
+        return self.db.execute('SELECT MAX(key) FROM pages WHERE archive = ?', (archive_name,)).fetchone()[0]
+
+    def update(self, reader, full=False):
+        ''' Index pages archived since the last update, reading them through the reader's mirror. full relists the whole archive, to catch pages uploaded out of order. '''
+        if full:
+            indexed = set(k for k, in self.db.execute('SELECT key FROM pages WHERE archive = ?', (reader.name,)))
+            new_keys = [k for k in reader.list_keys() if k not in indexed]
+        else:
+            new_keys = reader.list_keys(start_after=self.last_key(reader.name))
+        new_files = [{'key': k, 'scrape_date': k} for k in new_keys if ARCHIVE_KEY_RE.search(k)]
+
+        for n, (key, html) in enumerate(reader.prefetch(new_files, in_order=True)):
+            self.add(reader.name, key, html)
+            if n % 100 == 99:
+                self.db.commit()  # Keep progress if a long first build dies
+        self.db.commit()
+        return len(new_files)
+
+    def pages(self, archive_name, group_by='day', hour=None, slice='last'):
+        ''' The first or last page per day, per hour of each day, per day within one hour (like find_filename_date_matchs(hour=...)), or per MDH update date. group_by is 'day', 'hour' or 'update_date'. Returns dicts with key, scrape_date, update_date and the rest of the row, in scrape order. '''
+        # SQLite fills the other columns from the row holding the MIN()/MAX(), and keys sort in scrape order
+        columns = '{}(key), scrape_date, update_date, scrape_datetime, size, sha256, table_ids'.format('MIN' if slice == 'first' else 'MAX')
+        if group_by == 'update_date':
+            rows = self.db.execute('SELECT {} FROM pages WHERE archive = ? AND update_date IS NOT NULL GROUP BY update_date ORDER BY 1'.format(columns), (archive_name,))
+        elif group_by == 'hour':
+            rows = self.db.execute('SELECT {} FROM pages WHERE archive = ? GROUP BY scrape_date, scrape_hour ORDER BY 1'.format(columns), (archive_name,))
+        elif hour is not None:
+            rows = self.db.execute('SELECT {} FROM pages WHERE archive = ? AND scrape_hour = ? GROUP BY scrape_date ORDER BY 1'.format(columns), (archive_name, hour))
+        else:
+            rows = self.db.execute('SELECT {} FROM pages WHERE archive = ? GROUP BY scrape_date ORDER BY 1'.format(columns), (archive_name,))
+
+        return [{
+            'key': key,
+            'scrape_date': datetime.datetime.strptime(scrape_date, '%Y-%m-%d').date(),
+            'update_date': datetime.datetime.strptime(update_date, '%Y-%m-%d').date() if update_date else None,
+            'scrape_datetime': datetime.datetime.strptime(scrape_datetime, '%Y-%m-%d %H:%M'),
+            'size': size,
+            'sha256': sha256,
+            'table_ids': json.loads(table_ids),
+        } for key, scrape_date, update_date, scrape_datetime, size, sha256, table_ids in rows]
+
+    def close(self):
+        self.db.close()
+
+
+def html_archive_backend(bucket, prefix, archive_dir=None):
+    ''' The archive in S3, or in a local directory if one is given or set in HTML_ARCHIVE_LOCAL_DIR '''
+    archive_dir = archive_dir or settings.HTML_ARCHIVE_LOCAL_DIR
+    if archive_dir:
+        return LocalHtmlArchive(archive_dir, prefix)
+    return S3HtmlArchive(bucket, prefix)
+
+def html_archive(bucket, prefix, archive_dir=None, workers=None):
+    ''' HtmlArchiveReader over S3, or over a local directory if one is given or set in HTML_ARCHIVE_LOCAL_DIR '''
+    return HtmlArchiveReader(html_archive_backend(bucket, prefix, archive_dir), max_workers=workers)
+
+def add_archive_arguments(parser):
+    parser.add_argument('--archive-dir', help='Read archived pages from this directory instead of S3')
+    parser.add_argument('--workers', type=int, help='Download this many pages at once (default HTML_ARCHIVE_WORKERS)')
+
+
+#### Writing exports ####
+def json_fragments(series):
+    ''' Each value of a column as JSON text, converted a column at a time '''
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        categories = [json.dumps(c, ensure_ascii=False) for c in series.cat.categories]
+        return [categories[code] if code >= 0 else 'null' for code in series.cat.codes.tolist()]
+    if pd.api.types.is_bool_dtype(series):
+        return ['true' if v else 'false' for v in series.tolist()]
+    if pd.api.types.is_integer_dtype(series):
+        return series.astype('int64').astype(str).tolist()  # Nullable ints have had their NAs dropped
+    if pd.api.types.is_float_dtype(series):
+        return [repr(v) if v == v else 'NaN' for v in series.astype('float64').tolist()]  # Same as json.dumps
+    return [json.dumps(v, ensure_ascii=False) for v in series.tolist()]
+
+def write_points_geojson(df, path, longitude='longitude', latitude='latitude', properties=None, precision=None, compact=False, chunk_size=1000):
+    ''' Write a FeatureCollection with a Point per row, streaming features to the file as they're formatted. properties picks the columns to include (default: all but the coordinates), written in sorted order like geojson.dump(sort_keys=True). precision rounds the coordinates. compact drops the spaces after separators. '''
+    if properties is None:
+        properties = [c for c in df.columns if c not in (longitude, latitude)]
+    properties = sorted(properties)
+    comma, colon = (',', ':') if compact else (', ', ': ')
+
+    coords = df[[longitude, latitude]].astype('float64')
+    if precision is not None:
+        coords = coords.round(precision)
+    lngs, lats = json_fragments(coords[longitude]), json_fragments(coords[latitude])
+    columns = [json_fragments(df[c]) for c in properties]
+    keys = [json.dumps(c, ensure_ascii=False) + colon for c in properties]
+
+    # Everything around the coordinates and properties is the same for every feature
+    head = '{{"geometry"{0}{{"coordinates"{0}['.format(colon)
+    middle = ']{0}"type"{1}"Point"}}{0}"properties"{1}{{'.format(comma, colon)
+    tail = '}}{0}"type"{1}"Feature"}}'.format(comma, colon)
+    with open(path + '.tmp', 'w', encoding='utf8') as f:
+        f.write('{{"features"{}['.format(colon))
+        for start in range(0, len(df), chunk_size):
+            features = []
+            for n in range(start, min(start + chunk_size, len(df))):
+                props = comma.join(key + column[n] for key, column in zip(keys, columns))
+                features.append(head + lngs[n] + comma + lats[n] + middle + props + tail)
+            f.write(comma if start else '')
+            f.write(comma.join(features))
+        f.write(']{}"type"{}"FeatureCollection"}}'.format(comma, colon))
+    os.replace(path + '.tmp', path)
+
+
+#### Column math for exports ####
+def round_like_python(values, ndigits):
+    ''' Round a column the way round() rounds each value. numpy rounds values * 10 ** ndigits, which can land on exactly .5 when the value itself is just under or over it, so those few are redone with round(). '''
+    values = np.asarray(values, dtype=float)
+    rounded = np.round(values, ndigits)
+    scaled = values * 10 ** ndigits
+    near_ties = np.flatnonzero(np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6)
+    rounded[near_ties] = [round(v, ndigits) for v in values[near_ties]]
+    return rounded
+
+def group_starts(keys):
+    ''' For rows sorted so each group's rows are together, the position of the first row of each row's group '''
+    keys = np.asarray(keys)
+    first = np.ones(len(keys), dtype=bool)
+    first[1:] = keys[1:] != keys[:-1]
+    return np.maximum.accumulate(np.where(first, np.arange(len(keys)), 0))
+
+def rolling_mean_by_group(values, starts, window):
+    ''' groupby().rolling(window, min_periods=1).mean() for rows sorted by group, from running sums. Blanks are skipped like pandas does. Exact for whole numbers. '''
+    values = np.asarray(values, dtype=float)
+    present = ~np.isnan(values)
+    sums = np.concatenate([[0], np.cumsum(np.where(present, values, 0))])
+    counts = np.concatenate([[0], np.cumsum(present)])
+    end = np.arange(1, len(values) + 1)
+    start = np.maximum(end - window, starts)
+    n = counts[end] - counts[start]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(n > 0, (sums[end] - sums[start]) / n, np.nan)
+
+def diff_by_group(values, starts, periods):
+    ''' groupby().diff(periods) for rows sorted by group '''
+    values = np.asarray(values, dtype=float)
+    rows = np.arange(len(values))
+    has_prior = rows - periods >= starts
+    diffs = np.full(len(values), np.nan)
+    diffs[has_prior] = values[has_prior] - values[rows[has_prior] - periods]
+    return diffs
+
+
+#### Writing to the database ####
+def upsert_rows(model, objs, unique_fields, update_fields, batch_size=None):
+    ''' Save unsaved model instances with INSERT ... ON CONFLICT (unique_fields) DO UPDATE, so a rerun on the same day overwrites update_fields on the rows already there instead of adding duplicates. New rows get every column. Needs a unique constraint on unique_fields. Skips save(), like bulk_create(). '''
+    if not objs:
+        return 0
+
+    fields = [f for f in model._meta.concrete_fields if not f.primary_key]
+    field_names = {f.name for f in fields}
+    for name in list(unique_fields) + list(update_fields):
+        if name not in field_names:
+            raise ValueError('{} has no field {}'.format(model.__name__, name))
+
+    connection = connections[router.db_for_write(model)]
+    if connection.vendor not in ('sqlite', 'postgresql'):
+        # No ON CONFLICT, so one row at a time
+        with transaction.atomic(using=connection.alias):
+            for obj in objs:
+                lookup = {name: getattr(obj, model._meta.get_field(name).attname) for name in unique_fields}
+                defaults = {name: getattr(obj, model._meta.get_field(name).attname) for name in update_fields}
+                model.objects.update_or_create(defaults=defaults, **lookup)
+        return len(objs)
+
+    qn = connection.ops.quote_name
+    columns = ', '.join(qn(f.column) for f in fields)
+    conflict = ', '.join(qn(model._meta.get_field(name).column) for name in unique_fields)
+    updates = ', '.join('{0} = EXCLUDED.{0}'.format(qn(model._meta.get_field(name).column)) for name in update_fields)
+    row_placeholder = '({})'.format(', '.join(['%s'] * len(fields)))
+
+    # SQLite builds before 3.32 allow 999 parameters a statement
+    batch_size = batch_size or max(1, 999 // len(fields))
+    with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+        for start in range(0, len(objs), batch_size):
+            batch = objs[start:start + batch_size]
+            params = []
+            for obj in batch:
+                # pre_save() fills in auto_now fields
+                params.extend(f.get_db_prep_save(f.pre_save(obj, True), connection) for f in fields)
+            cursor.execute('INSERT INTO {} ({}) VALUES {} ON CONFLICT ({}) DO {}'.format(
+                qn(model._meta.db_table), columns, ', '.join([row_placeholder] * len(batch)), conflict,
+                'UPDATE SET {}'.format(updates) if updates else 'NOTHING',
+            ), params)
+    return len(objs)
+
+@contextmanager
+def ingest_stage(name):
+    ''' Run an ingest command's writes as one transaction, so readers see all of this run's rows or none of them, and a crash partway leaves the last run's data in place '''
+    start = time.perf_counter()
+    with transaction.atomic():
+        yield
+    print('{}: writes committed in {:.2f}s'.format(name, time.perf_counter() - start))
+
+@contextmanager
+def consistent_read():
+    ''' Every query in the block sees the database as of the same moment, so a dump running alongside an ingest stage reads all of a day's rows or none. Also works as a decorator. '''
+    connection = transaction.get_connection()
+    outermost = not connection.in_atomic_block
+    with transaction.atomic():
+        if outermost and connection.vendor == 'postgresql':
+            # The default READ COMMITTED takes a new snapshot for every query. SQLite holds its read lock until the transaction ends.
+            with connection.cursor() as cursor:
+                cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY')
+        yield
+
+# Bookkeeping fields of the versioned timeseries models, left out when deciding if a row changed
+TIMESERIES_VERSION_FIELDS = ['id', 'scrape_date', 'update_date', 'valid_from', 'valid_to', 'confirmed_update_date']
+
+def write_timeseries_versions(model, objs, date_field, scrape_date):
+    ''' Save one scrape's whole timeseries (unsaved instances, one per date_field value) as versions. Only rows whose values differ from the current version are written, with the old version closed by setting valid_to. Dates missing from objs are closed too. update_date isn't compared, since it changes every day. A version keeps the update_date its values first appeared with, and an unchanged one only has its confirmed_update_date moved up. Running again for the same scrape_date replaces that day's versions. Returns (rows written, rows closed). '''
+    compare_fields = [f.attname for f in model._meta.concrete_fields if f.attname not in TIMESERIES_VERSION_FIELDS + [date_field]]
+
+    new_versions = {}
+    for obj in objs:
+        key = getattr(obj, date_field)
+        if key in new_versions:
+            raise ValueError('{} has more than one row for {} {}'.format(model.__name__, date_field, key))
+        new_versions[key] = obj
+
+    with transaction.atomic():
+        # Undo an earlier run for this scrape_date
+        model.objects.filter(valid_from=scrape_date).delete()
+        model.objects.filter(valid_from__isnull=False, valid_to=scrape_date).update(valid_to=None)
+
+        current = {getattr(v, date_field): v for v in model.objects.filter(valid_from__isnull=False, valid_to__isnull=True)}
+
+        to_close = []
+        to_create = []
+        to_confirm = {}  # update_date: ids of unchanged versions it confirms
+        for key, obj in new_versions.items():
+            current_version = current.pop(key, None)
+            if current_version is not None:
+                if all(getattr(obj, f) == getattr(current_version, f) for f in compare_fields):
+                    if obj.update_date != current_version.confirmed_update_date:
+                        to_confirm.setdefault(obj.update_date, []).append(current_version.id)
+                    continue
+                to_close.append(current_version.id)
+            obj.scrape_date = scrape_date
+            obj.valid_from = scrape_date
+            obj.valid_to = None
+            obj.confirmed_update_date = obj.update_date
+            to_create.append(obj)
+        to_close.extend(v.id for v in current.values())  # Dates MDH dropped
+
+        model.objects.filter(id__in=to_close).update(valid_to=scrape_date)
+        model.objects.bulk_create(to_create)
+        for update_date, ids in to_confirm.items():
+            model.objects.filter(id__in=ids).update(confirmed_update_date=update_date)
+
+    return len(to_create), len(to_close)
+
+def timeseries_as_of(model, scrape_date=None):
+    ''' The whole timeseries as it stood on scrape_date, or on the latest scrape_date, from either whole-table snapshots or versions '''
+    if scrape_date is None:
+        latest = model.objects.aggregate(Max('scrape_date'), Max('valid_to'))
+        scrape_date = max([d for d in latest.values() if d is not None], default=None)
+        if scrape_date is None:
+            return model.objects.none()
+
+    snapshot = model.objects.filter(valid_from__isnull=True, scrape_date=scrape_date)
+    if snapshot.exists():
+        return snapshot
+    return model.objects.filter(valid_from__lte=scrape_date).filter(Q(valid_to__isnull=True) | Q(valid_to__gt=scrape_date))